@@ -53,33 +53,33 @@ function showSection(sectionName) {
 // Load dashboard data
 async function loadDashboardData() {
     try {
-        // Load statistics
-        const [productsRes, ordersRes, lowStockRes, healthRes] = await Promise.all([
-            fetch(`${API_BASE.inventory}/inventory/products`),
-            fetch(`${API_BASE.orders}/orders/`),
-            fetch(`${API_BASE.inventory}/inventory/low-stock`),
-            fetch(`${API_BASE.inventory}/healthz`)
-        ]);
-
-        const productsData = await productsRes.json();
-        const ordersData = await ordersRes.json();
-        const lowStockData = await lowStockRes.json();
-        const healthData = await healthRes.json();
-
-        // 計算庫存警告統計
-        const outOfStockCount = productsData.filter(p => (p.stock || 0) === 0).length;
-        const lowStockCount = productsData.filter(p => {
-            const stock = p.stock || 0;
-            const safetyStock = p.safety_stock || 0;
-            return stock > 0 && stock <= safetyStock;
-        }).length;
-        const totalStockAlerts = outOfStockCount + lowStockCount;
+        // 單一摘要端點：訂單數、營收、庫存警告與近期訂單由服務端定期彙總
+        const response = await fetch(`${API_BASE.orders}/dashboard/summary`);
+        const summary = await response.json();
+        const inventory = summary.inventory || { total_products: 0, out_of_stock: 0, low_stock: 0, total_alerts: 0, items: [] };
+
+        // 摘要中的產品依庫存減安全庫存排序，最接近缺貨的在前
+        const productsData = inventory.items.map(item => ({
+            id: item.product_id,
+            sku: item.sku,
+            name: item.name,
+            stock: item.current_stock,
+            safety_stock: item.safety_stock
+        }));
 
         // Update statistics
-        document.getElementById('total-products').textContent = productsData.length || 0;
-        document.getElementById('total-orders').textContent = ordersData.length || 0;
-        document.getElementById('low-stock-count').textContent = totalStockAlerts || 0;
-        document.getElementById('system-status').textContent = healthData.status === 'ok' ? 'Healthy' : 'Unhealthy';
+        document.getElementById('total-products').textContent = inventory.total_products;
+        document.getElementById('total-orders').textContent = summary.orders.total;
+        document.getElementById('total-revenue').textContent = `Revenue: $${summary.orders.revenue.toFixed(2)}`;
+        document.getElementById('low-stock-count').textContent = inventory.total_alerts;
+        document.getElementById('system-status').textContent = summary.inventory_status === 'ok' ? 'Healthy' : 'Unhealthy';
+
+        // 摘要只帶最接近缺貨的前幾項，圖表與警告註明涵蓋範圍
+        const alertCount = inventory.total_alerts;
+        document.getElementById('inventory-chart-scope').textContent =
+            `${productsData.length} of ${inventory.total_products} products closest to stockout`;
+        document.getElementById('stock-alerts-scope').textContent =
+            alertCount > productsData.length ? `Showing ${productsData.length} of ${alertCount}` : '';
 
         // Load low stock and out of stock alerts
         loadStockAlerts(productsData);
@@ -87,12 +87,38 @@ async function loadDashboardData() {
         // Load inventory chart
         loadInventoryChart(productsData);
 
+        // Load recent orders
+        loadRecentOrders(summary.orders.recent);
+
     } catch (error) {
         console.error('Error loading dashboard data:', error);
         showAlert('Error loading dashboard data', 'danger');
     }
 }
 
+// Load recent orders
+function loadRecentOrders(recentOrders) {
+    const tbody = document.getElementById('recent-orders-table');
+    if (recentOrders.length === 0) {
+        tbody.innerHTML = '<tr><td colspan="5" class="text-center text-muted">No orders found</td></tr>';
+        return;
+    }
+
+    let html = '';
+    recentOrders.forEach(order => {
+        html += `
+            <tr>
+                <td>${order.id}</td>
+                <td>${order.customer_name || '-'}</td>
+                <td><span class="badge ${getStatusClass(order.status)}">${order.status}</span></td>
+                <td>$${order.total.toFixed(2)}</td>
+                <td>${new Date(order.created_at).toLocaleString()}</td>
+            </tr>
+        `;
+    });
+    tbody.innerHTML = html;
+}
+
 // Load low stock alerts
 function loadStockAlerts(productsData) {
     const container = document.getElementById('low-stock-list');
@@ -0,0 +1,239 @@
+import codecs
+import csv
+import io
+import json
+import os
+from typing import Any, Iterable, Iterator, Optional
+from pydantic import BaseModel, ValidationError, confloat, conint, constr
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Session
+from .db import SessionLocal
+from .models import Product, Inventory
+from .cache import write_through_products
+from .catalog import build_catalog_query, paginate, product_snapshot
+from .services.hot_stock import hot_stock
+from .services.outbox import enqueue_stock_events, stock_event
+from .services.redis_pubsub import redis_pubsub
+from .services.reservations import held_quantities
+
+BULK_FORMATS = ("csv", "ndjson")
+IMPORT_CHUNK_SIZE = int(os.getenv("BULK_IMPORT_CHUNK_SIZE", "1000"))
+EXPORT_CHUNK_SIZE = int(os.getenv("BULK_EXPORT_CHUNK_SIZE", "1000"))
+# 回應中最多列出的錯誤筆數（失敗總數仍完整計算）
+MAX_REPORTED_ERRORS = 1000
+EXPORT_FIELDS = ["id", "sku", "name", "price", "safety_stock", "stock"]
+
+class ImportRow(BaseModel):
+    sku: constr(strip_whitespace=True, min_length=1, max_length=64)
+    name: constr(strip_whitespace=True, min_length=1, max_length=255)
+    price: confloat(ge=0, lt=100000000)
+    safety_stock: conint(ge=0) = 0
+    stock: Optional[conint(ge=0)] = None  # 未提供時既有產品保留原庫存，新產品為 0
+
+def iter_lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """把位元組區塊逐步解碼並切成行（保留換行，讓 csv 模組處理欄位內換行）"""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        parts = buffer.split("\n")
+        buffer = parts.pop()
+        for part in parts:
+            yield part + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+def iter_rows(lines: Iterable[str], fmt: str) -> Iterator[tuple[int, Any]]:
+    """解析 CSV（首行為欄位名稱）或 NDJSON，回傳 (資料列號, dict 或解析錯誤)"""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        if reader.fieldnames:
+            reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+        for row_number, row in enumerate(reader, start=1):
+            if None in row:
+                yield row_number, ValueError("too many columns")
+                continue
+            yield row_number, {k: v for k, v in row.items() if v not in (None, "")}
+        return
+    row_number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            yield row_number, ValueError(f"invalid JSON: {e}")
+            continue
+        if not isinstance(data, dict):
+            yield row_number, ValueError("row must be a JSON object")
+            continue
+        yield row_number, data
+
+def _validation_message(e: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(x) for x in err['loc'])}: {err['msg']}" for err in e.errors())
+
+class ProductImporter:
+    """分批匯入產品與庫存
+
+    每批以多列 INSERT ... ON DUPLICATE KEY UPDATE 寫入 products 與 inventory，
+    一批一個交易，提交後一次寫入快取。同一批內重複的 SKU 以最後一列為準。
+    既有產品與單筆寫入相同：庫存不可低於有效預留，庫存變更事件隨交易寫入 outbox，
+    提交後發布 product_updates 讓其他服務失效產品快取。
+    """
+
+    def __init__(self, chunk_size: int = IMPORT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.processed = 0
+        self.upserted = 0
+        self.failed = 0
+        self.errors: list[dict] = []
+
+    def _error(self, row_number: int, sku: Optional[str], message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "sku": sku, "error": message})
+
+    def run(self, rows: Iterable[tuple[int, Any]]) -> dict:
+        chunk: dict[str, tuple[int, ImportRow]] = {}
+        for row_number, data in rows:
+            self.processed += 1
+            if isinstance(data, Exception):
+                self._error(row_number, None, str(data))
+                continue
+            try:
+                row = ImportRow(**data)
+            except ValidationError as e:
+                self._error(row_number, data.get("sku"), _validation_message(e))
+                continue
+            chunk[row.sku] = (row_number, row)
+            if len(chunk) >= self.chunk_size:
+                self._flush(chunk)
+                chunk = {}
+        if chunk:
+            self._flush(chunk)
+        return {
+            "processed": self.processed,
+            "upserted": self.upserted,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
+
+    def _flush(self, chunk: dict[str, tuple[int, ImportRow]]):
+        db = SessionLocal()
+        try:
+            snapshots, updated_ids = self._write_chunk(db, chunk)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for row_number, row in chunk.values():
+                self._error(row_number, row.sku, f"chunk failed: {getattr(e, 'orig', e)}")
+            return
+        finally:
+            db.close()
+        self.upserted += len(snapshots)
+        write_through_products(snapshots)
+        redis_pubsub.publish_product_updates(updated_ids, "updated")
+
+    def _write_chunk(self, db: Session, chunk: dict[str, tuple[int, ImportRow]]) -> tuple[list[dict], list[int]]:
+        """寫入一批，回傳 (新快照, 既有產品 ID)"""
+        existing = dict(db.execute(select(Product.sku, Product.id).where(Product.sku.in_(list(chunk)))).all())
+        # 依 product_id 順序鎖定既有產品的庫存列，與單筆寫入及建立預留互斥，並取得匯入前的庫存
+        old_stocks = dict(db.execute(
+            select(Inventory.product_id, Inventory.stock)
+            .where(Inventory.product_id.in_(list(existing.values())))
+            .order_by(Inventory.product_id)
+            .with_for_update()
+        ).all()) if existing else {}
+
+        # 熱門商品的庫存以 Redis 計數器為準，不接受匯入覆寫；Redis 無法使用時既有產品的庫存一律不覆寫
+        try:
+            hot = set(hot_stock.hot_ids(list(existing.values())))
+            error = "product is in hot stock mode; disable it before importing stock"
+        except Exception:
+            hot = set(existing.values())
+            error = "hot stock state unavailable; retry importing stock later"
+        for sku in [sku for sku, (_, row) in chunk.items() if row.stock is not None and existing.get(sku) in hot]:
+            row_number, _ = chunk.pop(sku)
+            self._error(row_number, sku, error)
+        # 庫存不可低於有效預留
+        held = held_quantities(db, [existing[sku] for sku, (_, row) in chunk.items()
+                                    if row.stock is not None and sku in existing])
+        for sku in [sku for sku, (_, row) in chunk.items()
+                    if row.stock is not None and row.stock < held.get(existing.get(sku), 0)]:
+            row_number, _ = chunk.pop(sku)
+            self._error(row_number, sku, f"stock cannot go below reserved quantity ({held[existing[sku]]})")
+        if not chunk:
+            return [], []
+
+        stmt = insert(Product).values([
+            {"sku": row.sku, "name": row.name, "price": row.price, "safety_stock": row.safety_stock}
+            for _, row in chunk.values()
+        ])
+        db.execute(stmt.on_duplicate_key_update(
+            name=stmt.inserted.name, price=stmt.inserted.price, safety_stock=stmt.inserted.safety_stock
+        ))
+        new_skus = [sku for sku in chunk if sku not in existing]
+        if new_skus:
+            existing.update(db.execute(select(Product.sku, Product.id).where(Product.sku.in_(new_skus))).all())
+
+        with_stock = [{"product_id": existing[sku], "stock": row.stock}
+                      for sku, (_, row) in chunk.items() if row.stock is not None]
+        without_stock = [{"product_id": existing[sku], "stock": 0}
+                         for sku, (_, row) in chunk.items() if row.stock is None]
+        if with_stock:
+            stmt = insert(Inventory).values(with_stock)
+            db.execute(stmt.on_duplicate_key_update(stock=stmt.inserted.stock, version=Inventory.version + 1))
+        if without_stock:
+            # 既有庫存列只遞增版本（產品資訊已更新），只為新產品補上庫存列
+            stmt = insert(Inventory).values(without_stock)
+            db.execute(stmt.on_duplicate_key_update(version=Inventory.version + 1))
+
+        ids = [existing[sku] for sku in chunk]
+        rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(
+            Product.id.in_(ids)
+        ).all()
+        snapshots = [product_snapshot(p, inv.stock, inv.version) for p, inv in rows]
+        # 與 set_stock 相同，既有產品的庫存有變更時寫入庫存事件
+        enqueue_stock_events(db, [
+            stock_event(snapshot, old_stocks[snapshot["id"]], snapshot["stock"] - old_stocks[snapshot["id"]])
+            for snapshot in snapshots
+            if snapshot["id"] in old_stocks and snapshot["stock"] != old_stocks[snapshot["id"]]
+        ])
+        return snapshots, [pid for pid in ids if pid in old_stocks]
+
+def iter_export(fmt: str, sku_prefix: Optional[str] = None, q: Optional[str] = None,
+                low_stock_only: bool = False, chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    """依 id 鍵集分頁逐批輸出產品，不在記憶體中建立完整清單；熱門商品的庫存取自計數器"""
+    db = SessionLocal()
+    try:
+        if fmt == "csv":
+            yield ",".join(EXPORT_FIELDS) + "\r\n"
+        cursor = None
+        while True:
+            query = build_catalog_query(db, sku_prefix, q, low_stock_only)
+            rows, cursor = paginate(query, "id", "asc", cursor, chunk_size)
+            try:
+                hot_values = hot_stock.get_stocks([p.id for p, _ in rows])
+            except Exception:
+                hot_values = {}
+            snapshots = [
+                {field: value for field, value in product_snapshot(p, hot_values.get(p.id, inv.stock)).items()
+                 if field in EXPORT_FIELDS}
+                for p, inv in rows
+            ]
+            if fmt == "csv":
+                buffer = io.StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+                writer.writerows(snapshots)
+                yield buffer.getvalue()
+            else:
+                yield "".join(json.dumps(s) + "\n" for s in snapshots)
+            # 釋放本批物件，避免 session 身分對應表隨匯出累積
+            db.expunge_all()
+            if not cursor:
+                break
+    finally:
+        db.close()
@@ -1,11 +1,426 @@
-import os, redis
+import os, redis, json, hashlib, time, uuid
+import redis.asyncio as aioredis
+from typing import Callable, Optional
+from prometheus_client import Counter, Histogram
 
 _redis = None
+_async_redis = None
+
+# 完整產品清單以 hash 保存（product_id -> JSON），寫入時套用單筆差異而非整份刪除
+PRODUCTS_LIST_KEY = "products:list:v2"
+PRODUCTS_LIST_BUILDING_KEY = "products:list:v2:building"
+# 重建期間刪除的產品 ID，寫入 DB 結果時略過，避免重建讀到的舊資料把已刪除的產品加回
+PRODUCTS_LIST_TOMBSTONES_KEY = "products:list:v2:building:deleted"
+PRODUCTS_LIST_FRESH_KEY = "products:list:v2:fresh"
+PRODUCTS_LIST_LOCK_KEY = "products:list:v2:lock"
+PRODUCTS_LIST_BUILDING_MARKER = "__building__"
+# 軟性 TTL：過期後由單一 worker 全量重建校正，其他請求繼續讀取現有清單
+PRODUCTS_LIST_SOFT_TTL = int(os.getenv("PRODUCTS_LIST_SOFT_TTL", "300"))
+PRODUCTS_LIST_LOCK_TTL_MS = 30000
+PRODUCTS_LIST_REBUILD_CHUNK = 1000
+CATALOG_VERSION_KEY = "catalog:version"
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", "300"))
+# 單飛鎖：只有取得鎖的請求回源查 DB，其餘請求短暫等待快取寫入
+PRODUCT_LOCK_TTL_MS = 2000
+PRODUCT_LOCK_WAIT_SECONDS = 0.05
+PRODUCT_LOCK_WAIT_ATTEMPTS = 5
+
+# 從已存在的清單 hash（含重建中的暫存 hash）移除產品；重建進行中時另記錄刪除標記
+_LIST_DELETE_LUA = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('SADD', KEYS[3], ARGV[1])
+    redis.call('PEXPIRE', KEYS[3], redis.call('PTTL', KEYS[2]))
+end
+return 1
+"""
+_list_delete_script = None
+
+# 重建時寫入一批 DB 結果：略過有刪除標記的產品，HSETNX 讓重建期間寫入的較新差異優先，
+# 並延長暫存 hash、刪除標記與重建鎖的有效期限，載入時間較長時不會中途過期
+_LIST_SEED_LUA = """
+for i = 2, #ARGV, 2 do
+    if redis.call('SISMEMBER', KEYS[2], ARGV[i]) == 0 then
+        redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[1])
+redis.call('PEXPIRE', KEYS[3], ARGV[1])
+return 1
+"""
+_list_seed_script = None
+
+# 依版本寫入單一產品快取與清單項目：現有內容的版本較新時略過，避免較晚送達的舊寫入覆蓋新資料。
+# 只有分頁會顯示的欄位有變（或沒有舊快取可比較）時才遞增目錄版本，只改了版本的寫入不會讓分頁快取失效
+_WRITE_THROUGH_LUA = """
+local version = tonumber(ARGV[3])
+local incoming = cjson.decode(ARGV[2])
+local function decode(raw)
+    if not raw then
+        return nil
+    end
+    local ok, current = pcall(cjson.decode, raw)
+    if not ok or type(current) ~= 'table' then
+        return nil
+    end
+    return current
+end
+local function newer(current)
+    return current == nil or current.version == nil or version >= tonumber(current.version)
+end
+local function visible_change(current)
+    if current == nil then
+        return true
+    end
+    for _, field in ipairs({'sku', 'name', 'price', 'safety_stock', 'stock'}) do
+        if current[field] ~= incoming[field] then
+            return true
+        end
+    end
+    return false
+end
+local current = decode(redis.call('GET', KEYS[1]))
+local changed = false
+if newer(current) then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[4])
+    changed = visible_change(current)
+end
+for i = 2, 3 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        local entry = decode(redis.call('HGET', KEYS[i], ARGV[1]))
+        if newer(entry) then
+            redis.call('HSET', KEYS[i], ARGV[1], ARGV[2])
+        end
+    end
+end
+if changed then
+    redis.call('INCR', KEYS[4])
+end
+return changed and 1 or 0
+"""
+_write_through_script = None
+
+def product_key(product_id) -> str:
+    return f"product:{product_id}:v1"
+
+def _delete_list_entry(pipe, product_id):
+    global _list_delete_script
+    if _list_delete_script is None:
+        _list_delete_script = get_redis().register_script(_LIST_DELETE_LUA)
+    _list_delete_script(
+        keys=[PRODUCTS_LIST_KEY, PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_TOMBSTONES_KEY],
+        args=[str(product_id)],
+        client=pipe,
+    )
+
+REDIS_OP_DURATION = Histogram(
+    "redis_command_duration_seconds", "Redis 指令延遲", ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+REDIS_ERRORS = Counter("redis_command_errors_total", "Redis 指令錯誤數", ["command"])
+
+def observe_redis_command(command: str, elapsed: float, failed: bool = False):
+    REDIS_OP_DURATION.labels(command=command).observe(elapsed)
+    if failed:
+        REDIS_ERRORS.labels(command=command).inc()
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """記錄整批 pipeline 執行時間的 Pipeline"""
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command("PIPELINE", time.perf_counter() - start, failed)
+
+class InstrumentedRedis(redis.Redis):
+    """記錄每個指令延遲的 Redis 客戶端（Lua 腳本記為 EVALSHA）"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command(str(args[0]).upper(), time.perf_counter() - start, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedAsyncPipeline(aioredis.client.Pipeline):
+    """記錄整批 pipeline 執行時間的非同步 Pipeline"""
+
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command("PIPELINE", time.perf_counter() - start, failed)
+
+class InstrumentedAsyncRedis(aioredis.Redis):
+    """記錄每個指令延遲的非同步 Redis 客戶端；訂閱連線的 get_message 不經過此處，不計入"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command(str(args[0]).upper(), time.perf_counter() - start, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
 
 def get_redis():
     global _redis
     if _redis is None:
         host = os.getenv("REDIS_HOST", "redis")
         port = int(os.getenv("REDIS_PORT", "6379"))
-        _redis = redis.Redis(host=host, port=port, decode_responses=True)
+        _redis = InstrumentedRedis(host=host, port=port, decode_responses=True)
     return _redis
+
+# 帶擁有者 token 的跨副本鎖：只有仍持有鎖（值仍是自己的 token）時才延長或刪除
+_LOCK_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_LOCK_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def acquire_lock(key: str, ttl_ms: int) -> Optional[str]:
+    """取得鎖，回傳 token；已被持有時回傳 None"""
+    token = uuid.uuid4().hex
+    return token if get_redis().set(key, token, nx=True, px=ttl_ms) else None
+
+def renew_lock(key: str, token: str, ttl_ms: int) -> bool:
+    """延長仍持有的鎖，回傳是否仍持有"""
+    return bool(get_redis().eval(_LOCK_RENEW_LUA, 1, key, token, ttl_ms))
+
+def release_lock(key: str, token: str):
+    """釋放仍持有的鎖，不會刪除其他副本在過期後取得的鎖"""
+    get_redis().eval(_LOCK_RELEASE_LUA, 1, key, token)
+
+def get_async_redis():
+    """非阻塞客戶端，供事件迴圈中長時間等待的訂閱使用"""
+    global _async_redis
+    if _async_redis is None:
+        host = os.getenv("REDIS_HOST", "redis")
+        port = int(os.getenv("REDIS_PORT", "6379"))
+        _async_redis = InstrumentedAsyncRedis(host=host, port=port, decode_responses=True)
+    return _async_redis
+
+def invalidate_product_cache(*product_ids):
+    """移除產品的單一快取與清單項目，並遞增目錄版本讓所有分頁快取失效"""
+    try:
+        r = get_redis()
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(*[product_key(pid) for pid in product_ids])
+        for pid in product_ids:
+            _delete_list_entry(pipe, pid)
+        pipe.incr(CATALOG_VERSION_KEY)
+        pipe.execute()
+    except Exception:
+        pass
+
+def write_through_products(snapshots: list[dict]):
+    """寫入後直接更新單一產品快取與清單項目，分頁會顯示的欄位有變時才失效分頁快取
+
+    以快照中的庫存列版本比較後才寫入，並行寫入的快取更新順序與提交順序不同時也不會留下舊資料。
+    """
+    global _write_through_script
+    if not snapshots:
+        return
+    try:
+        r = get_redis()
+        if _write_through_script is None:
+            _write_through_script = r.register_script(_WRITE_THROUGH_LUA)
+        pipe = r.pipeline(transaction=False)
+        for snapshot in snapshots:
+            _write_through_script(
+                keys=[product_key(snapshot["id"]), PRODUCTS_LIST_KEY, PRODUCTS_LIST_BUILDING_KEY, CATALOG_VERSION_KEY],
+                args=[str(snapshot["id"]), json.dumps(snapshot), snapshot["version"], PRODUCT_CACHE_TTL],
+                client=pipe,
+            )
+        pipe.execute()
+    except Exception:
+        pass
+
+def get_cached_product(product_id: int, loader: Callable[[], Optional[dict]]) -> Optional[dict]:
+    """讀取單一產品快取；未命中時以單飛鎖回源，避免快取擊穿時大量請求同時查 DB
+
+    回源結果以 SET NX 寫入，不會覆蓋寫入端同時寫入的較新資料。
+    Redis 無法使用時直接回源。
+    """
+    key = product_key(product_id)
+    try:
+        r = get_redis()
+        cached = r.get(key)
+        if cached:
+            return json.loads(cached)
+
+        lock_key = f"{key}:lock"
+        if not r.set(lock_key, "1", nx=True, px=PRODUCT_LOCK_TTL_MS):
+            for _ in range(PRODUCT_LOCK_WAIT_ATTEMPTS):
+                time.sleep(PRODUCT_LOCK_WAIT_SECONDS)
+                cached = r.get(key)
+                if cached:
+                    return json.loads(cached)
+            return loader()
+    except Exception:
+        return loader()
+
+    try:
+        snapshot = loader()
+        if snapshot is not None:
+            try:
+                r.set(key, json.dumps(snapshot), ex=PRODUCT_CACHE_TTL, nx=True)
+            except Exception:
+                pass
+        return snapshot
+    finally:
+        try:
+            r.delete(lock_key)
+        except Exception:
+            pass
+
+def _rebuild_product_list(r, loader: Callable[[], list[dict]]) -> list[dict]:
+    """全量重建清單 hash：先建立暫存 hash 接收重建期間的差異與刪除標記，再逐批寫入
+    DB 結果（較新的差異優先、已刪除的略過），最後原子性地改名取代舊清單"""
+    global _list_seed_script
+    if _list_seed_script is None:
+        _list_seed_script = r.register_script(_LIST_SEED_LUA)
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_TOMBSTONES_KEY)
+    pipe.hset(PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_BUILDING_MARKER, "1")
+    pipe.pexpire(PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_LOCK_TTL_MS)
+    pipe.execute()
+
+    snapshots = loader()
+    for start in range(0, len(snapshots), PRODUCTS_LIST_REBUILD_CHUNK):
+        args = [PRODUCTS_LIST_LOCK_TTL_MS]
+        for snapshot in snapshots[start:start + PRODUCTS_LIST_REBUILD_CHUNK]:
+            args.extend([str(snapshot["id"]), json.dumps(snapshot)])
+        _list_seed_script(
+            keys=[PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_TOMBSTONES_KEY, PRODUCTS_LIST_LOCK_KEY],
+            args=args,
+        )
+
+    pipe = r.pipeline(transaction=True)
+    pipe.hdel(PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_BUILDING_MARKER)
+    pipe.delete(PRODUCTS_LIST_TOMBSTONES_KEY)
+    if snapshots:
+        pipe.persist(PRODUCTS_LIST_BUILDING_KEY)
+        pipe.rename(PRODUCTS_LIST_BUILDING_KEY, PRODUCTS_LIST_KEY)
+    else:
+        pipe.delete(PRODUCTS_LIST_KEY)
+    pipe.set(PRODUCTS_LIST_FRESH_KEY, "1", ex=PRODUCTS_LIST_SOFT_TTL)
+    pipe.execute()
+    return snapshots
+
+def get_product_list(loader: Callable[[], list[dict]]) -> list[dict]:
+    """取得完整產品清單（依 id 排序）
+
+    清單平時由寫入端的差異維持；冷啟動或軟性 TTL 到期時只有取得鎖的 worker
+    重建，其餘請求讀取現有清單，或在冷啟動時短暫等待。Redis 無法使用時直接回源。
+    """
+    try:
+        r = get_redis()
+        pipe = r.pipeline(transaction=False)
+        pipe.hgetall(PRODUCTS_LIST_KEY)
+        pipe.exists(PRODUCTS_LIST_FRESH_KEY)
+        entries, fresh = pipe.execute()
+        if entries and fresh:
+            return sorted((json.loads(v) for v in entries.values()), key=lambda x: x["id"])
+
+        if not r.set(PRODUCTS_LIST_LOCK_KEY, "1", nx=True, px=PRODUCTS_LIST_LOCK_TTL_MS):
+            if entries:
+                return sorted((json.loads(v) for v in entries.values()), key=lambda x: x["id"])
+            for _ in range(PRODUCT_LOCK_WAIT_ATTEMPTS):
+                time.sleep(PRODUCT_LOCK_WAIT_SECONDS)
+                entries = r.hgetall(PRODUCTS_LIST_KEY)
+                if entries:
+                    return sorted((json.loads(v) for v in entries.values()), key=lambda x: x["id"])
+            return loader()
+    except Exception:
+        return loader()
+
+    try:
+        return _rebuild_product_list(r, loader)
+    except Exception:
+        return loader()
+    finally:
+        try:
+            r.delete(PRODUCTS_LIST_LOCK_KEY)
+        except Exception:
+            pass
+
+def get_cached_products(product_ids: list[int], loader: Callable[[list[int]], dict]) -> dict:
+    """批次讀取單一產品快取（MGET），未命中的以一次 loader 回源並寫回（SET NX）
+
+    loader 接收未命中的 product_id 清單，回傳 {product_id: snapshot}。
+    """
+    if not product_ids:
+        return {}
+    try:
+        r = get_redis()
+        cached = r.mget([product_key(pid) for pid in product_ids])
+    except Exception:
+        return loader(product_ids)
+
+    found = {pid: json.loads(v) for pid, v in zip(product_ids, cached) if v}
+    misses = [pid for pid in product_ids if pid not in found]
+    if misses:
+        loaded = loader(misses)
+        try:
+            pipe = r.pipeline(transaction=False)
+            for pid, snapshot in loaded.items():
+                pipe.set(product_key(pid), json.dumps(snapshot), ex=PRODUCT_CACHE_TTL, nx=True)
+            pipe.execute()
+        except Exception:
+            pass
+        found.update(loaded)
+    return found
+
+def get_page_cache(namespace: str, params: dict):
+    """讀取分頁查詢快取，回傳 (快取鍵, 資料)；鍵包含目錄版本與查詢參數雜湊"""
+    try:
+        r = get_redis()
+        version = r.get(CATALOG_VERSION_KEY) or "0"
+        digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        key = f"{namespace}:page:v1:{version}:{digest}"
+        cached = r.get(key)
+        return key, (json.loads(cached) if cached else None)
+    except Exception:
+        return None, None
+
+def set_page_cache(key, payload, ttl: int = 30):
+    """寫入分頁查詢快取"""
+    if not key:
+        return
+    try:
+        get_redis().setex(key, ttl, json.dumps(payload))
+    except Exception:
+        pass
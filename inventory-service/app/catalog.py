@@ -0,0 +1,155 @@
+import base64
+import json
+from decimal import Decimal
+from typing import Any, Optional
+from fastapi import HTTPException
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from .db import SessionLocal
+from .models import Product, Inventory
+from .cache import get_cached_product, get_cached_products, write_through_products
+from .services.hot_stock import hot_stock
+
+# 可排序欄位
+SORT_FIELDS = {
+    "id": Product.id,
+    "sku": Product.sku,
+    "name": Product.name,
+    "price": Product.price,
+    "stock": Inventory.stock,
+}
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def product_snapshot(product: Product, stock: int, version: int = 0) -> dict:
+    """單一產品快取內容（產品資料加上目前庫存與庫存列版本）"""
+    return {
+        "id": product.id,
+        "sku": product.sku,
+        "name": product.name,
+        "price": float(product.price),
+        "safety_stock": product.safety_stock,
+        "stock": stock,
+        "version": version,
+    }
+
+def get_product_snapshot(db: Session, product_id: int) -> Optional[dict]:
+    """透過快取取得單一產品，不存在時回傳 None"""
+    def load() -> Optional[dict]:
+        row = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(
+            Product.id == product_id
+        ).first()
+        if not row:
+            return None
+        p, inv = row
+        return product_snapshot(p, inv.stock, inv.version)
+    snapshot = get_cached_product(product_id, load)
+    if snapshot is not None:
+        # 熱門商品的庫存以 Redis 計數器為準
+        try:
+            hot_value = hot_stock.get_stock(product_id)
+        except Exception:
+            hot_value = None
+        if hot_value is not None:
+            snapshot = {**snapshot, "stock": hot_value}
+    return snapshot
+
+def get_product_snapshots(db: Session, product_ids: list[int]) -> dict[int, dict]:
+    """透過快取批次取得多個產品，回傳 {product_id: snapshot}，不存在的產品不會出現"""
+    def load(ids: list[int]) -> dict[int, dict]:
+        rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(
+            Product.id.in_(ids)
+        ).all()
+        return {p.id: product_snapshot(p, inv.stock, inv.version) for p, inv in rows}
+    snapshots = get_cached_products(product_ids, load)
+    try:
+        hot_values = hot_stock.get_stocks(list(snapshots))
+    except Exception:
+        hot_values = {}
+    for pid, value in hot_values.items():
+        snapshots[pid] = {**snapshots[pid], "stock": value}
+    return snapshots
+
+def refresh_product_cache(product_ids: list[int]):
+    """重新載入產品並寫入快取；熱門商品的庫存取自計數器"""
+    db = SessionLocal()
+    try:
+        rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(
+            Product.id.in_(product_ids)
+        ).all()
+    finally:
+        db.close()
+    hot_values = hot_stock.get_stocks(product_ids)
+    write_through_products([product_snapshot(p, hot_values.get(p.id, inv.stock), inv.version) for p, inv in rows])
+
+def build_catalog_query(db: Session, sku_prefix: Optional[str] = None, q: Optional[str] = None,
+                        low_stock_only: bool = False):
+    """產品與庫存的 join 查詢，套用 SKU 前綴、名稱搜尋與低庫存篩選"""
+    query = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id)
+    if sku_prefix:
+        query = query.filter(Product.sku.startswith(sku_prefix, autoescape=True))
+    if q:
+        query = query.filter(Product.name.contains(q, autoescape=True))
+    if low_stock_only:
+        query = query.filter(Inventory.stock <= Product.safety_stock)
+    return query
+
+def _sort_value(sort: str, product: Product, inventory: Inventory) -> Any:
+    value = inventory.stock if sort == "stock" else getattr(product, sort)
+    return str(value) if isinstance(value, Decimal) else value
+
+def encode_cursor(sort: str, product: Product, inventory: Inventory) -> str:
+    """將 (排序欄位值, id) 編碼為不透明的游標字串"""
+    raw = json.dumps([sort, _sort_value(sort, product, inventory), product.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: str) -> tuple[Any, int]:
+    """解碼游標，格式錯誤或排序欄位不符時拋出 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_sort, value, product_id = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_sort != sort:
+        raise HTTPException(status_code=400, detail="Cursor does not match sort field")
+    if sort == "price":
+        value = Decimal(value)
+    return value, int(product_id)
+
+def paginate(query, sort: str = "id", order: str = "asc", cursor: Optional[str] = None,
+             limit: Optional[int] = None):
+    """套用排序與鍵集分頁，回傳 (rows, next_cursor)
+
+    cursor 為 None 且 limit 為 None 時回傳全部結果（舊有行為）。
+    """
+    if sort not in SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid sort field. Allowed: {list(SORT_FIELDS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Invalid order. Allowed: ['asc', 'desc']")
+
+    column = SORT_FIELDS[sort]
+    descending = order == "desc"
+    if descending:
+        query = query.order_by(column.desc(), Product.id.desc())
+    else:
+        query = query.order_by(column.asc(), Product.id.asc())
+
+    if cursor is None and limit is None:
+        return query.all(), None
+
+    if cursor:
+        value, product_id = decode_cursor(cursor, sort)
+        if descending:
+            query = query.filter(or_(column < value, and_(column == value, Product.id < product_id)))
+        else:
+            query = query.filter(or_(column > value, and_(column == value, Product.id > product_id)))
+
+    page_size = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    # 多取一筆判斷是否還有下一頁
+    rows = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(sort, *rows[-1])
+    return rows, next_cursor
@@ -3,9 +3,14 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
 from .db import engine
+from .metrics import setup_metrics
 from .models import Base
 from .routers import health, products, stock
+from .services.hot_stock import hot_stock
+from .services.outbox import outbox_relay
+from .services.reservations import hold_sweeper
 import time
+import asyncio
 
 # 開機時重試 DB，避免剛啟動連不上
 RETRIES = 20
@@ -32,6 +37,31 @@ app.add_middleware(
     allow_headers=["*"],  # 允許所有標頭
 )
 
+# Prometheus 指標：請求延遲、處理中請求數、每請求 SQL 數與 Redis 延遲
+setup_metrics(app, [engine])
+
+@app.on_event("startup")
+async def startup_event():
+    """應用啟動時啟動熱門商品庫存的 write-behind、庫存事件 outbox relay 與過期預留清理背景工作"""
+    asyncio.create_task(hot_stock.run_write_behind())
+    asyncio.create_task(outbox_relay.run())
+    asyncio.create_task(hold_sweeper.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """應用關閉時停止背景工作並寫回剩餘差異、送出剩餘事件"""
+    hot_stock.stop()
+    outbox_relay.stop()
+    hold_sweeper.stop()
+    try:
+        await asyncio.to_thread(hot_stock.flush)
+    except Exception as e:
+        print(f"Final hot stock flush failed: {e}")
+    try:
+        await asyncio.to_thread(outbox_relay.relay_once)
+    except Exception as e:
+        print(f"Final outbox relay failed: {e}")
+
 app.include_router(health.router)
 app.include_router(products.router)
 app.include_router(stock.router)
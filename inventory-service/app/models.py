@@ -1,5 +1,6 @@
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
-from sqlalchemy import String, Integer, Numeric, BigInteger, ForeignKey
+from sqlalchemy import String, Integer, Numeric, BigInteger, ForeignKey, Text, DateTime, Boolean, Index, UniqueConstraint
+from datetime import datetime
 
 Base = declarative_base()
 
@@ -15,3 +16,53 @@ class Inventory(Base):
     __tablename__ = "inventory"
     product_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
     stock: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    # 每次寫入產品或庫存都遞增，快取只接受版本不低於現有值的寫入
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+class StockEventOutbox(Base):
+    __tablename__ = "stock_event_outbox"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    product_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+class HotStockFlush(Base):
+    """已寫回 MySQL 的熱門商品差異批次，重試同一批次時略過，不會重複套用"""
+    __tablename__ = "hot_stock_flushes"
+    batch_id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    flushed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class StockHold(Base):
+    __tablename__ = "stock_holds"
+    __table_args__ = (
+        # 同一預留的每個產品只有一筆，重複送出的預留由此擋下
+        UniqueConstraint("reservation_id", "product_id", name="uq_stock_holds_reservation_product"),
+        Index("idx_stock_holds_product_expires", "product_id", "expires_at"),
+        Index("idx_stock_holds_expires", "expires_at"),
+    )
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    reservation_id: Mapped[str] = mapped_column(String(64), nullable=False)
+    product_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    qty: Mapped[int] = mapped_column(Integer, nullable=False)
+    # 熱門商品的預留已直接從 Redis 計數器扣除，釋放時需加回
+    deducted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+class ReservationConfirmation(Base):
+    """已確認（已扣庫存）的預留；永久保留，重試確認時不會再扣一次"""
+    __tablename__ = "reservation_confirmations"
+    reservation_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    confirmed_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("idx_idempotency_keys_expires", "expires_at"),
+    )
+    key: Mapped[str] = mapped_column(String(191), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    # Redis 無法使用時的備援；status_code 為空表示請求仍在處理中
+    status_code: Mapped[int] = mapped_column(Integer, nullable=True)
+    response: Mapped[str] = mapped_column(Text, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
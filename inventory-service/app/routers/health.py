@@ -1,6 +1,16 @@
 from fastapi import APIRouter
+from ..db import all_pool_stats
+from ..services.outbox import outbox_relay
 router = APIRouter(prefix="/api", tags=["health"])
 
 @router.get("/healthz")
 def healthz():
     return {"status": "ok"}
+
+@router.get("/metrics/db-pool")
+def db_pool_metrics():
+    return all_pool_stats()
+
+@router.get("/outbox/stats")
+def outbox_stats():
+    return {"stock_events": outbox_relay.stats()}
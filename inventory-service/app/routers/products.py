@@ -1,11 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
+import anyio
 from ..db import SessionLocal
 from ..models import Product, Inventory
-from ..cache import get_redis
-import json
-from typing import Optional
+from ..cache import invalidate_product_cache, write_through_products, get_product_list, get_page_cache, set_page_cache
+from ..catalog import build_catalog_query, paginate, product_snapshot, get_product_snapshot, get_product_snapshots
+from ..bulk import BULK_FORMATS, ProductImporter, iter_lines, iter_rows, iter_export
+from ..services.redis_pubsub import redis_pubsub
+from typing import Optional, Union
 
 router = APIRouter(prefix="/api/inventory", tags=["products"])
 
@@ -29,6 +34,30 @@ class ProductOut(BaseModel):
     safety_stock: int
     stock: int
 
+class ProductPageOut(BaseModel):
+    items: list[ProductOut]
+    next_cursor: Optional[str]
+
+class ProductBatchIn(BaseModel):
+    ids: list[int]
+
+class ProductBatchOut(BaseModel):
+    items: list[ProductOut]
+    missing: list[int]
+
+class ProductImportError(BaseModel):
+    row: int
+    sku: Optional[str]
+    error: str
+
+class ProductImportResult(BaseModel):
+    processed: int
+    upserted: int
+    failed: int
+    errors: list[ProductImportError]
+
+MAX_BATCH_IDS = 1000
+
 def get_db():
     db = SessionLocal()
     try:
@@ -46,47 +75,145 @@ def create_product(body: ProductCreate, db: Session = Depends(get_db)):
     inv = Inventory(product_id=p.id, stock=body.stock)
     db.add(inv); db.commit(); db.refresh(p)
 
-    # 失效快取
-    try:
-        r = get_redis()
-        r.delete("products:list:v1")
-    except Exception:
-        pass
+    # 寫入單一產品快取並失效清單快取
+    write_through_products([product_snapshot(p, inv.stock, inv.version)])
 
     return ProductOut(id=p.id, sku=p.sku, name=p.name, price=float(p.price), safety_stock=p.safety_stock, stock=inv.stock)
 
-@router.get("/products", response_model=list[ProductOut])
-def list_products(db: Session = Depends(get_db)):
-    r = get_redis()
-    cache_key = "products:list:v1"
-    cached = r.get(cache_key)
-    if cached:
-        return [ProductOut(**obj) for obj in json.loads(cached)]
-
-    rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).all()
-    result = [ProductOut(id=p.id, sku=p.sku, name=p.name, price=float(p.price),
-                         safety_stock=p.safety_stock, stock=inv.stock) for p, inv in rows]
-    try:
-        r.setex(cache_key, 30, json.dumps([x.dict() for x in result]))  # TTL 30s
-    except Exception:
-        pass
+@router.get("/products", response_model=Union[list[ProductOut], ProductPageOut])
+def list_products(
+    sku_prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    low_stock_only: bool = False,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """取得產品清單
+
+    帶 cursor 或 limit 時回傳 {items, next_cursor} 分頁結果（第一頁只帶 limit 即可）；
+    兩者皆未帶時回傳陣列（無任何參數時即為完整清單）。
+    """
+    params = {"sku_prefix": sku_prefix, "q": q, "low_stock_only": low_stock_only,
+              "sort": sort, "order": order, "cursor": cursor, "limit": limit}
+    paged = cursor is not None or limit is not None
+    if not any([sku_prefix, q, low_stock_only, paged]) and (sort, order) == ("id", "asc"):
+        return _list_all_products(db)
+
+    cache_key, cached = get_page_cache("products", params)
+    if cached is not None:
+        return ProductPageOut(**cached) if paged else [ProductOut(**obj) for obj in cached]
+
+    query = build_catalog_query(db, sku_prefix=sku_prefix, q=q, low_stock_only=low_stock_only)
+    rows, next_cursor = paginate(query, sort=sort, order=order, cursor=cursor, limit=limit)
+    items = [ProductOut(id=p.id, sku=p.sku, name=p.name, price=float(p.price),
+                        safety_stock=p.safety_stock, stock=inv.stock) for p, inv in rows]
+    result = ProductPageOut(items=items, next_cursor=next_cursor) if paged else items
+    set_page_cache(cache_key, result.dict() if paged else [x.dict() for x in items])
     return result
 
+def _list_all_products(db: Session) -> list[ProductOut]:
+    """完整產品清單（由增量維護的清單快取提供）"""
+    def load() -> list[dict]:
+        rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).order_by(Product.id).all()
+        return [product_snapshot(p, inv.stock, inv.version) for p, inv in rows]
+    return [ProductOut(**obj) for obj in get_product_list(load)]
+
+def _get_products_batch(ids: list[int], db: Session) -> ProductBatchOut:
+    unique_ids = list(dict.fromkeys(ids))
+    if len(unique_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    snapshots = get_product_snapshots(db, unique_ids)
+    return ProductBatchOut(
+        items=[ProductOut(**snapshots[pid]) for pid in unique_ids if pid in snapshots],
+        missing=[pid for pid in unique_ids if pid not in snapshots]
+    )
+
+def _bulk_format(format: Optional[str], content_type: Optional[str] = None) -> str:
+    """決定匯入／匯出格式：明確指定的 format 優先，其次依 Content-Type，預設 NDJSON"""
+    if format is None and content_type:
+        format = "csv" if "csv" in content_type else "ndjson"
+    format = format or "ndjson"
+    if format not in BULK_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format. Allowed: {list(BULK_FORMATS)}")
+    return format
+
+@router.post("/products:import", response_model=ProductImportResult)
+async def import_products(request: Request, format: Optional[str] = None):
+    """批次匯入產品（CSV 或 NDJSON），依 SKU 新增或更新
+
+    請求本文以串流方式逐批讀取、驗證與寫入，不需整份載入記憶體；
+    回傳處理筆數與每列的錯誤。
+    """
+    fmt = _bulk_format(format, request.headers.get("content-type"))
+    body = request.stream()
+
+    async def next_chunk() -> Optional[bytes]:
+        try:
+            return await body.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    def chunks():
+        # 在工作執行緒中逐塊向事件迴圈取得請求本文
+        while True:
+            chunk = anyio.from_thread.run(next_chunk)
+            if chunk is None:
+                return
+            if chunk:
+                yield chunk
+
+    importer = ProductImporter()
+    return await run_in_threadpool(lambda: importer.run(iter_rows(iter_lines(chunks()), fmt)))
+
+@router.get("/products:export")
+def export_products(
+    format: str = "ndjson",
+    sku_prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    low_stock_only: bool = False
+):
+    """串流匯出產品與庫存（CSV 或 NDJSON），依 id 逐批讀取"""
+    fmt = _bulk_format(format)
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        iter_export(fmt, sku_prefix, q, low_stock_only),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{fmt}"'},
+    )
+
+@router.get("/products:batch", response_model=ProductBatchOut)
+def get_products_batch(ids: str = Query(..., description="以逗號分隔的產品 ID"), db: Session = Depends(get_db)):
+    """一次取得多個產品（快取 MGET + 單一 IN 查詢回源）"""
+    try:
+        product_ids = [int(x) for x in ids.split(",") if x.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be comma-separated integers")
+    return _get_products_batch(product_ids, db)
+
+@router.post("/products:batch", response_model=ProductBatchOut)
+def post_products_batch(body: ProductBatchIn, db: Session = Depends(get_db)):
+    """一次取得多個產品（ID 較多時使用 POST body）"""
+    return _get_products_batch(body.ids, db)
+
 @router.get("/products/{product_id}", response_model=ProductOut)
 def get_product(product_id: int, db: Session = Depends(get_db)):
-    row = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(Product.id == product_id).first()
-    if not row:
+    snapshot = get_product_snapshot(db, product_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    p, inv = row
-    return ProductOut(id=p.id, sku=p.sku, name=p.name, price=float(p.price),
-                     safety_stock=p.safety_stock, stock=inv.stock)
+    return ProductOut(**snapshot)
 
 @router.put("/products/{product_id}", response_model=ProductOut)
 def update_product(product_id: int, body: ProductUpdate, db: Session = Depends(get_db)):
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
+    # 鎖定庫存列並遞增版本，讓產品資訊的快取寫入也依版本排序
+    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).with_for_update().first()
+    inventory.version += 1
     
     # 更新產品資訊
     if body.name is not None:
@@ -98,17 +225,13 @@ def update_product(product_id: int, body: ProductUpdate, db: Session = Depends(g
     
     db.commit()
     db.refresh(product)
+    db.refresh(inventory)
     
-    # 取得庫存資訊
-    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).first()
+    # 寫入單一產品快取並失效清單快取
+    write_through_products([product_snapshot(product, inventory.stock, inventory.version)])
     
-    # 失效快取
-    try:
-        r = get_redis()
-        r.delete("products:list:v1")
-        r.delete(f"product:{product_id}:v1")
-    except Exception:
-        pass
+    # 通知其他服務失效產品快取
+    redis_pubsub.publish_product_update({"product_id": product_id, "action": "updated"})
     
     return ProductOut(id=product.id, sku=product.sku, name=product.name, 
                      price=float(product.price), safety_stock=product.safety_stock, 
@@ -138,12 +261,10 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
     db.commit()
     
     # 失效快取
-    try:
-        r = get_redis()
-        r.delete("products:list:v1")
-        r.delete(f"product:{product_id}:v1")
-    except Exception:
-        pass
+    invalidate_product_cache(product_id)
+    
+    # 通知其他服務失效產品快取
+    redis_pubsub.publish_product_update({"product_id": product_id, "action": "deleted"})
     
     return {"message": "Product deleted successfully"}
 
@@ -1,14 +1,32 @@
-from fastapi import APIRouter, Depends, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, Header, HTTPException
+from pydantic import BaseModel, conint, constr
+from typing import Optional, Union
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import update, case, func
+from datetime import datetime, timedelta
 from ..db import SessionLocal
-from ..models import Product, Inventory
-from ..cache import get_redis
-from ..services.redis_pubsub import redis_pubsub
-import json
+from ..models import Product, Inventory, StockHold, ReservationConfirmation
+from ..cache import write_through_products, get_page_cache, set_page_cache
+from ..catalog import build_catalog_query, paginate, product_snapshot, get_product_snapshot, refresh_product_cache
+from ..idempotency import IDEMPOTENCY_HEADER, run_idempotent
+from ..services.outbox import enqueue_stock_events, stock_event
+from ..services.hot_stock import hot_stock
+from ..services.reservations import (
+    RESERVATION_TTL_SECONDS, MAX_RESERVATION_TTL_SECONDS, held_quantities, held_total_subquery,
+    restore_deducted, commit_restored
+)
+import os
+import uuid
 
 router = APIRouter(prefix="/api/inventory", tags=["stock"])
 
+BULK_STOCK_MODES = ("all_or_nothing", "best_effort")
+BULK_STOCK_CHUNK_SIZE = int(os.getenv("BULK_STOCK_CHUNK_SIZE", "1000"))
+MAX_BULK_STOCK_ITEMS = int(os.getenv("MAX_BULK_STOCK_ITEMS", "50000"))
+# 庫存摘要列出的產品數上限
+STOCK_SUMMARY_ITEMS = int(os.getenv("STOCK_SUMMARY_ITEMS", "50"))
+
 class StockAdjustment(BaseModel):
     adjustment: int  # 正數為增加，負數為減少
 
@@ -27,6 +45,80 @@ class LowStockAlert(BaseModel):
     current_stock: int
     safety_stock: int
 
+class StockSummary(BaseModel):
+    total_products: int
+    total_units: int
+    out_of_stock: int
+    low_stock: int  # 有庫存但不高於安全庫存
+    items: list[LowStockAlert]  # 依庫存減安全庫存排序，最接近缺貨的產品
+
+class StockPageOut(BaseModel):
+    items: list[StockInfo]
+    next_cursor: Optional[str]
+
+class LowStockPageOut(BaseModel):
+    items: list[LowStockAlert]
+    next_cursor: Optional[str]
+
+class StockBatchItem(BaseModel):
+    product_id: int
+    qty: conint(gt=0)
+
+class StockBatchRequest(BaseModel):
+    items: list[StockBatchItem]
+
+class StockBatchLine(BaseModel):
+    product_id: int
+    sku: str
+    name: str
+    price: float
+    qty: int
+    current_stock: int
+    safety_stock: int
+    is_low_stock: bool
+
+class StockBatchResult(BaseModel):
+    items: list[StockBatchLine]
+
+class ReservationRequest(BaseModel):
+    items: list[StockBatchItem]
+    reservation_id: Optional[constr(min_length=1, max_length=64)] = None  # 未提供時自動產生
+    ttl_seconds: Optional[conint(gt=0)] = None
+
+class ReservationConfirm(BaseModel):
+    # 預留已過期被清理時改為直接扣除這些數量
+    items: Optional[list[StockBatchItem]] = None
+
+class ReservationOut(BaseModel):
+    reservation_id: str
+    expires_at: datetime
+    items: list[StockBatchLine]
+
+class StockAvailability(BaseModel):
+    product_id: int
+    on_hand: int
+    held: int
+    available: int
+
+class StockBulkItem(BaseModel):
+    product_id: int
+    adjustment: Optional[int] = None  # 相對調整量
+    stock: Optional[conint(ge=0)] = None  # 直接設定的庫存
+
+class StockBulkRequest(BaseModel):
+    items: list[StockBulkItem]
+    mode: str = "all_or_nothing"
+
+class StockBulkFailure(BaseModel):
+    product_id: int
+    error: str
+
+class StockBulkResult(BaseModel):
+    mode: str
+    applied: int
+    items: list[StockInfo]
+    failed: list[StockBulkFailure]
+
 def get_db():
     db = SessionLocal()
     try:
@@ -34,98 +126,705 @@ def get_db():
     finally:
         db.close()
 
+HOT_STOCK_UNAVAILABLE = "Hot stock state unavailable, please retry"
+
+def _hot_ids(product_ids: list[int]) -> set[int]:
+    """取得熱門商品 ID；Redis 無法使用時無法確認是否為熱門商品，回傳 503 而不是改寫 MySQL"""
+    try:
+        return set(hot_stock.hot_ids(product_ids))
+    except Exception:
+        raise HTTPException(status_code=503, detail=HOT_STOCK_UNAVAILABLE)
+
+def _adjust_hot_stock(snapshot: dict, status: int, value: int, seq: int, adjustment: int, db: Session) -> StockInfo:
+    """熱門商品調整結果：庫存已由 Redis 計數器扣減，MySQL 由 write-behind 寫回"""
+    if status < 0:
+        raise HTTPException(status_code=400, detail="Stock cannot be negative")
+    snapshot = {**snapshot, "stock": value, "version": seq}
+    event = stock_event(snapshot, value - adjustment, adjustment)
+    enqueue_stock_events(db, [event])
+    db.commit()
+    return StockInfo(
+        product_id=snapshot["id"],
+        sku=snapshot["sku"],
+        name=snapshot["name"],
+        current_stock=value,
+        safety_stock=snapshot["safety_stock"],
+        is_low_stock=event["is_low_stock"]
+    )
+
 @router.post("/stock/{product_id}/adjust", response_model=StockInfo)
-def adjust_stock(product_id: int, body: StockAdjustment, db: Session = Depends(get_db)):
-    """調整產品庫存"""
-    # 檢查產品是否存在
-    product = db.query(Product).filter(Product.id == product_id).first()
-    if not product:
+def adjust_stock(
+    product_id: int,
+    body: StockAdjustment,
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER),
+):
+    """調整產品庫存（帶 Idempotency-Key 時，重試會重播第一次的結果而不會重複調整）"""
+    return run_idempotent(
+        "stock-adjust", idempotency_key, {"product_id": product_id, **body.dict()},
+        lambda: _adjust_stock(product_id, body, db),
+    )
+
+def _below_held_detail(held: int) -> str:
+    if held:
+        return f"Stock cannot go below reserved quantity ({held})"
+    return "Stock cannot be negative"
+
+def _reject_switched_to_hot(db: Session, product_ids: list[int]):
+    """取得庫存列鎖後再確認一次熱門模式，已切換為熱門商品時回滾並回傳 409"""
+    switched = sorted(_hot_ids(product_ids))
+    if switched:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Hot stock mode changed for products {switched}, please retry")
+
+def _adjust_stock(product_id: int, body: StockAdjustment, db: Session) -> StockInfo:
+    # 先確認產品存在，避免熱門計數器已調整後才回傳 404
+    snapshot = get_product_snapshot(db, product_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="Product not found")
+
+    # 熱門商品：由 Redis 計數器原子性地檢查並調整，不鎖定 MySQL 庫存列；
+    # Redis 發生錯誤時只有確認不是熱門商品才改寫 MySQL
+    try:
+        status, value, seq = hot_stock.adjust(product_id, body.adjustment)
+    except Exception:
+        if _hot_ids([product_id]):
+            raise HTTPException(status_code=503, detail=HOT_STOCK_UNAVAILABLE)
+        status, value, seq = 0, 0, 0
+    if status != 0:
+        return _adjust_hot_stock(snapshot, status, value, seq, body.adjustment, db)
     
-    # 更新庫存
-    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).first()
-    if not inventory:
-        raise HTTPException(status_code=404, detail="Inventory record not found")
+    # 單一條件式 UPDATE：由資料庫原子性地檢查並套用調整，不會有遺失更新；
+    # 減少庫存時條件包含有效預留總數，不可動用其他訂單的預留
+    floor = 0
+    if body.adjustment < 0:
+        floor = held_total_subquery(product_id)
+    result = db.execute(
+        update(Inventory)
+        .where(Inventory.product_id == product_id, Inventory.stock + body.adjustment >= floor)
+        .values(stock=Inventory.stock + body.adjustment, version=Inventory.version + 1)
+    )
+    if result.rowcount == 0:
+        db.rollback()
+        exists = db.query(Inventory.product_id).filter(Inventory.product_id == product_id).first()
+        if not exists:
+            raise HTTPException(status_code=404, detail="Product not found")
+        held = held_quantities(db, [product_id]).get(product_id, 0)
+        raise HTTPException(status_code=400, detail=_below_held_detail(held))
+    # UPDATE 已取得列鎖：期間若已切換為熱門商品，計數器是以寫入前的庫存建立的，放棄這次寫入
+    _reject_switched_to_hot(db, [product_id])
     
-    new_stock = inventory.stock + body.adjustment
-    if new_stock < 0:
-        raise HTTPException(status_code=400, detail="Stock cannot be negative")
+    # 同一交易內讀回（此列已被本交易的 UPDATE 鎖定）
+    product, new_stock, version = db.query(Product, Inventory.stock, Inventory.version).join(
+        Inventory, Product.id == Inventory.product_id
+    ).filter(Product.id == product_id).one()
+    snapshot = product_snapshot(product, new_stock, version)
     
-    inventory.stock = new_stock
+    # 庫存變更通知（含低庫存警告）與庫存異動在同一交易寫入 outbox，由 relay 送出
+    event = stock_event(snapshot, new_stock - body.adjustment, body.adjustment)
+    enqueue_stock_events(db, [event])
     db.commit()
-    db.refresh(inventory)
     
-    # 檢查是否低庫存並發送警告
-    is_low_stock = new_stock <= product.safety_stock
-    if is_low_stock:
-        try:
-            alert = LowStockAlert(
-                product_id=product.id,
-                sku=product.sku,
-                name=product.name,
-                current_stock=new_stock,
-                safety_stock=product.safety_stock
-            )
-            redis_pubsub.publish_low_stock_alert(alert.dict())
-        except Exception:
-            pass
-    
-    # 發布庫存變更通知
+    # 寫入單一產品快取並失效清單快取
+    write_through_products([snapshot])
+    
+    return StockInfo(
+        product_id=snapshot["id"],
+        sku=snapshot["sku"],
+        name=snapshot["name"],
+        current_stock=new_stock,
+        safety_stock=snapshot["safety_stock"],
+        is_low_stock=event["is_low_stock"]
+    )
+
+def _apply_stock_batch(items: list[StockBatchItem], sign: int, db: Session,
+                       confirmation: Optional[str] = None) -> StockBatchResult:
+    """在單一交易內依產品 ID 順序鎖定並調整多筆庫存
+
+    熱門商品不鎖定 MySQL 列，改由 Redis 計數器一次原子性地調整；
+    MySQL 交易提交失敗時會把計數器調整回去。帶 confirmation 時在同一交易記錄該預留已確認。
+    """
+    if not items:
+        raise HTTPException(status_code=400, detail="items cannot be empty")
+
+    # 合併重複的產品，數量加總
+    quantities: dict[int, int] = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.qty
+    product_ids = sorted(quantities)
+    hot_ids = _hot_ids(product_ids)
+    cold_ids = [pid for pid in product_ids if pid not in hot_ids]
+
+    # 依 product_id 順序取得列鎖，避免多筆訂單互相死結
+    found = {}
+    if cold_ids:
+        rows = (
+            db.query(Product, Inventory)
+            .join(Inventory, Product.id == Inventory.product_id)
+            .filter(Product.id.in_(cold_ids))
+            .order_by(Product.id)
+            .with_for_update()
+            .all()
+        )
+        found = {p.id: (p, inv) for p, inv in rows}
+        _reject_switched_to_hot(db, list(found))
+    hot_products = {}
+    if hot_ids:
+        hot_products = {p.id: p for p in db.query(Product).filter(Product.id.in_(hot_ids)).all()}
+
+    missing = [pid for pid in product_ids if pid not in found and pid not in hot_products]
+    if missing:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+
+    if sign < 0:
+        # 可用庫存需扣除其他訂單的有效預留
+        held = held_quantities(db, cold_ids)
+        insufficient = [
+            {"product_id": pid, "required": quantities[pid], "available": found[pid][1].stock - held.get(pid, 0)}
+            for pid in cold_ids
+            if found[pid][1].stock - held.get(pid, 0) < quantities[pid]
+        ]
+        if insufficient:
+            db.rollback()
+            raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "items": insufficient})
+
+    snapshots = {}
+    for pid in cold_ids:
+        p, inv = found[pid]
+        inv.stock = inv.stock + sign * quantities[pid]
+        inv.version += 1
+        snapshots[pid] = product_snapshot(p, inv.stock, inv.version)
+
+    hot_adjustments = {pid: sign * quantities[pid] for pid in sorted(hot_ids)}
+    if hot_adjustments:
+        status, values, seqs = hot_stock.adjust_many(hot_adjustments)
+        if status != 1:
+            db.rollback()
+            pid, available = next(iter(values.items()))
+            if status < 0:
+                raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "items": [
+                    {"product_id": pid, "required": quantities[pid], "available": available}
+                ]})
+            raise HTTPException(status_code=409, detail=f"Hot stock mode changed for product {pid}, please retry")
+        for pid, value in values.items():
+            snapshots[pid] = product_snapshot(hot_products[pid], value, seqs[pid])
+
+    events = {}
+    for pid in product_ids:
+        adjustment = sign * quantities[pid]
+        events[pid] = stock_event(snapshots[pid], snapshots[pid]["stock"] - adjustment, adjustment)
+    enqueue_stock_events(db, list(events.values()))
+    if confirmation is not None:
+        db.add(ReservationConfirmation(reservation_id=confirmation))
+
     try:
-        change_data = {
-            "product_id": product.id,
-            "sku": product.sku,
-            "name": product.name,
-            "old_stock": inventory.stock - body.adjustment,
-            "new_stock": new_stock,
-            "adjustment": body.adjustment,
-            "is_low_stock": is_low_stock,
-            "timestamp": inventory.updated_at.isoformat() if inventory.updated_at else None
-        }
-        redis_pubsub.publish_stock_change(change_data)
+        db.commit()
     except Exception:
-        pass
-    
-    # 失效快取
+        if hot_adjustments:
+            hot_stock.adjust_many({pid: -adj for pid, adj in hot_adjustments.items()})
+        raise
+
+    lines = []
+    for pid in product_ids:
+        snapshot = snapshots[pid]
+        lines.append(StockBatchLine(
+            product_id=pid,
+            sku=snapshot["sku"],
+            name=snapshot["name"],
+            price=snapshot["price"],
+            qty=quantities[pid],
+            current_stock=snapshot["stock"],
+            safety_stock=snapshot["safety_stock"],
+            is_low_stock=events[pid]["is_low_stock"]
+        ))
+
+    # 熱門商品的快取由 write-behind 寫回後更新
+    write_through_products([snapshots[pid] for pid in cold_ids])
+    return StockBatchResult(items=lines)
+
+def _apply_bulk_chunk(ops: dict[int, StockBulkItem], db: Session,
+                     failures: list[StockBulkFailure]) -> list[dict]:
+    """鎖定一批庫存列並以單一 UPDATE ... CASE 套用，事件寫入 outbox，回傳新快照"""
+    rows = (
+        db.query(Product, Inventory.stock, Inventory.version)
+        .join(Inventory, Product.id == Inventory.product_id)
+        .filter(Product.id.in_(list(ops)))
+        .order_by(Product.id)
+        .with_for_update()
+        .all()
+    )
+    found = {p.id: (p, stock, version) for p, stock, version in rows}
+    _reject_switched_to_hot(db, list(found))
+    # 庫存列已鎖定，設定或調整後的庫存不可低於有效預留
+    held = held_quantities(db, list(found))
+    new_values = {}
+    for pid, item in ops.items():
+        if pid not in found:
+            failures.append(StockBulkFailure(product_id=pid, error="Product not found"))
+            continue
+        old_stock = found[pid][1]
+        new_stock = item.stock if item.stock is not None else old_stock + item.adjustment
+        if new_stock < held.get(pid, 0):
+            failures.append(StockBulkFailure(product_id=pid, error=_below_held_detail(held.get(pid, 0))))
+            continue
+        new_values[pid] = new_stock
+    if new_values:
+        db.execute(
+            update(Inventory)
+            .where(Inventory.product_id.in_(list(new_values)))
+            .values(stock=case(new_values, value=Inventory.product_id), version=Inventory.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+    snapshots = [product_snapshot(found[pid][0], value, found[pid][2] + 1) for pid, value in new_values.items()]
+    enqueue_stock_events(db, [
+        stock_event(snapshot, found[snapshot["id"]][1], snapshot["stock"] - found[snapshot["id"]][1])
+        for snapshot in snapshots
+    ])
+    return snapshots
+
+@router.post("/stock/bulk", response_model=StockBulkResult)
+def bulk_update_stock(body: StockBulkRequest, db: Session = Depends(get_db)):
+    """批次調整或設定庫存（進貨等大量作業）
+
+    每一項需指定 adjustment（相對調整）或 stock（直接設定）其中之一。依產品 ID 排序後
+    分批鎖定並以單一 UPDATE 套用。all_or_nothing 模式在單一交易內完成，任一項失敗即
+    全部取消並回傳 409；best_effort 模式每批各自提交，略過失敗的項目並逐項回報。
+    所有異動的事件隨交易寫入 outbox，快取只寫入一次。
+    """
+    if body.mode not in BULK_STOCK_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid mode. Allowed: {list(BULK_STOCK_MODES)}")
+    if not body.items:
+        raise HTTPException(status_code=400, detail="items cannot be empty")
+    if len(body.items) > MAX_BULK_STOCK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items (max {MAX_BULK_STOCK_ITEMS})")
+
+    ops: dict[int, StockBulkItem] = {}
+    invalid = []
+    for item in body.items:
+        if (item.adjustment is None) == (item.stock is None):
+            invalid.append({"product_id": item.product_id, "error": "Exactly one of adjustment or stock is required"})
+        elif item.product_id in ops:
+            invalid.append({"product_id": item.product_id, "error": "Duplicate product_id"})
+        else:
+            ops[item.product_id] = item
+    if invalid:
+        raise HTTPException(status_code=400, detail={"message": "Invalid items", "items": invalid})
+
+    product_ids = sorted(ops)
+    hot_ids = _hot_ids(product_ids)
+    failures: list[StockBulkFailure] = []
+    for pid in sorted(hot_ids):
+        if ops[pid].stock is not None:
+            failures.append(StockBulkFailure(product_id=pid, error="Product is in hot stock mode; disable it before setting stock"))
+    cold_ids = [pid for pid in product_ids if pid not in hot_ids]
+    hot_adjustments = {pid: ops[pid].adjustment for pid in sorted(hot_ids) if ops[pid].stock is None}
+    all_or_nothing = body.mode == "all_or_nothing"
+
+    # 依 product_id 順序分批鎖定，跨批次仍維持一致的加鎖順序
+    results: list[dict] = []
+    for i in range(0, len(cold_ids), BULK_STOCK_CHUNK_SIZE):
+        chunk = {pid: ops[pid] for pid in cold_ids[i:i + BULK_STOCK_CHUNK_SIZE]}
+        if all_or_nothing:
+            try:
+                results.extend(_apply_bulk_chunk(chunk, db, failures))
+            except Exception:
+                db.rollback()
+                raise
+            continue
+        # best_effort：每批各自提交，整批失敗時回報該批所有項目並繼續下一批
+        chunk_failures: list[StockBulkFailure] = []
+        try:
+            chunk_results = _apply_bulk_chunk(chunk, db, chunk_failures)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            failures.extend(StockBulkFailure(product_id=pid, error=f"Chunk failed: {getattr(e, 'orig', e)}") for pid in chunk)
+            continue
+        failures.extend(chunk_failures)
+        results.extend(chunk_results)
+
+    hot_results: list[dict] = []
+    if hot_adjustments:
+        hot_products = {p.id: p for p in db.query(Product).filter(Product.id.in_(list(hot_adjustments))).all()}
+        for pid in [pid for pid in hot_adjustments if pid not in hot_products]:
+            failures.append(StockBulkFailure(product_id=pid, error="Product not found"))
+            del hot_adjustments[pid]
+    if all_or_nothing and failures:
+        db.rollback()
+        raise HTTPException(status_code=409, detail={
+            "message": "Bulk stock update rejected", "items": [f.dict() for f in failures]
+        })
+    if hot_adjustments:
+        if all_or_nothing:
+            status, values, seqs = hot_stock.adjust_many(hot_adjustments)
+            if status != 1:
+                db.rollback()
+                pid = next(iter(values))
+                error = "Stock cannot be negative" if status < 0 else "Hot stock mode changed, please retry"
+                raise HTTPException(status_code=409, detail={
+                    "message": "Bulk stock update rejected", "items": [{"product_id": pid, "error": error}]
+                })
+        else:
+            values, seqs = {}, {}
+            for pid, (status, value, seq) in hot_stock.adjust_each(hot_adjustments).items():
+                if status == 1:
+                    values[pid], seqs[pid] = value, seq
+                else:
+                    error = "Stock cannot be negative" if status < 0 else "Hot stock mode changed, please retry"
+                    failures.append(StockBulkFailure(product_id=pid, error=error))
+            # 只有實際套用的項目需要在提交失敗時調整回去
+            hot_adjustments = {pid: hot_adjustments[pid] for pid in values}
+        hot_results = [product_snapshot(hot_products[pid], value, seqs[pid]) for pid, value in values.items()]
+        enqueue_stock_events(db, [
+            stock_event(snapshot, snapshot["stock"] - hot_adjustments[snapshot["id"]], hot_adjustments[snapshot["id"]])
+            for snapshot in hot_results
+        ])
+
     try:
-        r = get_redis()
-        r.delete("products:list:v1")
-        r.delete(f"product:{product_id}:v1")
+        db.commit()
     except Exception:
-        pass
-    
-    return StockInfo(
-        product_id=product.id,
-        sku=product.sku,
-        name=product.name,
-        current_stock=inventory.stock,
-        safety_stock=product.safety_stock,
-        is_low_stock=is_low_stock
+        # 兩種模式都把已套用的計數器調整回去，否則計數器已變動而對應的 outbox 事件遺失
+        db.rollback()
+        if hot_adjustments:
+            hot_stock.adjust_many({pid: -adj for pid, adj in hot_adjustments.items()})
+        raise
+
+    items = [
+        StockInfo(
+            product_id=snapshot["id"],
+            sku=snapshot["sku"],
+            name=snapshot["name"],
+            current_stock=snapshot["stock"],
+            safety_stock=snapshot["safety_stock"],
+            is_low_stock=snapshot["stock"] <= snapshot["safety_stock"]
+        )
+        for snapshot in results + hot_results
+    ]
+
+    # 熱門商品的快取由 write-behind 寫回後更新
+    write_through_products(results)
+    return StockBulkResult(mode=body.mode, applied=len(items), items=items, failed=failures)
+
+@router.post("/stock/reserve", response_model=StockBatchResult)
+def reserve_stock_batch(body: StockBatchRequest, db: Session = Depends(get_db)):
+    """一次預留多筆產品庫存（全部成功或全部失敗）"""
+    return _apply_stock_batch(body.items, -1, db)
+
+@router.post("/stock/release", response_model=StockBatchResult)
+def release_stock_batch(body: StockBatchRequest, db: Session = Depends(get_db)):
+    """一次釋放多筆產品庫存"""
+    return _apply_stock_batch(body.items, 1, db)
+
+def _merge_quantities(items: list[StockBatchItem]) -> dict[int, int]:
+    quantities: dict[int, int] = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.qty
+    return quantities
+
+def _lock_products(db: Session, product_ids: list[int]) -> dict[int, tuple[Product, Inventory]]:
+    """依 product_id 順序鎖定產品與庫存列"""
+    if not product_ids:
+        return {}
+    rows = (
+        db.query(Product, Inventory)
+        .join(Inventory, Product.id == Inventory.product_id)
+        .filter(Product.id.in_(product_ids))
+        .order_by(Product.id)
+        .with_for_update()
+        .all()
+    )
+    return {p.id: (p, inv) for p, inv in rows}
+
+def _batch_line(snapshot: dict, qty: int, current_stock: int) -> StockBatchLine:
+    return StockBatchLine(
+        product_id=snapshot["id"],
+        sku=snapshot["sku"],
+        name=snapshot["name"],
+        price=snapshot["price"],
+        qty=qty,
+        current_stock=current_stock,
+        safety_stock=snapshot["safety_stock"],
+        is_low_stock=current_stock <= snapshot["safety_stock"]
+    )
+
+@router.post("/stock/reservations", response_model=ReservationOut)
+def create_reservation(body: ReservationRequest, db: Session = Depends(get_db)):
+    """建立有效期限內的庫存預留（全部成功或全部失敗）
+
+    一般商品只新增預留紀錄、不改寫庫存列，可用庫存為現有庫存減去有效預留；
+    到期未確認的預留由背景清理釋放。熱門商品直接從 Redis 計數器扣除，釋放時加回。
+    回傳的 current_stock 為預留後的可用庫存。
+    """
+    if not body.items:
+        raise HTTPException(status_code=400, detail="items cannot be empty")
+    ttl = min(body.ttl_seconds or RESERVATION_TTL_SECONDS, MAX_RESERVATION_TTL_SECONDS)
+    reservation_id = body.reservation_id or uuid.uuid4().hex
+    if db.query(StockHold.id).filter(StockHold.reservation_id == reservation_id).first():
+        raise HTTPException(status_code=409, detail="Reservation already exists")
+
+    quantities = _merge_quantities(body.items)
+    product_ids = sorted(quantities)
+    hot_ids = _hot_ids(product_ids)
+    cold_ids = [pid for pid in product_ids if pid not in hot_ids]
+
+    # 鎖定庫存列只為了序列化同一產品的預留，不會改寫庫存列；
+    # 取得鎖後再確認一次熱門模式，避免在切換為熱門商品的同時建立不扣計數器的預留
+    found = _lock_products(db, cold_ids)
+    _reject_switched_to_hot(db, list(found))
+    hot_products = {}
+    if hot_ids:
+        hot_products = {p.id: p for p in db.query(Product).filter(Product.id.in_(hot_ids)).all()}
+    missing = [pid for pid in product_ids if pid not in found and pid not in hot_products]
+    if missing:
+        db.rollback()
+        raise HTTPException(status_code=404, detail=f"Products not found: {missing}")
+
+    held = held_quantities(db, cold_ids)
+    available = {pid: found[pid][1].stock - held.get(pid, 0) for pid in cold_ids}
+    insufficient = [
+        {"product_id": pid, "required": quantities[pid], "available": available[pid]}
+        for pid in cold_ids
+        if available[pid] < quantities[pid]
+    ]
+    if insufficient:
+        db.rollback()
+        raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "items": insufficient})
+
+    lines = {}
+    hot_adjustments = {pid: -quantities[pid] for pid in sorted(hot_ids)}
+    if hot_adjustments:
+        status, values, seqs = hot_stock.adjust_many(hot_adjustments)
+        if status != 1:
+            db.rollback()
+            pid, value = next(iter(values.items()))
+            if status < 0:
+                raise HTTPException(status_code=409, detail={"message": "Insufficient stock", "items": [
+                    {"product_id": pid, "required": quantities[pid], "available": value}
+                ]})
+            raise HTTPException(status_code=409, detail=f"Hot stock mode changed for product {pid}, please retry")
+        events = []
+        for pid, value in values.items():
+            snapshot = product_snapshot(hot_products[pid], value, seqs[pid])
+            events.append(stock_event(snapshot, value + quantities[pid], -quantities[pid]))
+            lines[pid] = _batch_line(snapshot, quantities[pid], value)
+        enqueue_stock_events(db, events)
+
+    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+    db.add_all([
+        StockHold(reservation_id=reservation_id, product_id=pid, qty=quantities[pid],
+                  deducted=pid in hot_ids, expires_at=expires_at)
+        for pid in product_ids
+    ])
+    for pid in cold_ids:
+        p, inv = found[pid]
+        lines[pid] = _batch_line(product_snapshot(p, inv.stock), quantities[pid], available[pid] - quantities[pid])
+    try:
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        if hot_adjustments:
+            hot_stock.adjust_many({pid: -adj for pid, adj in hot_adjustments.items()})
+        if isinstance(e, IntegrityError):
+            # 同一 reservation_id 的另一個請求（例如重試）已先建立預留
+            raise HTTPException(status_code=409, detail="Reservation already exists")
+        raise
+    return ReservationOut(
+        reservation_id=reservation_id,
+        expires_at=expires_at,
+        items=[lines[pid] for pid in product_ids]
     )
 
+@router.post("/stock/reservations/{reservation_id}/confirm", response_model=StockBatchResult)
+def confirm_reservation(reservation_id: str, body: Optional[ReservationConfirm] = None,
+                        db: Session = Depends(get_db)):
+    """確認預留（付款）：將預留轉為實際扣除庫存
+
+    已過期但尚未被清理的預留，在庫存仍足夠時照常確認；已被清理的預留改為直接扣除
+    body 中的數量，未提供時回傳 404。確認結果記錄在 reservation_confirmations，
+    同一預留之後再確認（包括冪等紀錄過期後的重試）只回傳空結果，不會重複扣庫存。
+    """
+    return run_idempotent(
+        "reservation-confirm", reservation_id, {"reservation_id": reservation_id},
+        lambda: _confirm_reservation(reservation_id, body.items if body else None, db),
+    )
+
+def _confirm_reservation(reservation_id: str, items: Optional[list[StockBatchItem]], db: Session) -> StockBatchResult:
+    holds = (
+        db.query(StockHold)
+        .filter(StockHold.reservation_id == reservation_id)
+        .with_for_update()
+        .all()
+    )
+    # 預留列鎖定後再檢查，與同時進行的確認互斥
+    if db.get(ReservationConfirmation, reservation_id) is not None:
+        db.rollback()
+        return StockBatchResult(items=[])
+    if not holds:
+        if not items:
+            raise HTTPException(status_code=404, detail="Reservation not found or expired")
+        try:
+            return _apply_stock_batch(items, -1, db, confirmation=reservation_id)
+        except IntegrityError:
+            # 另一個請求已先完成確認
+            db.rollback()
+            return StockBatchResult(items=[])
+
+    now = datetime.utcnow()
+    cold_holds = {h.product_id: h for h in holds if not h.deducted}
+    found = _lock_products(db, sorted(cold_holds))
+    # 扣除前確認庫存足以涵蓋本預留且不動用其他訂單的有效預留（已過期的預留可能已被其他寫入用掉）
+    held = held_quantities(db, list(found), exclude_reservation=reservation_id)
+    insufficient = [
+        {"product_id": pid, "required": cold_holds[pid].qty, "available": found[pid][1].stock - held.get(pid, 0)}
+        for pid in sorted(found)
+        if found[pid][1].stock - held.get(pid, 0) < cold_holds[pid].qty
+    ]
+    if insufficient:
+        db.rollback()
+        expired = any(cold_holds[item["product_id"]].expires_at <= now for item in insufficient)
+        message = "Reservation expired and stock is no longer available" if expired else "Insufficient stock to confirm reservation"
+        raise HTTPException(status_code=409, detail={"message": message, "items": insufficient})
+
+    snapshots = {}
+    events = []
+    for pid, hold in sorted(cold_holds.items()):
+        if pid not in found:
+            continue
+        p, inv = found[pid]
+        inv.stock -= hold.qty
+        inv.version += 1
+        snapshots[pid] = product_snapshot(p, inv.stock, inv.version)
+        events.append(stock_event(snapshots[pid], inv.stock + hold.qty, -hold.qty))
+    enqueue_stock_events(db, events)
+
+    # 熱門商品預留時已扣除，確認時只需移除預留紀錄
+    lines = [_batch_line(snapshots[pid], cold_holds[pid].qty, snapshots[pid]["stock"]) for pid in sorted(snapshots)]
+    hot_holds = [h for h in holds if h.deducted]
+    if hot_holds:
+        hot_values = hot_stock.get_stocks([h.product_id for h in hot_holds])
+        hot_products = {p.id: p for p in db.query(Product).filter(Product.id.in_([h.product_id for h in hot_holds])).all()}
+        for h in hot_holds:
+            if h.product_id in hot_products:
+                stock = hot_values.get(h.product_id, 0)
+                lines.append(_batch_line(product_snapshot(hot_products[h.product_id], stock), h.qty, stock))
+    for hold in holds:
+        db.delete(hold)
+    db.add(ReservationConfirmation(reservation_id=reservation_id))
+    db.commit()
+
+    write_through_products(list(snapshots.values()))
+    return StockBatchResult(items=lines)
+
+@router.delete("/stock/reservations/{reservation_id}")
+def release_reservation(reservation_id: str, db: Session = Depends(get_db)):
+    """釋放預留（取消訂單）"""
+    holds = (
+        db.query(StockHold)
+        .filter(StockHold.reservation_id == reservation_id)
+        .with_for_update()
+        .all()
+    )
+    if not holds:
+        raise HTTPException(status_code=404, detail="Reservation not found or expired")
+    restore = {h.product_id: h.qty for h in holds if h.deducted}
+    for hold in holds:
+        db.delete(hold)
+    snapshots, hot_restored = restore_deducted(db, restore)
+    commit_restored(db, hot_restored)
+    write_through_products(snapshots)
+    return {"message": f"Reservation {reservation_id} released", "items": len(holds)}
+
+@router.get("/stock/{product_id}/availability", response_model=StockAvailability)
+def get_stock_availability(product_id: int, db: Session = Depends(get_db)):
+    """現有庫存、有效預留與可用庫存"""
+    snapshot = get_product_snapshot(db, product_id)
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Product not found")
+    held = held_quantities(db, [product_id]).get(product_id, 0)
+    return StockAvailability(
+        product_id=product_id,
+        on_hand=snapshot["stock"],
+        held=held,
+        available=snapshot["stock"] - held
+    )
+
+@router.get("/stock/summary", response_model=StockSummary)
+def get_stock_summary(db: Session = Depends(get_db)):
+    """庫存摘要（產品數、總庫存、缺貨與低庫存數及最接近缺貨的產品），供儀表板使用
+
+    結果快取在目錄版本下，庫存或產品異動時失效；熱門商品以 write-behind 寫回後的庫存計算。
+    """
+    cache_key, cached = get_page_cache("stock-summary", {"limit": STOCK_SUMMARY_ITEMS})
+    if cached is not None:
+        return StockSummary(**cached)
+
+    total_products, total_units, out_of_stock, low_stock = db.query(
+        func.count(Product.id),
+        func.coalesce(func.sum(Inventory.stock), 0),
+        func.coalesce(func.sum(case((Inventory.stock == 0, 1), else_=0)), 0),
+        func.coalesce(func.sum(case(((Inventory.stock > 0) & (Inventory.stock <= Product.safety_stock), 1), else_=0)), 0),
+    ).join(Inventory, Product.id == Inventory.product_id).one()
+    rows = (
+        db.query(Product, Inventory.stock)
+        .join(Inventory, Product.id == Inventory.product_id)
+        .order_by(Inventory.stock - Product.safety_stock, Product.id)
+        .limit(STOCK_SUMMARY_ITEMS)
+        .all()
+    )
+    summary = StockSummary(
+        total_products=total_products,
+        total_units=int(total_units),
+        out_of_stock=int(out_of_stock),
+        low_stock=int(low_stock),
+        items=[
+            LowStockAlert(product_id=p.id, sku=p.sku, name=p.name, current_stock=stock, safety_stock=p.safety_stock)
+            for p, stock in rows
+        ]
+    )
+    set_page_cache(cache_key, summary.dict())
+    return summary
+
 @router.get("/stock/{product_id}", response_model=StockInfo)
 def get_stock(product_id: int, db: Session = Depends(get_db)):
     """取得產品庫存資訊"""
-    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).first()
-    if not inventory:
+    snapshot = get_product_snapshot(db, product_id)
+    if not snapshot:
         raise HTTPException(status_code=404, detail="Product not found")
     
-    product = db.query(Product).filter(Product.id == product_id).first()
-    is_low_stock = inventory.stock <= product.safety_stock
-    
     return StockInfo(
-        product_id=product.id,
-        sku=product.sku,
-        name=product.name,
-        current_stock=inventory.stock,
-        safety_stock=product.safety_stock,
-        is_low_stock=is_low_stock
+        product_id=snapshot["id"],
+        sku=snapshot["sku"],
+        name=snapshot["name"],
+        current_stock=snapshot["stock"],
+        safety_stock=snapshot["safety_stock"],
+        is_low_stock=snapshot["stock"] <= snapshot["safety_stock"]
     )
 
-@router.get("/stock", response_model=list[StockInfo])
-def list_all_stock(db: Session = Depends(get_db)):
-    """取得所有產品庫存資訊"""
-    rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).all()
+@router.get("/stock", response_model=Union[list[StockInfo], StockPageOut])
+def list_all_stock(
+    sku_prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    low_stock_only: bool = False,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """取得所有產品庫存資訊（支援篩選、排序與游標分頁）
+
+    帶 cursor 或 limit 時回傳 {items, next_cursor} 分頁結果（第一頁不需帶 cursor），否則回傳完整陣列。
+    """
+    params = {"sku_prefix": sku_prefix, "q": q, "low_stock_only": low_stock_only,
+              "sort": sort, "order": order, "cursor": cursor, "limit": limit}
+    paged = cursor is not None or limit is not None
+    cache_key, cached = get_page_cache("stock", params)
+    if cached is not None:
+        return StockPageOut(**cached) if paged else [StockInfo(**obj) for obj in cached]
+
+    query = build_catalog_query(db, sku_prefix=sku_prefix, q=q, low_stock_only=low_stock_only)
+    rows, next_cursor = paginate(query, sort=sort, order=order, cursor=cursor, limit=limit)
     
     result = []
     for p, inv in rows:
@@ -139,14 +838,36 @@ def list_all_stock(db: Session = Depends(get_db)):
             is_low_stock=is_low_stock
         ))
     
+    if paged:
+        page = StockPageOut(items=result, next_cursor=next_cursor)
+        set_page_cache(cache_key, page.dict())
+        return page
+    set_page_cache(cache_key, [x.dict() for x in result])
     return result
 
-@router.get("/low-stock", response_model=list[LowStockAlert])
-def get_low_stock_products(db: Session = Depends(get_db)):
-    """取得低庫存產品清單"""
-    rows = db.query(Product, Inventory).join(Inventory, Product.id == Inventory.product_id).filter(
-        Inventory.stock <= Product.safety_stock
-    ).all()
+@router.get("/low-stock", response_model=Union[list[LowStockAlert], LowStockPageOut])
+def get_low_stock_products(
+    sku_prefix: Optional[str] = None,
+    q: Optional[str] = None,
+    sort: str = "id",
+    order: str = "asc",
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """取得低庫存產品清單（支援篩選、排序與游標分頁）
+
+    帶 cursor 或 limit 時回傳 {items, next_cursor} 分頁結果（第一頁不需帶 cursor），否則回傳完整陣列。
+    """
+    params = {"sku_prefix": sku_prefix, "q": q, "sort": sort, "order": order,
+              "cursor": cursor, "limit": limit}
+    paged = cursor is not None or limit is not None
+    cache_key, cached = get_page_cache("low-stock", params)
+    if cached is not None:
+        return LowStockPageOut(**cached) if paged else [LowStockAlert(**obj) for obj in cached]
+
+    query = build_catalog_query(db, sku_prefix=sku_prefix, q=q, low_stock_only=True)
+    rows, next_cursor = paginate(query, sort=sort, order=order, cursor=cursor, limit=limit)
     
     alerts = []
     for p, inv in rows:
@@ -158,6 +879,11 @@ def get_low_stock_products(db: Session = Depends(get_db)):
             safety_stock=p.safety_stock
         ))
     
+    if paged:
+        page = LowStockPageOut(items=alerts, next_cursor=next_cursor)
+        set_page_cache(cache_key, page.dict())
+        return page
+    set_page_cache(cache_key, [x.dict() for x in alerts])
     return alerts
 
 @router.post("/stock/{product_id}/set")
@@ -165,36 +891,66 @@ def set_stock(product_id: int, stock: int, db: Session = Depends(get_db)):
     """直接設定產品庫存數量"""
     if stock < 0:
         raise HTTPException(status_code=400, detail="Stock cannot be negative")
+    if _hot_ids([product_id]):
+        raise HTTPException(status_code=409, detail="Product is in hot stock mode; disable it before setting stock")
     
-    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).first()
+    inventory = db.query(Inventory).filter(Inventory.product_id == product_id).with_for_update().first()
     if not inventory:
         raise HTTPException(status_code=404, detail="Product not found")
+    # 取得列鎖後再確認一次，避免覆寫剛切換為熱門商品的庫存
+    if _hot_ids([product_id]):
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Product is in hot stock mode; disable it before setting stock")
     
+    held = held_quantities(db, [product_id]).get(product_id, 0)
+    if stock < held:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=_below_held_detail(held))
+    
+    old_stock = inventory.stock
     inventory.stock = stock
-    db.commit()
+    inventory.version += 1
     
-    # 檢查是否低庫存
+    # 庫存變更通知（含低庫存警告）與異動同一交易寫入 outbox
     product = db.query(Product).filter(Product.id == product_id).first()
-    if stock <= product.safety_stock:
-        try:
-            r = get_redis()
-            alert = LowStockAlert(
-                product_id=product.id,
-                sku=product.sku,
-                name=product.name,
-                current_stock=stock,
-                safety_stock=product.safety_stock
-            )
-            r.publish("low_stock_alerts", json.dumps(alert.dict()))
-        except Exception:
-            pass
-    
-    # 失效快取
-    try:
-        r = get_redis()
-        r.delete("products:list:v1")
-        r.delete(f"product:{product_id}:v1")
-    except Exception:
-        pass
+    snapshot = product_snapshot(product, stock, inventory.version)
+    enqueue_stock_events(db, [stock_event(snapshot, old_stock, stock - old_stock)])
+    db.commit()
     
-    return {"message": f"Stock set to {stock} successfully"}
\ No newline at end of file
+    # 寫入單一產品快取並失效清單快取
+    write_through_products([snapshot])
+    
+    return {"message": f"Stock set to {stock} successfully"}
+
+@router.get("/hot-stock")
+def list_hot_stock():
+    """列出熱門商品的計數器、待寫回差異與最近一次對帳偏差"""
+    return hot_stock.status()
+
+@router.post("/hot-stock/reconcile")
+def reconcile_hot_stock():
+    """立即寫回並對帳，回傳 {product_id: 偏差}"""
+    return {"drift": hot_stock.reconcile()}
+
+@router.post("/hot-stock/{product_id}")
+def enable_hot_stock(product_id: int):
+    """將產品切換為熱門商品模式（庫存改由 Redis 計數器處理）"""
+    try:
+        stock = hot_stock.enable(product_id)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if stock is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return {"product_id": product_id, "hot": True, "stock": stock}
+
+@router.delete("/hot-stock/{product_id}")
+def disable_hot_stock(product_id: int):
+    """關閉熱門商品模式，剩餘差異寫回 MySQL"""
+    try:
+        was_hot = hot_stock.disable(product_id)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not was_hot:
+        raise HTTPException(status_code=404, detail="Product is not in hot stock mode")
+    refresh_product_cache([product_id])
+    return {"product_id": product_id, "hot": False}
@@ -0,0 +1,447 @@
+import os
+import asyncio
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import update, bindparam, case, delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from ..cache import get_redis, acquire_lock, renew_lock, release_lock
+from ..db import SessionLocal, engine
+from ..models import Inventory, StockHold, HotStockFlush
+
+HOT_SET_KEY = "stock:hot"
+HOT_PENDING_KEY = "stock:hot:pending"
+# 寫回中的差異批次：寫回 MySQL 提交後才刪除，寫回失敗或程序中斷時由下一次寫回重試
+HOT_INFLIGHT_KEY = "stock:hot:inflight"
+HOT_BATCH_FIELD = "__batch"
+HOT_FLUSH_LOCK_KEY = "stock:hot:flush:lock"
+HOT_FLUSH_LOCK_TTL_MS = 10000
+# 已寫回批次紀錄的保留時間，只需涵蓋寫回重試的時間範圍
+HOT_FLUSH_RECORD_TTL = timedelta(days=1)
+# 各熱門商品的事件序號，啟用時以庫存列版本起算，每次調整遞增，寫回時同步回庫存列版本
+HOT_SEQ_KEY = "stock:hot:seq"
+
+def hot_counter_key(product_id) -> str:
+    return f"stock:hot:{product_id}"
+
+# 單一產品：檢查並調整計數器，同時累加待寫回的差異並遞增事件序號
+# 回傳 {0, 0, 0} 非熱門商品；{-1, 目前庫存, 0} 庫存不足；{1, 新庫存, 序號} 成功
+_ADJUST_LUA = """
+local current = redis.call('GET', KEYS[1])
+if not current then
+    return {0, 0, 0}
+end
+local new = tonumber(current) + tonumber(ARGV[2])
+if new < 0 then
+    return {-1, tonumber(current), 0}
+end
+redis.call('SET', KEYS[1], new)
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+return {1, new, redis.call('HINCRBY', KEYS[3], ARGV[1], 1)}
+"""
+
+# 多個產品：全部檢查通過才一起套用（全部成功或全部失敗）
+# KEYS[1] 為待寫回 hash，KEYS[2] 為序號 hash，KEYS[3..] 為計數器；ARGV 為 product_id, 調整量 交錯排列
+# 回傳 {1, 新庫存, 序號, ...} 成功；{-1, 失敗位置, 目前庫存} 庫存不足；{0, 失敗位置} 非熱門商品
+_ADJUST_MANY_LUA = """
+local values = {}
+for i = 3, #KEYS do
+    local current = redis.call('GET', KEYS[i])
+    if not current then
+        return {0, i - 2}
+    end
+    local new = tonumber(current) + tonumber(ARGV[(i - 2) * 2])
+    if new < 0 then
+        return {-1, i - 2, tonumber(current)}
+    end
+    values[i - 2] = new
+end
+local result = {1}
+for i = 3, #KEYS do
+    local pid = ARGV[(i - 2) * 2 - 1]
+    redis.call('SET', KEYS[i], values[i - 2])
+    redis.call('HINCRBY', KEYS[1], pid, ARGV[(i - 2) * 2])
+    table.insert(result, values[i - 2])
+    table.insert(result, redis.call('HINCRBY', KEYS[2], pid, 1))
+end
+return result
+"""
+
+# 多個產品各自套用（best effort）：可套用的項目照常調整，其餘略過
+# KEYS 與 ARGV 同 _ADJUST_MANY_LUA；每個產品回傳 {狀態, 庫存, 序號}，狀態同 _ADJUST_LUA
+_ADJUST_EACH_LUA = """
+local result = {}
+for i = 3, #KEYS do
+    local pid, adjustment = ARGV[(i - 2) * 2 - 1], tonumber(ARGV[(i - 2) * 2])
+    local current = redis.call('GET', KEYS[i])
+    if not current then
+        table.insert(result, {0, 0, 0})
+    elseif tonumber(current) + adjustment < 0 then
+        table.insert(result, {-1, tonumber(current), 0})
+    else
+        local new = tonumber(current) + adjustment
+        redis.call('SET', KEYS[i], new)
+        redis.call('HINCRBY', KEYS[1], pid, adjustment)
+        table.insert(result, {1, new, redis.call('HINCRBY', KEYS[2], pid, 1)})
+    end
+end
+return result
+"""
+
+# 啟用熱門模式：計數器不存在時以 MySQL 庫存建立，事件序號從庫存列版本起算；
+# 該產品仍有尚未寫回 MySQL 的差異時 MySQL 庫存不是最新的，回傳 false 拒絕啟用
+# KEYS[1] 為計數器，KEYS[2] 為序號 hash，KEYS[3] 為熱門集合，KEYS[4..5] 為待寫回與寫回中 hash；
+# ARGV 為 product_id, 庫存, 版本
+_ENABLE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0
+        and (redis.call('HEXISTS', KEYS[4], ARGV[1]) == 1 or redis.call('HEXISTS', KEYS[5], ARGV[1]) == 1) then
+    return false
+end
+if redis.call('SET', KEYS[1], ARGV[2], 'NX') then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+end
+redis.call('SADD', KEYS[3], ARGV[1])
+return redis.call('GET', KEYS[1])
+"""
+
+# 取得要寫回的批次：上一次寫回未完成時重試同一批次，否則把待寫回差異整個移到寫回中並標上批次 ID
+# KEYS[1] 為待寫回 hash，KEYS[2] 為寫回中 hash，KEYS[3] 為序號 hash；ARGV[1] 為新批次 ID
+# 回傳 {批次 ID, product_id, 差異, 目前事件序號, ...}，沒有差異時回傳空陣列
+_DRAIN_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('HSET', KEYS[2], '__batch', ARGV[1])
+end
+local inflight = redis.call('HGETALL', KEYS[2])
+local result = {''}
+for i = 1, #inflight, 2 do
+    if inflight[i] == '__batch' then
+        result[1] = inflight[i + 1]
+    else
+        table.insert(result, inflight[i])
+        table.insert(result, inflight[i + 1])
+        table.insert(result, tonumber(redis.call('HGET', KEYS[3], inflight[i]) or '0'))
+    end
+end
+return result
+"""
+
+# 寫回提交後刪除寫回中的批次（只刪除同一批次，不會刪到其他副本之後建立的批次）
+_ACK_LUA = """
+if redis.call('HGET', KEYS[1], '__batch') == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# 停用熱門模式：移除計數器，尚未寫回的差異留在待寫回 hash（至少一筆，讓寫回同步庫存列版本）
+# 回傳是否原本為熱門商品
+_DISABLE_LUA = """
+local was_hot = redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('DEL', KEYS[1])
+if was_hot == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 0)
+end
+return was_hot
+"""
+
+# 對帳用：同一時間點讀取計數器與尚未寫回的差異（待寫回加上寫回中）
+# KEYS[1] 為待寫回 hash，KEYS[2] 為寫回中 hash，KEYS[3..] 為計數器；ARGV 為對應的 product_id
+_SNAPSHOT_LUA = """
+local result = {}
+for i = 1, #ARGV do
+    local counter = redis.call('GET', KEYS[i + 2])
+    local delta = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '0')
+        + tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    result[i] = {counter or false, delta}
+end
+return result
+"""
+
+class HotStockService:
+    """熱門商品庫存服務
+
+    對標記為熱門的商品，庫存以 Redis 計數器為準，由 Lua 腳本原子性地檢查並扣減，
+    避免每筆調整都鎖定同一筆 MySQL 庫存列。差異先累積在待寫回 hash，由背景
+    write-behind 批次寫回 MySQL，並定期對帳偵測計數器與 MySQL 的偏差。
+
+    注意：Redis 需開啟持久化（AOF），否則 Redis 重啟會遺失尚未寫回的差異。
+    """
+
+    def __init__(self):
+        self.redis_client = get_redis()
+        self.flush_interval = float(os.getenv("HOT_STOCK_FLUSH_INTERVAL", "0.5"))
+        self.reconcile_interval = float(os.getenv("HOT_STOCK_RECONCILE_INTERVAL", "60"))
+        self.last_drift: Dict[int, int] = {}
+        self._scripts = {}
+        self.running = False
+
+    def _script(self, name: str, source: str):
+        if name not in self._scripts:
+            self._scripts[name] = self.redis_client.register_script(source)
+        return self._scripts[name]
+
+    def hot_ids(self, product_ids: List[int]) -> List[int]:
+        """回傳其中屬於熱門商品的 product_id"""
+        if not product_ids:
+            return []
+        flags = self.redis_client.smismember(HOT_SET_KEY, product_ids)
+        return [pid for pid, flag in zip(product_ids, flags) if flag]
+
+    def get_stock(self, product_id: int) -> Optional[int]:
+        """熱門商品的目前庫存，非熱門商品回傳 None"""
+        value = self.redis_client.get(hot_counter_key(product_id))
+        return int(value) if value is not None else None
+
+    def get_stocks(self, product_ids: List[int]) -> Dict[int, int]:
+        """批次取得熱門商品目前庫存，只回傳熱門商品"""
+        if not product_ids:
+            return {}
+        values = self.redis_client.mget([hot_counter_key(pid) for pid in product_ids])
+        return {pid: int(v) for pid, v in zip(product_ids, values) if v is not None}
+
+    def adjust(self, product_id: int, adjustment: int) -> Tuple[int, int, int]:
+        """調整單一熱門商品庫存，回傳 (狀態, 庫存, 事件序號)；狀態 0 表示非熱門商品"""
+        status, value, seq = self._script("adjust", _ADJUST_LUA)(
+            keys=[hot_counter_key(product_id), HOT_PENDING_KEY, HOT_SEQ_KEY],
+            args=[product_id, adjustment],
+        )
+        return int(status), int(value), int(seq)
+
+    def adjust_many(self, adjustments: Dict[int, int]) -> Tuple[int, Dict, Dict]:
+        """一次調整多個熱門商品（全部成功或全部失敗）
+
+        成功回傳 (1, {product_id: 新庫存}, {product_id: 事件序號})；
+        庫存不足回傳 (-1, {product_id: 目前庫存}, {})；有商品已非熱門回傳 (0, {product_id: None}, {})。
+        """
+        product_ids = list(adjustments)
+        args = []
+        for pid in product_ids:
+            args.extend([pid, adjustments[pid]])
+        result = self._script("adjust_many", _ADJUST_MANY_LUA)(
+            keys=[HOT_PENDING_KEY, HOT_SEQ_KEY] + [hot_counter_key(pid) for pid in product_ids],
+            args=args,
+        )
+        status = int(result[0])
+        if status == 1:
+            values = {pid: int(result[1 + i * 2]) for i, pid in enumerate(product_ids)}
+            seqs = {pid: int(result[2 + i * 2]) for i, pid in enumerate(product_ids)}
+            return 1, values, seqs
+        failed = product_ids[int(result[1]) - 1]
+        if status == -1:
+            return -1, {failed: int(result[2])}, {}
+        return 0, {failed: None}, {}
+
+    def adjust_each(self, adjustments: Dict[int, int]) -> Dict[int, Tuple[int, int, int]]:
+        """一次呼叫各自調整多個熱門商品，回傳 {product_id: (狀態, 庫存, 事件序號)}，狀態同 adjust"""
+        product_ids = list(adjustments)
+        if not product_ids:
+            return {}
+        args = []
+        for pid in product_ids:
+            args.extend([pid, adjustments[pid]])
+        result = self._script("adjust_each", _ADJUST_EACH_LUA)(
+            keys=[HOT_PENDING_KEY, HOT_SEQ_KEY] + [hot_counter_key(pid) for pid in product_ids],
+            args=args,
+        )
+        return {pid: (int(status), int(value), int(seq)) for pid, (status, value, seq) in zip(product_ids, result)}
+
+    def enable(self, product_id: int) -> Optional[int]:
+        """啟用熱門模式：以 MySQL 目前庫存建立計數器，回傳計數器值；產品不存在回傳 None
+
+        尚有未扣除庫存的一般預留時拒絕啟用：這些預留確認時會扣 MySQL，而切換後以計數器為準。
+        """
+        db = SessionLocal()
+        try:
+            row = db.query(Inventory.stock, Inventory.version).filter(
+                Inventory.product_id == product_id
+            ).with_for_update().first()
+            if row is None:
+                return None
+            cold_holds = db.query(StockHold.id).filter(
+                StockHold.product_id == product_id, StockHold.deducted.is_(False)
+            ).first()
+            if cold_holds:
+                db.rollback()
+                raise RuntimeError("Product has open reservations; confirm or release them before enabling hot stock mode")
+            # 持有庫存列鎖時建立計數器：進行中的一般寫入提交後才讀到庫存，
+            # 之後的一般寫入取得列鎖後會看到已是熱門商品而放棄
+            stock = self._script("enable", _ENABLE_LUA)(
+                keys=[hot_counter_key(product_id), HOT_SEQ_KEY, HOT_SET_KEY, HOT_PENDING_KEY, HOT_INFLIGHT_KEY],
+                args=[product_id, row.stock, row.version],
+            )
+            db.commit()
+            if stock is None:
+                raise RuntimeError("Hot stock deltas for this product are still being written back; try again")
+            return int(stock)
+        finally:
+            db.close()
+
+    def disable(self, product_id: int) -> bool:
+        """停用熱門模式：移除計數器並將剩餘差異寫回 MySQL，回傳是否原本為熱門商品"""
+        with self._flush_lock() as token:
+            if token is None:
+                raise RuntimeError("Hot stock flusher busy, try again")
+            was_hot = bool(self._script("disable", _DISABLE_LUA)(
+                keys=[hot_counter_key(product_id), HOT_PENDING_KEY, HOT_SET_KEY],
+                args=[product_id],
+            ))
+            # 剩餘差異經由一般的寫回流程寫入，同時把庫存列版本推進到最後的事件序號，
+            # 之後的一般寫入序號才會接續；寫回失敗時差異仍留在 Redis，由之後的寫回重試
+            self._flush_locked(token)
+            self.redis_client.hdel(HOT_SEQ_KEY, product_id)
+            self.last_drift.pop(product_id, None)
+            return was_hot
+
+    def _write_deltas(self, batch_id: str, deltas: Dict[int, int], seqs: Dict[int, int]) -> bool:
+        """以單一交易批次套用差異至 MySQL（executemany），版本推進到不小於事件序號
+
+        同一交易記錄批次 ID，已寫回的批次（上次提交後來不及刪除寫回中的批次、或兩個寫回重疊）
+        直接略過，回傳是否套用。
+        """
+        table = Inventory.__table__
+        now = datetime.utcnow()
+        try:
+            with engine.begin() as conn:
+                if conn.execute(select(HotStockFlush.batch_id).where(HotStockFlush.batch_id == batch_id)).first():
+                    return False
+                conn.execute(insert(HotStockFlush).values(batch_id=batch_id, flushed_at=now))
+                conn.execute(
+                    update(table)
+                    .where(table.c.product_id == bindparam("pid"))
+                    .values(stock=table.c.stock + bindparam("delta"),
+                            version=case((bindparam("seq") > table.c.version, bindparam("seq")),
+                                         else_=table.c.version + 1)),
+                    [{"pid": pid, "delta": delta, "seq": seqs.get(pid, 0)} for pid, delta in deltas.items()],
+                )
+                conn.execute(delete(HotStockFlush).where(HotStockFlush.flushed_at < now - HOT_FLUSH_RECORD_TTL))
+            return True
+        except IntegrityError:
+            # 另一個寫回同時提交了同一批次
+            return False
+
+    @contextmanager
+    def _flush_lock(self):
+        """跨副本的寫回鎖，yield 鎖的 token（未取得時為 None）；鎖只能由持有者延長與釋放"""
+        token = acquire_lock(HOT_FLUSH_LOCK_KEY, HOT_FLUSH_LOCK_TTL_MS)
+        try:
+            yield token
+        finally:
+            if token is not None:
+                release_lock(HOT_FLUSH_LOCK_KEY, token)
+
+    def flush(self) -> int:
+        """將累積的差異寫回 MySQL，回傳寫回的產品數；多個副本間只有一個會執行"""
+        with self._flush_lock() as token:
+            if token is None:
+                return 0
+            return self._flush_locked(token)
+
+    def _flush_locked(self, token: str) -> int:
+        """先重試上次未完成的批次，再寫回新的差異；每個批次寫回前延長鎖，失去鎖時停止
+
+        即使鎖過期而與其他副本重疊，同一批次也只會套用一次。
+        """
+        flushed = set()
+        for _ in range(2):
+            raw = self._script("drain", _DRAIN_LUA)(
+                keys=[HOT_PENDING_KEY, HOT_INFLIGHT_KEY, HOT_SEQ_KEY], args=[uuid.uuid4().hex]
+            )
+            if not raw:
+                break
+            batch_id = raw[0]
+            deltas = {int(raw[i]): int(raw[i + 1]) for i in range(1, len(raw), 3)}
+            seqs = {int(raw[i]): int(raw[i + 2]) for i in range(1, len(raw), 3)}
+            if not renew_lock(HOT_FLUSH_LOCK_KEY, token, HOT_FLUSH_LOCK_TTL_MS):
+                raise RuntimeError("Hot stock flush lock lost")
+            self._write_deltas(batch_id, deltas, seqs)
+            # MySQL 已提交（或先前已提交）後才刪除寫回中的差異
+            self._script("ack", _ACK_LUA)(keys=[HOT_INFLIGHT_KEY], args=[batch_id])
+            flushed.update(deltas)
+        if not flushed:
+            return 0
+        # 更新快取中的庫存（清單與單一產品）
+        from ..catalog import refresh_product_cache
+        refresh_product_cache(sorted(flushed))
+        return len(flushed)
+
+    def reconcile(self) -> Dict[int, int]:
+        """對帳：回傳 {product_id: 偏差}，偏差 = MySQL 庫存 - (計數器 - 尚未寫回的差異)"""
+        with self._flush_lock() as token:
+            if token is None:
+                return dict(self.last_drift)
+            # 先寫回，再於同一鎖內比較，避免與寫回中的差異混淆
+            self._flush_locked(token)
+            product_ids = sorted(int(pid) for pid in self.redis_client.smembers(HOT_SET_KEY))
+            if not product_ids:
+                self.last_drift = {}
+                return {}
+            snapshot = self._snapshot(product_ids)
+            db = SessionLocal()
+            try:
+                stocks = dict(
+                    db.query(Inventory.product_id, Inventory.stock)
+                    .filter(Inventory.product_id.in_(product_ids))
+                    .all()
+                )
+            finally:
+                db.close()
+            drift = {}
+            for pid, (counter, pending) in zip(product_ids, snapshot):
+                if counter is None or pid not in stocks:
+                    continue
+                diff = stocks[pid] - (int(counter) - int(pending))
+                if diff:
+                    drift[pid] = diff
+            if drift:
+                print(f"Hot stock drift detected: {drift}")
+            self.last_drift = drift
+            return drift
+
+    def _snapshot(self, product_ids: List[int]) -> list:
+        return self._script("snapshot", _SNAPSHOT_LUA)(
+            keys=[HOT_PENDING_KEY, HOT_INFLIGHT_KEY] + [hot_counter_key(pid) for pid in product_ids],
+            args=product_ids,
+        )
+
+    def status(self) -> List[Dict]:
+        """列出熱門商品的計數器、待寫回差異與最近一次對帳偏差"""
+        product_ids = sorted(int(pid) for pid in self.redis_client.smembers(HOT_SET_KEY))
+        if not product_ids:
+            return []
+        snapshot = self._snapshot(product_ids)
+        return [
+            {
+                "product_id": pid,
+                "stock": int(counter) if counter is not None else None,
+                "pending_delta": int(pending),
+                "drift": self.last_drift.get(pid, 0),
+            }
+            for pid, (counter, pending) in zip(product_ids, snapshot)
+        ]
+
+    async def run_write_behind(self):
+        """背景 write-behind 迴圈：定期寫回差異並對帳"""
+        self.running = True
+        last_reconcile = time.monotonic()
+        while self.running:
+            try:
+                await asyncio.to_thread(self.flush)
+                if time.monotonic() - last_reconcile >= self.reconcile_interval:
+                    await asyncio.to_thread(self.reconcile)
+                    last_reconcile = time.monotonic()
+            except Exception as e:
+                print(f"Hot stock write-behind error: {e}")
+            await asyncio.sleep(self.flush_interval)
+
+    def stop(self):
+        """停止背景迴圈"""
+        self.running = False
+
+# 全域實例
+hot_stock = HotStockService()
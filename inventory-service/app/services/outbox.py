@@ -0,0 +1,146 @@
+import os
+import json
+import asyncio
+from datetime import datetime
+from typing import Dict, List
+from sqlalchemy import delete, func
+from sqlalchemy.orm import Session
+from ..cache import acquire_lock, renew_lock, release_lock
+from ..db import SessionLocal
+from ..models import StockEventOutbox
+from .redis_pubsub import redis_pubsub
+
+OUTBOX_RELAY_LOCK_KEY = "outbox:stock_events:relay:lock"
+
+def stock_event(snapshot: Dict, old_stock: int, adjustment: int) -> Dict:
+    """建立一筆庫存事件（snapshot 為調整後的產品快照）
+
+    snapshot 的 version 作為該產品的事件序號：一般商品為持有列鎖時遞增的庫存列版本，
+    熱門商品為計數器調整時在 Redis 遞增的序號（寫回時同步到庫存列版本）。
+    """
+    new_stock = snapshot["stock"]
+    is_low_stock = new_stock <= snapshot["safety_stock"]
+    alert = {
+        "product_id": snapshot["id"],
+        "sku": snapshot["sku"],
+        "name": snapshot["name"],
+        "current_stock": new_stock,
+        "safety_stock": snapshot["safety_stock"],
+    }
+    change_data = {
+        "product_id": snapshot["id"],
+        "sku": snapshot["sku"],
+        "name": snapshot["name"],
+        "old_stock": old_stock,
+        "new_stock": new_stock,
+        "adjustment": adjustment,
+        "is_low_stock": is_low_stock,
+        "seq": snapshot["version"],
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    return {"product_id": snapshot["id"], "seq": snapshot["version"], "is_low_stock": is_low_stock,
+            "change": change_data, "alert": alert}
+
+def enqueue_stock_events(db: Session, events: List[Dict]):
+    """將庫存事件寫入 outbox（與庫存異動同一交易，由呼叫端提交）"""
+    db.add_all([
+        StockEventOutbox(product_id=event["product_id"], payload=json.dumps(event))
+        for event in events
+    ])
+
+class OutboxRelay:
+    """庫存事件 outbox relay
+
+    依 id 順序批次讀取 outbox、以單一呼叫送到 Redis，成功後才刪除，
+    因此至少送達一次；失敗時保留資料列並以指數退避重試。
+    id 在寫入時配發而非提交時，熱門商品的事件也不經庫存列鎖，id 順序不一定是發生順序：
+    每批依各產品的事件序號排序，發送時略過序號不大於已送出者的低庫存狀態轉換。
+    多副本間以帶 token 的 Redis 鎖確保只有一個 relay 在送。
+    """
+
+    def __init__(self):
+        self.batch_size = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", "500"))
+        self.interval = float(os.getenv("OUTBOX_RELAY_INTERVAL", "0.2"))
+        self.max_backoff = float(os.getenv("OUTBOX_RELAY_MAX_BACKOFF", "30"))
+        self.lock_ttl_ms = 10000
+        self.relayed = 0
+        self.failures = 0
+        self.last_error = None
+        self.running = False
+
+    def relay_once(self) -> int:
+        """送出 outbox 中的事件直到清空，回傳送出的筆數；未取得 relay 鎖時回傳 0"""
+        token = acquire_lock(OUTBOX_RELAY_LOCK_KEY, self.lock_ttl_ms)
+        if token is None:
+            return 0
+        relayed = 0
+        try:
+            while True:
+                sent = self._relay_batch()
+                relayed += sent
+                # 每批延長鎖，避免長時間清空積壓時被其他副本接手；鎖已失去時停止
+                if sent < self.batch_size or not renew_lock(OUTBOX_RELAY_LOCK_KEY, token, self.lock_ttl_ms):
+                    return relayed
+        finally:
+            release_lock(OUTBOX_RELAY_LOCK_KEY, token)
+
+    def _relay_batch(self) -> int:
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(StockEventOutbox.id, StockEventOutbox.payload)
+                .order_by(StockEventOutbox.id)
+                .limit(self.batch_size)
+                .all()
+            )
+            if not rows:
+                return 0
+            events = [json.loads(payload) for _, payload in rows]
+            # 同一產品依事件序號送出（導入序號前的事件沒有 seq，維持 id 順序）
+            events.sort(key=lambda event: (event["product_id"], event.get("seq") or 0))
+            redis_pubsub.publish_stock_events(events)
+            db.execute(delete(StockEventOutbox).where(StockEventOutbox.id.in_([row_id for row_id, _ in rows])))
+            db.commit()
+            self.relayed += len(rows)
+            return len(rows)
+        finally:
+            db.close()
+
+    def stats(self) -> Dict:
+        """outbox 積壓筆數、最舊事件的等待秒數與 relay 計數"""
+        db = SessionLocal()
+        try:
+            pending, oldest = db.query(func.count(StockEventOutbox.id), func.min(StockEventOutbox.created_at)).one()
+        finally:
+            db.close()
+        return {
+            "pending": pending,
+            "oldest_age_seconds": (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+            "relayed": self.relayed,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+    async def run(self):
+        """背景 relay 迴圈"""
+        self.running = True
+        backoff = self.interval
+        while self.running:
+            try:
+                await asyncio.to_thread(self.relay_once)
+                backoff = self.interval
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Outbox relay error: {e}; retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(self.max_backoff, backoff * 2)
+                continue
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        """停止背景迴圈"""
+        self.running = False
+
+# 全域實例
+outbox_relay = OutboxRelay()
@@ -1,31 +1,95 @@
+import os
 import redis
 import json
+import random
 import asyncio
-from typing import Callable, Dict, Any
-from ..cache import get_redis
+from typing import Callable, Dict, Any, List
+from ..cache import get_redis, get_async_redis
+
+# 庫存事件改用 Redis Stream：消費者群組確認處理後才移除，離線期間的事件不會遺失
+STOCK_EVENTS_STREAM = "stream:stock_events"
+# 以近似裁剪限制 Stream 長度，避免無人消費時無限成長
+STOCK_EVENTS_MAXLEN = int(os.getenv("STOCK_EVENTS_MAXLEN", "100000"))
+# 目前低於安全庫存的產品；警告只在進入此集合時發出，回升時移除並發出解除事件
+LOW_STOCK_SET_KEY = "stock:low"
+# 各產品已送出的最大事件序號；序號較小的事件晚到時不改變低庫存狀態
+STOCK_EVENTS_SEQ_KEY = "stock:events:seq"
+
+# KEYS[1] 為事件 Stream，KEYS[2] 為低庫存集合，KEYS[3] 為已送出序號 hash；ARGV[1] 為 Stream 長度上限，
+# 之後每五個為一筆：product_id, 事件序號（可為空）, 是否低庫存, 變更 JSON, 警告 JSON；回傳發出的警告數
+_STOCK_EVENTS_LUA = """
+local alerts = 0
+for i = 2, #ARGV, 5 do
+    local product_id, seq, low, change, alert = ARGV[i], tonumber(ARGV[i + 1]), ARGV[i + 2], ARGV[i + 3], ARGV[i + 4]
+    redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'type', 'stock_change', 'data', change)
+    local stale = false
+    if seq then
+        if seq <= tonumber(redis.call('HGET', KEYS[3], product_id) or '-1') then
+            stale = true
+        else
+            redis.call('HSET', KEYS[3], product_id, seq)
+        end
+    end
+    if stale then
+        -- 較新的事件已決定目前的低庫存狀態
+    elseif low == '1' then
+        if redis.call('SADD', KEYS[2], product_id) == 1 then
+            redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'type', 'low_stock_alert', 'data', alert)
+            alerts = alerts + 1
+        end
+    elseif redis.call('SREM', KEYS[2], product_id) == 1 then
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'type', 'low_stock_cleared', 'data', alert)
+    end
+end
+return alerts
+"""
+
+# 訂閱者：每個頻道的處理 worker 數、佇列上限與重連退避
+SUBSCRIBER_WORKERS = int(os.getenv("REDIS_SUBSCRIBER_WORKERS", "4"))
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("REDIS_SUBSCRIBER_QUEUE_SIZE", "1000"))
+SUBSCRIBER_BACKOFF_BASE = 0.5
+SUBSCRIBER_BACKOFF_MAX = 30.0
 
 class RedisPubSubService:
-    """Redis Pub/Sub 服務"""
+    """Redis Pub/Sub 服務（庫存事件寫入 Stream）"""
     
     def __init__(self):
         self.redis_client = get_redis()
         self.subscribers = {}
+        self.attempts: Dict[str, int] = {}
+        self._stock_events_script = None
     
-    def publish_low_stock_alert(self, alert_data: Dict[str, Any]):
-        """發布低庫存警告"""
-        try:
-            self.redis_client.publish("low_stock_alerts", json.dumps(alert_data))
-            print(f"Published low stock alert: {alert_data}")
-        except Exception as e:
-            print(f"Failed to publish low stock alert: {e}")
+    def publish_stock_event(self, event_type: str, data: Dict[str, Any]):
+        """寫入庫存事件 Stream"""
+        self.redis_client.xadd(
+            STOCK_EVENTS_STREAM,
+            {"type": event_type, "data": json.dumps(data)},
+            maxlen=STOCK_EVENTS_MAXLEN,
+            approximate=True,
+        )
     
-    def publish_stock_change(self, change_data: Dict[str, Any]):
-        """發布庫存變更通知"""
-        try:
-            self.redis_client.publish("stock_changes", json.dumps(change_data))
-            print(f"Published stock change: {change_data}")
-        except Exception as e:
-            print(f"Failed to publish stock change: {e}")
+    def publish_stock_events(self, events: List[Dict[str, Any]]) -> int:
+        """以單一 Lua 呼叫寫入一批庫存變更，低庫存警告只在跨越門檻時發出
+
+        events 的每一項為 {"product_id", "seq", "is_low_stock", "change", "alert"}，
+        回傳發出的低庫存警告數。晚到的舊事件（seq 不大於已送出者）只寫入變更，不觸發警告。
+        """
+        if not events:
+            return 0
+        if self._stock_events_script is None:
+            self._stock_events_script = self.redis_client.register_script(_STOCK_EVENTS_LUA)
+        args = [STOCK_EVENTS_MAXLEN]
+        for event in events:
+            args.extend([
+                event["product_id"],
+                event.get("seq", ""),
+                "1" if event["is_low_stock"] else "0",
+                json.dumps(event["change"]),
+                json.dumps(event["alert"]),
+            ])
+        alerts = self._stock_events_script(keys=[STOCK_EVENTS_STREAM, LOW_STOCK_SET_KEY, STOCK_EVENTS_SEQ_KEY], args=args)
+        print(f"Published {len(events)} stock change(s), {alerts} low stock alert(s)")
+        return int(alerts)
     
     def publish_inventory_update(self, update_data: Dict[str, Any]):
         """發布庫存更新通知"""
@@ -35,24 +99,74 @@ class RedisPubSubService:
         except Exception as e:
             print(f"Failed to publish inventory update: {e}")
     
-    async def subscribe_to_channel(self, channel: str, callback: Callable):
-        """訂閱頻道"""
+    def publish_product_update(self, update_data: Dict[str, Any]):
+        """發布產品資料變更通知（供其他服務失效產品快取）"""
         try:
-            pubsub = self.redis_client.pubsub()
-            pubsub.subscribe(channel)
-            
-            print(f"Subscribed to channel: {channel}")
-            
-            for message in pubsub.listen():
-                if message['type'] == 'message':
-                    try:
-                        data = json.loads(message['data'])
-                        await callback(data)
-                    except Exception as e:
-                        print(f"Error processing message: {e}")
-                        
+            self.redis_client.publish("product_updates", json.dumps(update_data))
+            print(f"Published product update: {update_data}")
         except Exception as e:
-            print(f"Failed to subscribe to {channel}: {e}")
+            print(f"Failed to publish product update: {e}")
+    
+    def publish_product_updates(self, product_ids: List[int], action: str):
+        """以單一 pipeline 為多個產品發布 product_updates（訊息格式與單筆相同）"""
+        if not product_ids:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for product_id in product_ids:
+                pipe.publish("product_updates", json.dumps({"product_id": product_id, "action": action}))
+            pipe.execute()
+            print(f"Published {len(product_ids)} product update(s): {action}")
+        except Exception as e:
+            print(f"Failed to publish product updates: {e}")
+    
+    async def _listen(self, channel: str, queue: asyncio.Queue) -> None:
+        pubsub = get_async_redis().pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            print(f"Subscribed to channel: {channel}")
+            self.attempts[channel] = 0
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message['type'] != 'message':
+                    continue
+                try:
+                    await queue.put(json.loads(message['data']))
+                except ValueError as e:
+                    print(f"Invalid message on {channel}: {e}")
+        finally:
+            await pubsub.reset()
+    
+    async def subscribe_to_channel(self, channel: str, callback: Callable):
+        """訂閱頻道（非阻塞；斷線時指數退避重連，訊息交由有界 worker 池處理）"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        
+        async def worker():
+            while True:
+                data = await queue.get()
+                try:
+                    await callback(data)
+                except Exception as e:
+                    print(f"Error processing message: {e}")
+                finally:
+                    queue.task_done()
+        
+        workers = [asyncio.create_task(worker()) for _ in range(SUBSCRIBER_WORKERS)]
+        self.attempts[channel] = 0
+        try:
+            while True:
+                try:
+                    await self._listen(channel, queue)
+                except Exception as e:
+                    delay = min(SUBSCRIBER_BACKOFF_MAX, SUBSCRIBER_BACKOFF_BASE * 2 ** self.attempts[channel])
+                    delay *= random.uniform(0.5, 1.0)
+                    self.attempts[channel] += 1
+                    print(f"Subscription to {channel} failed: {e}; retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
     
     def register_subscriber(self, channel: str, callback: Callable):
         """註冊訂閱者"""
@@ -0,0 +1,142 @@
+import os
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, func, select
+from sqlalchemy.orm import Session
+from ..db import SessionLocal
+from ..models import Product, Inventory, StockHold
+from ..cache import write_through_products
+from ..catalog import product_snapshot
+from .hot_stock import hot_stock
+from .outbox import enqueue_stock_events, stock_event
+
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+MAX_RESERVATION_TTL_SECONDS = int(os.getenv("MAX_RESERVATION_TTL_SECONDS", "86400"))
+
+def held_quantities(db: Session, product_ids: List[int], exclude_reservation: Optional[str] = None) -> Dict[int, int]:
+    """未過期且尚未從庫存扣除的預留數量，回傳 {product_id: 數量}"""
+    if not product_ids:
+        return {}
+    query = (
+        db.query(StockHold.product_id, func.sum(StockHold.qty))
+        .filter(
+            StockHold.product_id.in_(product_ids),
+            StockHold.deducted.is_(False),
+            StockHold.expires_at > datetime.utcnow(),
+        )
+    )
+    if exclude_reservation is not None:
+        query = query.filter(StockHold.reservation_id != exclude_reservation)
+    return {pid: int(qty) for pid, qty in query.group_by(StockHold.product_id).all()}
+
+def held_total_subquery(product_id: int):
+    """單一產品有效預留總數的純量子查詢，供條件式 UPDATE 在同一個陳述式內比較"""
+    return (
+        select(func.coalesce(func.sum(StockHold.qty), 0))
+        .where(
+            StockHold.product_id == product_id,
+            StockHold.deducted.is_(False),
+            StockHold.expires_at > datetime.utcnow(),
+        )
+        .scalar_subquery()
+    )
+
+def restore_deducted(db: Session, quantities: Dict[int, int]) -> Tuple[List[dict], Dict[int, int]]:
+    """把熱門商品預留時已扣除的數量加回，事件寫入 outbox
+
+    若商品已不是熱門商品（計數器已移除），改加回 MySQL 庫存列。回傳 (需寫入快取的快照,
+    已加回計數器的數量)；呼叫端以 commit_restored 提交，提交失敗時會把計數器調整回去。
+    """
+    if not quantities:
+        return [], {}
+    products = {p.id: p for p in db.query(Product).filter(Product.id.in_(list(quantities))).all()}
+    events, cold_snapshots, hot_restored = [], [], {}
+    for pid in sorted(quantities):
+        if pid not in products:
+            continue
+        qty = quantities[pid]
+        status, value, seq = hot_stock.adjust(pid, qty)
+        if status == 0:
+            inventory = db.query(Inventory).filter(Inventory.product_id == pid).with_for_update().first()
+            if inventory is None:
+                continue
+            inventory.stock += qty
+            inventory.version += 1
+            value, seq = inventory.stock, inventory.version
+            cold_snapshots.append(product_snapshot(products[pid], value, seq))
+        else:
+            hot_restored[pid] = qty
+        events.append(stock_event(product_snapshot(products[pid], value, seq), value - qty, qty))
+    enqueue_stock_events(db, events)
+    return cold_snapshots, hot_restored
+
+def commit_restored(db: Session, hot_restored: Dict[int, int]):
+    """提交交易；失敗時把已加回的熱門商品計數器扣回，避免重試或下次清理重複加回"""
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        if hot_restored:
+            hot_stock.adjust_many({pid: -qty for pid, qty in hot_restored.items()})
+        raise
+
+class HoldSweeper:
+    """定期分批刪除過期的預留
+
+    一般商品的可用庫存本來就排除過期預留，刪除只是清理；
+    熱門商品的預留已扣除計數器，過期時需加回。
+    多副本以 SKIP LOCKED 分攤，不會重複處理同一筆預留。
+    """
+
+    def __init__(self):
+        self.interval = float(os.getenv("RESERVATION_SWEEP_INTERVAL", "5"))
+        self.batch_size = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "1000"))
+        self.swept = 0
+        self.running = False
+
+    def sweep_once(self) -> int:
+        """處理一批過期預留，回傳刪除筆數"""
+        db = SessionLocal()
+        try:
+            holds = (
+                db.query(StockHold.id, StockHold.product_id, StockHold.qty, StockHold.deducted)
+                .filter(StockHold.expires_at <= datetime.utcnow())
+                .order_by(StockHold.expires_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            if not holds:
+                return 0
+            restore: Dict[int, int] = {}
+            for _, pid, qty, deducted in holds:
+                if deducted:
+                    restore[pid] = restore.get(pid, 0) + qty
+            db.execute(delete(StockHold).where(StockHold.id.in_([h.id for h in holds])))
+            snapshots, hot_restored = restore_deducted(db, restore)
+            commit_restored(db, hot_restored)
+        finally:
+            db.close()
+        write_through_products(snapshots)
+        self.swept += len(holds)
+        return len(holds)
+
+    async def run(self):
+        """背景清理迴圈：有積壓時連續處理，清空後依間隔等待"""
+        self.running = True
+        while self.running:
+            try:
+                swept = await asyncio.to_thread(self.sweep_once)
+                if swept >= self.batch_size:
+                    continue
+            except Exception as e:
+                print(f"Reservation sweeper error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def stop(self):
+        """停止背景迴圈"""
+        self.running = False
+
+# 全域實例
+hold_sweeper = HoldSweeper()
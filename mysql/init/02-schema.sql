@@ -15,11 +15,67 @@ CREATE TABLE IF NOT EXISTS inventory (
   CONSTRAINT fk_inventory_product FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
 );
 
+CREATE TABLE IF NOT EXISTS stock_event_outbox (
+  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+  product_id BIGINT NOT NULL,
+  payload TEXT NOT NULL,
+  created_at DATETIME NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS hot_stock_flushes (
+  batch_id VARCHAR(32) PRIMARY KEY,
+  flushed_at DATETIME NOT NULL,
+  KEY ix_hot_stock_flushes_flushed_at (flushed_at)
+);
+
+CREATE TABLE IF NOT EXISTS stock_holds (
+  id BIGINT PRIMARY KEY AUTO_INCREMENT,
+  reservation_id VARCHAR(64) NOT NULL,
+  product_id BIGINT NOT NULL,
+  qty INT NOT NULL,
+  deducted TINYINT(1) NOT NULL DEFAULT 0,
+  expires_at DATETIME NOT NULL,
+  created_at DATETIME NOT NULL,
+  UNIQUE KEY uq_stock_holds_reservation_product (reservation_id, product_id),
+  KEY idx_stock_holds_product_expires (product_id, expires_at),
+  KEY idx_stock_holds_expires (expires_at),
+  CONSTRAINT fk_stock_holds_product FOREIGN KEY (product_id) REFERENCES products(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS reservation_confirmations (
+  reservation_id VARCHAR(64) PRIMARY KEY,
+  confirmed_at DATETIME NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  `key` VARCHAR(191) PRIMARY KEY,
+  fingerprint CHAR(64) NOT NULL,
+  status_code INT NULL,
+  response TEXT NULL,
+  expires_at DATETIME NOT NULL,
+  KEY idx_idempotency_keys_expires (expires_at)
+);
+
 CREATE TABLE IF NOT EXISTS orders (
   id BIGINT PRIMARY KEY AUTO_INCREMENT,
   status VARCHAR(32) NOT NULL,
   total DECIMAL(10,2) NOT NULL DEFAULT 0.00,
-  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  KEY idx_orders_status_created_id (status, created_at, id),
+  KEY idx_orders_created_id (created_at, id)
+);
+
+CREATE TABLE IF NOT EXISTS order_sagas (
+  id VARCHAR(64) PRIMARY KEY,
+  order_id BIGINT NULL,
+  step VARCHAR(32) NOT NULL,
+  payload TEXT NOT NULL,
+  last_error TEXT NULL,
+  attempts INT NOT NULL DEFAULT 0,
+  created_at DATETIME NOT NULL,
+  updated_at DATETIME NOT NULL,
+  KEY idx_order_sagas_step_updated (step, updated_at),
+  KEY idx_order_sagas_order_id (order_id)
 );
 
 CREATE TABLE IF NOT EXISTS order_items (
@@ -28,6 +84,7 @@ CREATE TABLE IF NOT EXISTS order_items (
   product_id BIGINT NOT NULL,
   qty INT NOT NULL,
   unit_price DECIMAL(10,2) NOT NULL,
+  KEY idx_order_items_order_id (order_id),
   CONSTRAINT fk_items_order FOREIGN KEY (order_id) REFERENCES orders(id) ON DELETE CASCADE,
   CONSTRAINT fk_items_product FOREIGN KEY (product_id) REFERENCES products(id)
 );
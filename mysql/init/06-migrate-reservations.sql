@@ -0,0 +1,3 @@
+-- 訂單記錄建立時的庫存預留，付款時確認、取消時釋放
+ALTER TABLE orders
+ADD COLUMN reservation_id VARCHAR(64) NULL;
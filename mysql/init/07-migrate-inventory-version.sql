@@ -0,0 +1,3 @@
+-- 庫存列版本：每次寫入產品或庫存時遞增，快取寫入依版本比較避免舊資料覆蓋新資料
+ALTER TABLE inventory
+ADD COLUMN version BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,13 @@
+-- 同一預留的每個產品只能有一筆預留，避免重試同時建立兩份預留；唯一鍵也涵蓋依 reservation_id 的查詢
+-- 全新安裝時 02-schema.sql 已建立唯一鍵，只有既有資料庫需要轉換
+SET @has_unique := (
+  SELECT COUNT(*) FROM information_schema.statistics
+  WHERE table_schema = DATABASE() AND table_name = 'stock_holds'
+    AND index_name = 'uq_stock_holds_reservation_product'
+);
+SET @ddl := IF(@has_unique = 0,
+  'ALTER TABLE stock_holds DROP INDEX idx_stock_holds_reservation, ADD UNIQUE KEY uq_stock_holds_reservation_product (reservation_id, product_id)',
+  'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
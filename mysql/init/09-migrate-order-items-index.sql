@@ -0,0 +1,13 @@
+-- 訂單列表以單一 GROUP BY 統計各訂單的品項數，需要 order_items(order_id) 索引
+-- 全新安裝時 02-schema.sql 已建立索引，只有既有資料庫需要補上
+SET @has_index := (
+  SELECT COUNT(*) FROM information_schema.statistics
+  WHERE table_schema = DATABASE() AND table_name = 'order_items'
+    AND index_name = 'idx_order_items_order_id'
+);
+SET @ddl := IF(@has_index = 0,
+  'CREATE INDEX idx_order_items_order_id ON order_items (order_id)',
+  'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
@@ -0,0 +1,25 @@
+-- 訂單列表以 (created_at, id) 鍵集分頁，依狀態篩選時走 (status, created_at, id)
+-- 全新安裝時 02-schema.sql 已建立索引，只有既有資料庫需要補上
+SET @has_index := (
+  SELECT COUNT(*) FROM information_schema.statistics
+  WHERE table_schema = DATABASE() AND table_name = 'orders'
+    AND index_name = 'idx_orders_status_created_id'
+);
+SET @ddl := IF(@has_index = 0,
+  'CREATE INDEX idx_orders_status_created_id ON orders (status, created_at, id)',
+  'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
+
+SET @has_index := (
+  SELECT COUNT(*) FROM information_schema.statistics
+  WHERE table_schema = DATABASE() AND table_name = 'orders'
+    AND index_name = 'idx_orders_created_id'
+);
+SET @ddl := IF(@has_index = 0,
+  'CREATE INDEX idx_orders_created_id ON orders (created_at, id)',
+  'DO 0');
+PREPARE stmt FROM @ddl;
+EXECUTE stmt;
+DEALLOCATE PREPARE stmt;
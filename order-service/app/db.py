@@ -1,7 +1,88 @@
 import os
-from sqlalchemy import create_engine
+import time
+from sqlalchemy import create_engine, exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 
 DB_URL = os.environ.get("DB_URL")
-engine = create_engine(DB_URL, pool_pre_ping=True)
+
+# 連線池設定：每個副本最多使用 pool_size + max_overflow 條連線，
+# 需依 HPA 最大副本數 × 服務數估算，不可超過 MySQL max_connections
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# 回收時間需小於 MySQL wait_timeout；設定後可關閉 pre-ping，省去每次借出連線前的 ping
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+class _TimedPoolMixin:
+    """記錄借出連線的等待時間與逾時次數"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.wait_count += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+POOL_OPTIONS = dict(
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=POOL_PRE_PING,
+)
+
+engine = create_engine(DB_URL, poolclass=TimedQueuePool, **POOL_OPTIONS)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+def _async_url(url: str) -> str:
+    """由 DB_URL 推導 aiomysql 連線字串：pymysql 驅動換成 aiomysql，未指定驅動時補上"""
+    if url.startswith("mysql://"):
+        return "mysql+aiomysql://" + url[len("mysql://"):]
+    return url.replace("+pymysql", "+aiomysql", 1)
+
+# 非同步引擎：預設由 DB_URL 推導，可用 ASYNC_DB_URL 覆寫
+ASYNC_DB_URL = os.environ.get("ASYNC_DB_URL") or _async_url(DB_URL)
+async_engine = create_async_engine(ASYNC_DB_URL, poolclass=TimedAsyncQueuePool, **POOL_OPTIONS)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+def pool_stats(pool) -> dict:
+    """連線池即時狀態"""
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": MAX_OVERFLOW,
+        "wait_count": getattr(pool, "wait_count", 0),
+        "wait_seconds_total": round(getattr(pool, "wait_seconds_total", 0.0), 6),
+        "wait_seconds_max": round(getattr(pool, "wait_seconds_max", 0.0), 6),
+        "timeouts": getattr(pool, "timeouts", 0),
+    }
+
+def all_pool_stats() -> dict:
+    return {
+        "sync": pool_stats(engine.pool),
+        "async": pool_stats(async_engine.sync_engine.pool),
+    }
@@ -0,0 +1,359 @@
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional
+import redis
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from .db import AsyncSessionLocal
+from .models import IdempotencyRecord
+from .services.redis_subscriber import redis_subscriber
+
+# ---- 共用邏輯：正本在 inventory-service/app/idempotency.py，本段為逐字複本，修改時從正本複製 ----
+# 兩個服務各自以獨立的建置目錄打包映像，無法共用套件；兩邊只差在同步或非同步的 I/O
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+# 完成的結果保留多久可供重播
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# 處理中的鍵在程序中斷時自動失效，讓重試可以重新執行；
+# 每個程序由單一背景迴圈每隔 1/3 TTL 一次續期所有處理中的鍵，並把備援表的結果搬回 Redis
+IDEMPOTENCY_LOCK_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_TTL_SECONDS", "60"))
+IDEMPOTENCY_RENEW_INTERVAL = max(IDEMPOTENCY_LOCK_TTL_SECONDS / 3, 1)
+IDEMPOTENCY_FALLBACK_DRAIN_BATCH = 500
+MAX_IDEMPOTENCY_KEY_LENGTH = 128
+
+# 只有仍持有處理權（值仍是自己的處理中標記）時才續期或刪除，不會動到別人的鍵
+_RENEW_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class _Claim:
+    """一次請求對鍵的處理權"""
+
+    def __init__(self, scope: str, key: str, payload: Any):
+        self.storage_key = f"idempotency:{scope}:{key}"
+        self.fingerprint = request_fingerprint(payload)
+        # 處理中標記帶有本次請求的 token，續期與釋放時用來確認仍持有處理權
+        self.pending = json.dumps({"fingerprint": self.fingerprint, "status_code": None, "token": uuid.uuid4().hex})
+        self.in_redis = True
+
+    def completed(self, status_code: int, body: Any) -> dict:
+        return {"fingerprint": self.fingerprint, "status_code": status_code, "response": json.dumps(body)}
+
+class _FallbackState:
+    """MySQL 備援表是否可能有紀錄
+
+    沒有時 Redis 搶占成功後就不必再查 MySQL。本程序寫入備援表時立即設為 True；
+    其他副本寫入的紀錄由背景迴圈在一個週期內發現，期間最多晚一個週期才會改查 MySQL。
+    """
+
+    def __init__(self):
+        self.may_have_records = True
+        self.writes = 0
+
+    def mark(self):
+        self.writes += 1
+        self.may_have_records = True
+
+    def settle(self, writes_seen: int, may_have_records: bool):
+        """以背景迴圈的檢查結果更新；檢查期間本程序又寫入備援表時維持 True"""
+        if self.writes == writes_seen:
+            self.may_have_records = may_have_records
+
+_fallback = _FallbackState()
+
+# 本程序處理中的鍵，由背景迴圈統一續期
+_active_claims: dict[str, _Claim] = {}
+_active_lock = threading.Lock()
+
+def _track(claim: _Claim):
+    with _active_lock:
+        _active_claims[claim.pending] = claim
+
+def _untrack(claim: _Claim):
+    with _active_lock:
+        _active_claims.pop(claim.pending, None)
+
+def _tracked() -> tuple[list[_Claim], list[_Claim]]:
+    """回傳（存在 Redis 的處理權, 存在 MySQL 的處理權）"""
+    with _active_lock:
+        claims = list(_active_claims.values())
+    return [c for c in claims if c.in_redis], [c for c in claims if not c.in_redis]
+
+def request_fingerprint(payload: Any) -> str:
+    """請求內容的雜湊，用來偵測同一個鍵被用在不同的請求"""
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+def _validate_key(key: str):
+    if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} must be 1-{MAX_IDEMPOTENCY_KEY_LENGTH} characters")
+
+def _in_progress() -> HTTPException:
+    return HTTPException(status_code=409, detail=f"A request with this {IDEMPOTENCY_HEADER} is still in progress")
+
+def _replay(record: dict, fingerprint: str) -> JSONResponse:
+    """依已儲存的紀錄回應：內容不符回 422、仍在處理中回 409，否則重播結果"""
+    if record["fingerprint"] != fingerprint:
+        raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} was already used with a different request")
+    if record.get("status_code") is None:
+        raise _in_progress()
+    return JSONResponse(
+        content=json.loads(record["response"]),
+        status_code=record["status_code"],
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+def _record_dict(record: IdempotencyRecord) -> dict:
+    return {"fingerprint": record.fingerprint, "status_code": record.status_code, "response": record.response}
+
+def _live_record(record: Optional[IdempotencyRecord], now: datetime) -> Optional[dict]:
+    return _record_dict(record) if record is not None and record.expires_at > now else None
+
+def _pending_expiry(now: datetime) -> datetime:
+    return now + timedelta(seconds=IDEMPOTENCY_LOCK_TTL_SECONDS)
+
+def _pending_record(claim: _Claim, now: datetime) -> IdempotencyRecord:
+    return IdempotencyRecord(key=claim.storage_key, fingerprint=claim.fingerprint, expires_at=_pending_expiry(now))
+
+def _completed_record(claim: _Claim, stored: dict, now: datetime) -> IdempotencyRecord:
+    return IdempotencyRecord(key=claim.storage_key, **stored, expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS))
+
+def _purge_expired(claim: _Claim, now: datetime):
+    # 備援表只在 Redis 故障時寫入，寫入時順便清除過期紀錄
+    return delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now, IdempotencyRecord.key != claim.storage_key)
+
+def _renew_pending(claim: _Claim, now: datetime):
+    return update(IdempotencyRecord).where(
+        IdempotencyRecord.key == claim.storage_key, IdempotencyRecord.status_code.is_(None)
+    ).values(expires_at=_pending_expiry(now))
+
+def _delete_pending(claim: _Claim):
+    return delete(IdempotencyRecord).where(
+        IdempotencyRecord.key == claim.storage_key, IdempotencyRecord.status_code.is_(None)
+    )
+
+def _renew_pending_many(keys: list[str], now: datetime):
+    return update(IdempotencyRecord).where(
+        IdempotencyRecord.key.in_(keys), IdempotencyRecord.status_code.is_(None)
+    ).values(expires_at=_pending_expiry(now))
+
+def _fallback_records(now: datetime):
+    return select(IdempotencyRecord).where(IdempotencyRecord.expires_at > now).limit(IDEMPOTENCY_FALLBACK_DRAIN_BATCH)
+
+def _delete_completed(keys: list[str]):
+    return delete(IdempotencyRecord).where(
+        IdempotencyRecord.key.in_(keys), IdempotencyRecord.status_code.isnot(None)
+    )
+
+def _purge_all_expired(now: datetime):
+    return delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now)
+
+def _remaining_seconds(record: IdempotencyRecord, now: datetime) -> int:
+    return max(int((record.expires_at - now).total_seconds()), 1)
+
+def _drained_keys(completed: list[IdempotencyRecord], moved: list, existing: list) -> list[str]:
+    """可從備援表刪除的鍵：已搬進 Redis，或 Redis 已有同一個鍵的完成結果
+
+    Redis 上仍是處理中標記時保留備援紀錄，重試仍會查到 MySQL 的結果。
+    """
+    keys = []
+    for record, ok, raw in zip(completed, moved, existing):
+        if ok or (raw is not None and json.loads(raw).get("status_code") is not None):
+            keys.append(record.key)
+    return keys
+
+# ---- 非同步 I/O ----
+
+def get_redis():
+    """沿用訂閱者的 Redis 客戶端，不另建連線池"""
+    return redis_subscriber.redis_client
+
+async def _claim(claim: _Claim) -> Optional[JSONResponse]:
+    """取得鍵的處理權，回傳要重播的回應（取得處理權時回傳 None）
+
+    以 SET NX 搶占；Redis 無法使用時改在 MySQL 搶占。備援表可能有紀錄時，Redis 搶占成功後再查一次 MySQL，
+    讓 Redis 故障期間完成、尚未搬回 Redis 的請求也能重播；查詢失敗時放棄處理權，不讓重試卡在處理中。
+    """
+    try:
+        redis_client = get_redis()
+        if not await redis_client.set(claim.storage_key, claim.pending, nx=True, ex=IDEMPOTENCY_LOCK_TTL_SECONDS):
+            raw = await redis_client.get(claim.storage_key)
+            if raw is None:
+                # 處理中的鍵剛好過期，交由用戶端重試
+                raise _in_progress()
+            return _replay(json.loads(raw), claim.fingerprint)
+    except redis.RedisError:
+        claim.in_redis = False
+        return await _claim_db(claim)
+    if not _fallback.may_have_records:
+        return None
+
+    try:
+        async with AsyncSessionLocal() as db:
+            stored = _live_record(await db.get(IdempotencyRecord, claim.storage_key), datetime.utcnow())
+    except Exception:
+        await _release(claim)
+        raise
+    if stored is None:
+        return None
+    if stored["status_code"] is not None:
+        await redis_client.set(claim.storage_key, json.dumps(stored), ex=IDEMPOTENCY_TTL_SECONDS)
+    else:
+        await redis_client.delete(claim.storage_key)
+    return _replay(stored, claim.fingerprint)
+
+async def _claim_db(claim: _Claim) -> Optional[JSONResponse]:
+    _fallback.mark()
+    async with AsyncSessionLocal() as db:
+        try:
+            now = datetime.utcnow()
+            record = await db.get(IdempotencyRecord, claim.storage_key, with_for_update=True)
+            stored = _live_record(record, now)
+            if stored is not None:
+                await db.rollback()
+                return _replay(stored, claim.fingerprint)
+            if record is not None:
+                await db.delete(record)
+                await db.flush()
+            db.add(_pending_record(claim, now))
+            await db.commit()
+            return None
+        except IntegrityError:
+            await db.rollback()
+            raise _in_progress()
+
+async def _renew_all():
+    """續期本程序所有處理中的鍵：Redis 上的以一次 pipeline 續期，MySQL 上的以一句 UPDATE 續期"""
+    redis_claims, db_claims = _tracked()
+    if redis_claims:
+        pipe = get_redis().pipeline(transaction=False)
+        for claim in redis_claims:
+            pipe.eval(_RENEW_LUA, 1, claim.storage_key, claim.pending, IDEMPOTENCY_LOCK_TTL_SECONDS)
+        await pipe.execute()
+    if db_claims:
+        async with AsyncSessionLocal() as db:
+            await db.execute(_renew_pending_many([c.storage_key for c in db_claims], datetime.utcnow()))
+            await db.commit()
+
+async def _drain_fallback():
+    """把 Redis 故障期間存進備援表的完成結果搬回 Redis，並更新備援表是否仍有紀錄"""
+    writes_seen = _fallback.writes
+    async with AsyncSessionLocal() as db:
+        now = datetime.utcnow()
+        await db.execute(_purge_all_expired(now))
+        records = (await db.execute(_fallback_records(now))).scalars().all()
+        completed = [r for r in records if r.status_code is not None]
+        drained = []
+        if completed:
+            pipe = get_redis().pipeline(transaction=False)
+            for record in completed:
+                pipe.set(record.key, json.dumps(_record_dict(record)), nx=True, ex=_remaining_seconds(record, now))
+            moved = await pipe.execute()
+            existing = await get_redis().mget([r.key for r in completed])
+            drained = _drained_keys(completed, moved, existing)
+            if drained:
+                await db.execute(_delete_completed(drained))
+        await db.commit()
+        _fallback.settle(
+            writes_seen, len(records) > len(drained) or len(records) == IDEMPOTENCY_FALLBACK_DRAIN_BATCH
+        )
+
+async def _maintain():
+    while True:
+        try:
+            await _renew_all()
+        except Exception as e:
+            print(f"Failed to renew idempotency keys: {e}")
+        try:
+            await _drain_fallback()
+        except Exception as e:
+            print(f"Failed to drain idempotency fallback records: {e}")
+        await asyncio.sleep(IDEMPOTENCY_RENEW_INTERVAL)
+
+_maintainer: Optional[asyncio.Task] = None
+
+def _ensure_maintainer():
+    global _maintainer
+    if _maintainer is None or _maintainer.done() or _maintainer.get_loop() is not asyncio.get_running_loop():
+        _maintainer = asyncio.create_task(_maintain())
+
+@asynccontextmanager
+async def _keep_claimed(claim: _Claim):
+    """執行處理函式期間把處理權交給背景迴圈續期，避免處理較久時鍵過期而讓重試重複執行"""
+    _ensure_maintainer()
+    _track(claim)
+    try:
+        yield
+    finally:
+        _untrack(claim)
+
+async def _complete(claim: _Claim, status_code: int, body: Any):
+    """儲存結果供重播；Redis 寫入失敗時改存 MySQL"""
+    stored = claim.completed(status_code, body)
+    if claim.in_redis:
+        try:
+            await get_redis().set(claim.storage_key, json.dumps(stored), ex=IDEMPOTENCY_TTL_SECONDS)
+            return
+        except redis.RedisError:
+            pass
+    _fallback.mark()
+    async with AsyncSessionLocal() as db:
+        now = datetime.utcnow()
+        await db.execute(_purge_expired(claim, now))
+        await db.merge(_completed_record(claim, stored, now))
+        await db.commit()
+
+async def _release(claim: _Claim):
+    """請求失敗時放棄處理權，讓重試重新執行"""
+    try:
+        if claim.in_redis:
+            await get_redis().eval(_RELEASE_LUA, 1, claim.storage_key, claim.pending)
+            return
+        async with AsyncSessionLocal() as db:
+            await db.execute(_delete_pending(claim))
+            await db.commit()
+    except Exception as e:
+        print(f"Failed to release idempotency key {claim.storage_key}: {e}")
+
+async def run_idempotent(scope: str, key: Optional[str], payload: Any,
+                         handler: Callable[[], Awaitable[Any]]) -> Any:
+    """以 Idempotency-Key 執行請求：同一個鍵與相同內容只執行一次，重試時重播第一次的成功結果
+
+    只儲存成功的結果；失敗（含 4xx）時釋放鍵，重試會重新執行。
+    """
+    if key is None:
+        return await handler()
+    _validate_key(key)
+    claim = _Claim(scope, key, payload)
+    replay = await _claim(claim)
+    if replay is not None:
+        return replay
+    try:
+        async with _keep_claimed(claim):
+            result = await handler()
+    except Exception:
+        await _release(claim)
+        raise
+    try:
+        await _complete(claim, 200, jsonable_encoder(result))
+    except Exception as e:
+        # 訂單已建立，儲存失敗只影響之後的重播
+        print(f"Failed to store idempotent response {claim.storage_key}: {e}")
+    return result
@@ -2,10 +2,14 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy import text
-from .db import engine
+from .db import engine, async_engine
+from .metrics import setup_metrics
 from .models import Base
-from .routers import health, orders
+from .routers import dashboard, health, orders
 from .services.redis_subscriber import redis_subscriber
+from .services.stock_events import stock_event_consumer
+from .services.inventory_client import inventory_client
+from .services.order_saga import order_saga
 import time
 import asyncio
 
@@ -35,13 +39,29 @@ app.add_middleware(
     allow_headers=["*"],  # 允許所有標頭
 )
 
+# Prometheus 指標：請求延遲、處理中請求數、每請求 SQL 數與庫存服務呼叫延遲
+setup_metrics(app, [engine, async_engine.sync_engine])
+
 @app.on_event("startup")
 async def startup_event():
-    """應用啟動時啟動 Redis 訂閱者"""
+    """應用啟動時建立庫存服務連線池並啟動 Redis 訂閱者、庫存事件消費者與訂單 saga 復原工作"""
+    await inventory_client.start()
     asyncio.create_task(redis_subscriber.subscribe_to_channels())
+    asyncio.create_task(stock_event_consumer.run())
+    asyncio.create_task(order_saga.run())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """應用關閉時停止事件消費並釋放庫存服務與資料庫連線池"""
+    redis_subscriber.stop()
+    stock_event_consumer.stop()
+    order_saga.stop()
+    await inventory_client.close()
+    await async_engine.dispose()
 
 app.include_router(health.router)
 app.include_router(orders.router)
+app.include_router(dashboard.router)
 
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="0.0.0.0", port=8002)
@@ -0,0 +1,94 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from sqlalchemy import event
+from .db import all_pool_stats
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP 請求延遲", ["method", "route", "status"]
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "處理中的 HTTP 請求數")
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "單一 SQL 執行時間",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "每個請求執行的 SQL 數", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+)
+DB_TIME_PER_REQUEST = Histogram("db_seconds_per_request", "每個請求花在 SQL 的時間", ["route"])
+
+# 目前請求的 SQL 統計（由中介層建立，SQLAlchemy 事件累加）
+_request_db_stats: ContextVar[Optional[dict]] = ContextVar("request_db_stats", default=None)
+
+# 開始時間記在該次執行的 context 上：SQL 失敗時 after_cursor_execute 不會觸發，
+# 記在 context 上不會像連線層級的堆疊一樣殘留而讓後續量測錯位
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    DB_QUERY_DURATION.observe(elapsed)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats["count"] += 1
+        stats["seconds"] += elapsed
+
+def instrument_engine(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+class DBPoolCollector:
+    """以 gauge 形式輸出連線池狀態"""
+
+    def collect(self):
+        stats = all_pool_stats()
+        for field in ("size", "checked_in", "checked_out", "overflow", "wait_count",
+                      "wait_seconds_total", "wait_seconds_max", "timeouts"):
+            gauge = GaugeMetricFamily(f"db_pool_{field}", f"DB 連線池 {field}", labels=["engine"])
+            for name, values in stats.items():
+                gauge.add_metric([name], values[field])
+            yield gauge
+
+def setup_metrics(app: FastAPI, engines: list):
+    """註冊請求量測中介層、SQL 事件與 /metrics 端點
+
+    本模組在兩個服務中是逐字相同的兩份複本（各服務以獨立的建置目錄打包，無法共用套件），
+    正本為 inventory-service/app/metrics.py，修改時從正本複製；
+    服務特有的指標（Redis 指令、庫存服務呼叫）放在各自的客戶端模組。
+    """
+    for sync_engine in engines:
+        instrument_engine(sync_engine)
+    REGISTRY.register(DBPoolCollector())
+
+    @app.middleware("http")
+    async def metrics_middleware(request: Request, call_next):
+        stats = {"count": 0, "seconds": 0.0}
+        token = _request_db_stats.set(stats)
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        status = "500"
+        try:
+            response = await call_next(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            _request_db_stats.reset(token)
+            route = request.scope.get("route")
+            route_path = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.labels(method=request.method, route=route_path, status=status).observe(elapsed)
+            DB_QUERIES_PER_REQUEST.labels(route=route_path).observe(stats["count"])
+            DB_TIME_PER_REQUEST.labels(route=route_path).observe(stats["seconds"])
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
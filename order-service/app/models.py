@@ -1,5 +1,5 @@
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column
-from sqlalchemy import String, Numeric, BigInteger, Integer, DateTime, Text
+from sqlalchemy import String, Numeric, BigInteger, Integer, DateTime, Text, Index
 from datetime import datetime
 import pytz
 
@@ -12,6 +12,10 @@ def get_aest_time():
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("idx_orders_status_created_id", "status", "created_at", "id"),
+        Index("idx_orders_created_id", "created_at", "id"),
+    )
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     status: Mapped[str] = mapped_column(String(32), nullable=False, default="CREATED")
     total: Mapped[float] = mapped_column(Numeric(10,2), nullable=False, default=0.00)
@@ -23,11 +27,45 @@ class Order(Base):
     updated_at: Mapped[datetime] = mapped_column(DateTime, default=get_aest_time, onupdate=get_aest_time)
     paid_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     shipped_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # 建立訂單時的庫存預留，付款時確認、取消時釋放
+    reservation_id: Mapped[str] = mapped_column(String(64), nullable=True)
 
 class OrderItem(Base):
     __tablename__ = "order_items"
+    __table_args__ = (
+        Index("idx_order_items_order_id", "order_id"),
+    )
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
     order_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     product_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
     qty: Mapped[int] = mapped_column(Integer, nullable=False)
     unit_price: Mapped[float] = mapped_column(Numeric(10,2), nullable=False)
+
+class OrderSaga(Base):
+    __tablename__ = "order_sagas"
+    __table_args__ = (
+        Index("idx_order_sagas_step_updated", "step", "updated_at"),
+        Index("idx_order_sagas_order_id", "order_id"),
+    )
+    # 同時作為庫存預留 ID（orders.reservation_id）
+    id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    order_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    step: Mapped[str] = mapped_column(String(32), nullable=False)
+    # 建立訂單的請求內容，預留成功後加上價格
+    payload: Mapped[str] = mapped_column(Text, nullable=False)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.utcnow)
+
+class IdempotencyRecord(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("idx_idempotency_keys_expires", "expires_at"),
+    )
+    key: Mapped[str] = mapped_column(String(191), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    # Redis 無法使用時的備援；status_code 為空表示請求仍在處理中
+    status_code: Mapped[int] = mapped_column(Integer, nullable=True)
+    response: Mapped[str] = mapped_column(Text, nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
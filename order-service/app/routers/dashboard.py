@@ -0,0 +1,55 @@
+from fastapi import APIRouter
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from datetime import datetime
+from ..services.dashboard import dashboard_summary
+
+router = APIRouter(prefix="/api/dashboard", tags=["dashboard"])
+
+class StatusSummary(BaseModel):
+    count: int
+    revenue: float
+
+class RecentOrder(BaseModel):
+    id: int
+    status: str
+    total: float
+    customer_name: Optional[str]
+    created_at: datetime
+
+class OrdersSummary(BaseModel):
+    total: int
+    revenue: float  # PAID 與 SHIPPED 訂單的金額
+    by_status: Dict[str, StatusSummary]
+    recent: List[RecentOrder]
+
+class StockAlertItem(BaseModel):
+    product_id: int
+    sku: str
+    name: str
+    current_stock: int
+    safety_stock: int
+
+class InventorySummary(BaseModel):
+    total_products: int
+    total_units: int
+    out_of_stock: int  # 庫存為 0
+    low_stock: int  # 有庫存但不高於安全庫存，不含缺貨；兩者互斥
+    total_alerts: int  # out_of_stock + low_stock
+    items: List[StockAlertItem]
+
+class DashboardSummaryOut(BaseModel):
+    generated_at: datetime
+    orders: OrdersSummary
+    inventory: Optional[InventorySummary]  # 庫存服務從未成功回應時為空
+    inventory_status: str
+
+@router.get("/summary", response_model=DashboardSummaryOut)
+async def get_dashboard_summary():
+    """儀表板摘要：訂單數、各狀態營收、近期訂單與庫存警告
+
+    每個副本各自在記憶體中物化一份，保留 DASHBOARD_SUMMARY_TTL 秒（預設 5 秒），期間該副本的請求共用；
+    副本之間不共用，連續請求落在不同副本時 generated_at 可能不同。資料最多落後一個 TTL，
+    庫存部分另受庫存服務的摘要快取影響。
+    """
+    return await dashboard_summary.get()
@@ -1,6 +1,26 @@
 from fastapi import APIRouter
+from ..db import all_pool_stats
+from ..services.product_cache import product_cache
+from ..services.stock_events import stock_event_consumer
+from ..services.order_saga import order_saga
 router = APIRouter(prefix="/api", tags=["health"])
 
 @router.get("/healthz")
 def healthz():
     return {"status": "ok"}
+
+@router.get("/cache/stats")
+def cache_stats():
+    return {"product_cache": product_cache.stats()}
+
+@router.get("/events/stats")
+def event_stats():
+    return {"stock_events": stock_event_consumer.stats()}
+
+@router.get("/sagas/stats")
+async def saga_stats():
+    return {"order_sagas": await order_saga.stats()}
+
+@router.get("/metrics/db-pool")
+def db_pool_metrics():
+    return all_pool_stats()
@@ -1,13 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header
 from pydantic import BaseModel, conint, EmailStr
-from typing import List, Optional
-from sqlalchemy.orm import Session
-from sqlalchemy import text, desc
+from typing import List, Optional, Union
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, desc, func, or_, and_
 from datetime import datetime
-from ..db import SessionLocal
+import base64
+import json
+from ..db import AsyncSessionLocal
 from ..models import Order, OrderItem
 from ..services.order_workflow import OrderWorkflowService, OrderStatus
 from ..services.inventory_client import inventory_client
+from ..services.order_saga import order_saga
+from ..idempotency import IDEMPOTENCY_HEADER, run_idempotent
 
 router = APIRouter(prefix="/api/orders", tags=["orders"])
 
@@ -64,94 +68,97 @@ class OrderListOut(BaseModel):
     updated_at: datetime
     item_count: int
 
-def get_db():
-    db = SessionLocal()
+class OrderPageOut(BaseModel):
+    items: List[OrderListOut]
+    next_cursor: Optional[str]
+
+def encode_order_cursor(order: Order) -> str:
+    """將 (created_at, id) 編碼為不透明的游標字串"""
+    raw = json.dumps([order.created_at.isoformat(), order.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_order_cursor(cursor: str) -> tuple[datetime, int]:
+    """解碼游標，格式錯誤時拋出 400"""
     try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(order_id)
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @router.post("/", response_model=OrderOut)
-async def create_order(body: OrderCreate, db: Session = Depends(get_db)):
-    """建立新訂單"""
+async def create_order(
+    body: OrderCreate,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER),
+):
+    """建立新訂單（帶 Idempotency-Key 時，重試會回傳第一次建立的訂單而不會重複預留庫存）"""
+    return await run_idempotent("order-create", idempotency_key, body.dict(), lambda: _create_order(body, db))
+
+async def _create_order(body: OrderCreate, db: AsyncSession) -> OrderOut:
     if not body.items:
         raise HTTPException(400, "items cannot be empty")
 
-    # 檢查庫存並預留
-    product_info = {}
-    total = 0.0
-    
+    # 由 saga 預留庫存（有期限，付款時確認）並寫入訂單，每一步都先記錄，中斷時由復原工作補償
     try:
-        # 檢查所有產品的庫存
-        for item in body.items:
-            stock_info = await inventory_client.check_stock(item.product_id, item.qty)
-            product_info[item.product_id] = await inventory_client.get_product_info(item.product_id)
-            total += product_info[item.product_id]["price"] * item.qty
-        
-        # 預留庫存
-        for item in body.items:
-            await inventory_client.reserve_stock(item.product_id, item.qty)
-            
+        order_id = await order_saga.create_order(body.dict())
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(500, f"Failed to process inventory: {str(e)}")
-
-    # 建立訂單
-    try:
-        with db.begin():
-            order = Order(
-                status=OrderStatus.CREATED.value,
-                total=total,
-                customer_name=body.customer_name,
-                customer_email=body.customer_email,
-                shipping_address=body.shipping_address,
-                notes=body.notes
-            )
-            db.add(order)
-            db.flush()  # 取得 order.id
-
-            # 建立訂單項目
-            for item in body.items:
-                product = product_info[item.product_id]
-                order_item = OrderItem(
-                    order_id=order.id,
-                    product_id=item.product_id,
-                    qty=item.qty,
-                    unit_price=product["price"]
-                )
-                db.add(order_item)
-
-        # 重新查詢完整的訂單資訊
-        return await get_order(order.id, db)
-        
-    except Exception as e:
-        # 如果訂單建立失敗，釋放已預留的庫存
-        for item in body.items:
-            try:
-                await inventory_client.release_stock(item.product_id, item.qty)
-            except:
-                pass  # 記錄錯誤但不影響主要錯誤
         raise HTTPException(500, f"Failed to create order: {str(e)}")
 
-@router.get("/", response_model=List[OrderListOut])
+    # 重新查詢完整的訂單資訊
+    return await get_order(order_id, db)
+
+@router.get("/", response_model=Union[List[OrderListOut], OrderPageOut])
 async def list_orders(
     skip: int = 0, 
     limit: int = 100, 
     status: Optional[str] = None,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_db)
 ):
-    """取得訂單列表"""
-    query = db.query(Order)
+    """取得訂單列表
+    
+    未帶 cursor 時沿用 skip/limit 並回傳陣列；帶 cursor 時（第一頁傳空字串）
+    改用 (created_at, id) 鍵集分頁，回傳 {items, next_cursor}。
+    """
+    query = select(Order)
     
     if status:
-        query = query.filter(Order.status == status)
+        query = query.where(Order.status == status)
+    
+    query = query.order_by(desc(Order.created_at), desc(Order.id))
+    
+    if cursor is None:
+        query = query.offset(skip).limit(limit)
+    else:
+        if cursor:
+            created_at, order_id = decode_order_cursor(cursor)
+            query = query.where(or_(
+                Order.created_at < created_at,
+                and_(Order.created_at == created_at, Order.id < order_id)
+            ))
+        # 多取一筆判斷是否還有下一頁
+        query = query.limit(limit + 1)
+    orders = (await db.execute(query)).scalars().all()
     
-    orders = query.order_by(desc(Order.created_at)).offset(skip).limit(limit).all()
+    # 以單一分組查詢取得本頁所有訂單的項目數
+    item_counts = {}
+    if orders:
+        item_counts = dict((await db.execute(
+            select(OrderItem.order_id, func.count(OrderItem.id))
+            .where(OrderItem.order_id.in_([order.id for order in orders]))
+            .group_by(OrderItem.order_id)
+        )).all())
     
     result = []
     for order in orders:
-        item_count = db.query(OrderItem).filter(OrderItem.order_id == order.id).count()
+        item_count = item_counts.get(order.id, 0)
         result.append(OrderListOut(
             id=order.id,
             status=order.status,
@@ -162,43 +169,40 @@ async def list_orders(
             item_count=item_count
         ))
     
-    return result
+    if cursor is None:
+        return result
+    
+    next_cursor = None
+    if len(orders) > limit:
+        result = result[:limit]
+        next_cursor = encode_order_cursor(orders[limit - 1])
+    return OrderPageOut(items=result, next_cursor=next_cursor)
 
 @router.get("/{order_id}", response_model=OrderOut)
-async def get_order(order_id: int, db: Session = Depends(get_db)):
+async def get_order(order_id: int, db: AsyncSession = Depends(get_db)):
     """取得單一訂單詳情"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(404, "Order not found")
     
     # 取得訂單項目
-    items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
+    items = (await db.execute(select(OrderItem).where(OrderItem.order_id == order_id))).scalars().all()
+    
+    # 並行取得產品資訊；查詢失敗的產品使用基本資訊
+    products = await inventory_client.get_product_info_many([item.product_id for item in items])
     
-    # 取得產品資訊
     order_items = []
     for item in items:
-        try:
-            product_info = await inventory_client.get_product_info(item.product_id)
-            order_items.append(OrderItemOut(
-                id=item.id,
-                product_id=item.product_id,
-                product_name=product_info["name"],
-                product_sku=product_info["sku"],
-                qty=item.qty,
-                unit_price=float(item.unit_price),
-                subtotal=float(item.unit_price * item.qty)
-            ))
-        except:
-            # 如果無法取得產品資訊，使用基本資訊
-            order_items.append(OrderItemOut(
-                id=item.id,
-                product_id=item.product_id,
-                product_name=f"Product {item.product_id}",
-                product_sku="N/A",
-                qty=item.qty,
-                unit_price=float(item.unit_price),
-                subtotal=float(item.unit_price * item.qty)
-            ))
+        product_info = products.get(item.product_id)
+        order_items.append(OrderItemOut(
+            id=item.id,
+            product_id=item.product_id,
+            product_name=product_info["name"] if product_info else f"Product {item.product_id}",
+            product_sku=product_info["sku"] if product_info else "N/A",
+            qty=item.qty,
+            unit_price=float(item.unit_price),
+            subtotal=float(item.unit_price * item.qty)
+        ))
     
     return OrderOut(
         id=order.id,
@@ -216,9 +220,9 @@ async def get_order(order_id: int, db: Session = Depends(get_db)):
     )
 
 @router.put("/{order_id}", response_model=OrderOut)
-async def update_order(order_id: int, body: OrderUpdate, db: Session = Depends(get_db)):
+async def update_order(order_id: int, body: OrderUpdate, db: AsyncSession = Depends(get_db)):
     """更新訂單資訊"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(404, "Order not found")
     
@@ -236,33 +240,41 @@ async def update_order(order_id: int, body: OrderUpdate, db: Session = Depends(g
         order.notes = body.notes
     
     order.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(order)
+    await db.commit()
+    await db.refresh(order)
     
     return await get_order(order_id, db)
 
 @router.patch("/{order_id}/status", response_model=OrderOut)
-async def update_order_status(order_id: int, body: OrderStatusUpdate, db: Session = Depends(get_db)):
-    """更新訂單狀態"""
+async def update_order_status(order_id: int, body: OrderStatusUpdate, db: AsyncSession = Depends(get_db)):
+    """更新訂單狀態（付款時先確認庫存預留，預留失效且庫存不足時回傳 409）"""
+    order = await db.get(Order, order_id)
+    if not order:
+        raise HTTPException(404, "Order not found")
+    if (body.status == OrderStatus.PAID.value and order.reservation_id
+            and OrderWorkflowService.can_transition(order.status, body.status)):
+        await order_saga.pay(order.reservation_id, order_id, body.notes)
+        await db.refresh(order)
+        return await get_order(order_id, db)
     try:
-        order = OrderWorkflowService.update_order_status(db, order_id, body.status, body.notes)
+        order = await OrderWorkflowService.update_order_status(db, order_id, body.status, body.notes)
         return await get_order(order_id, db)
     except ValueError as e:
         raise HTTPException(400, str(e))
 
 @router.get("/{order_id}/workflow", response_model=dict)
-async def get_order_workflow(order_id: int, db: Session = Depends(get_db)):
+async def get_order_workflow(order_id: int, db: AsyncSession = Depends(get_db)):
     """取得訂單工作流程資訊"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(404, "Order not found")
     
     return OrderWorkflowService.get_order_workflow_info(order)
 
 @router.delete("/{order_id}")
-async def cancel_order(order_id: int, db: Session = Depends(get_db)):
+async def cancel_order(order_id: int, db: AsyncSession = Depends(get_db)):
     """取消訂單（釋放庫存）"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(404, "Order not found")
     
@@ -270,26 +282,33 @@ async def cancel_order(order_id: int, db: Session = Depends(get_db)):
         raise HTTPException(400, f"Cannot cancel order in {order.status} status")
     
     try:
-        # 釋放庫存
-        items = db.query(OrderItem).filter(OrderItem.order_id == order_id).all()
-        for item in items:
-            await inventory_client.release_stock(item.product_id, item.qty)
+        # 未付款的訂單由 saga 釋放預留並取消；已付款（或沒有預留的舊訂單）把已扣除的庫存加回
+        if order.status == OrderStatus.CREATED.value and order.reservation_id:
+            await order_saga.cancel(order.reservation_id, "Order cancelled by user")
+            return {"message": "Order cancelled successfully"}
+        items = (await db.execute(select(OrderItem).where(OrderItem.order_id == order_id))).scalars().all()
+        if items:
+            await inventory_client.release_items(
+                [{"product_id": item.product_id, "qty": item.qty} for item in items]
+            )
         
         # 更新訂單狀態
-        OrderWorkflowService.update_order_status(
+        await OrderWorkflowService.update_order_status(
             db, order_id, OrderStatus.CANCELLED.value, 
             "Order cancelled by user"
         )
         
         return {"message": "Order cancelled successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Failed to cancel order: {str(e)}")
 
 @router.delete("/{order_id}/delete")
-async def delete_order(order_id: int, db: Session = Depends(get_db)):
+async def delete_order(order_id: int, db: AsyncSession = Depends(get_db)):
     """刪除訂單"""
-    order = db.query(Order).filter(Order.id == order_id).first()
+    order = await db.get(Order, order_id)
     if not order:
         raise HTTPException(404, "Order not found")
     
@@ -298,11 +317,11 @@ async def delete_order(order_id: int, db: Session = Depends(get_db)):
         raise HTTPException(400, f"Cannot delete order in {order.status} status")
     
     # 刪除訂單項目
-    db.query(OrderItem).filter(OrderItem.order_id == order_id).delete()
+    await db.execute(delete(OrderItem).where(OrderItem.order_id == order_id))
     
     # 刪除訂單
-    db.delete(order)
-    db.commit()
+    await db.delete(order)
+    await db.commit()
     
     return {"message": "Order deleted successfully"}
 
@@ -0,0 +1,86 @@
+import os
+import time
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional
+from fastapi import HTTPException
+from sqlalchemy import select, func, desc
+from ..db import AsyncSessionLocal
+from ..models import Order
+from .inventory_client import inventory_client
+from .order_workflow import OrderStatus
+
+# 計入營收的訂單狀態
+REVENUE_STATUSES = (OrderStatus.PAID.value, OrderStatus.SHIPPED.value)
+
+class DashboardSummaryService:
+    """儀表板摘要
+
+    訂單彙總與庫存摘要在短間隔內物化一次，期間本副本的所有請求（所有開啟的分頁）共用同一份結果
+    （只存在本副本的記憶體，各副本各自重建）；過期時只有一個請求重建，其餘等待同一次重建。庫存服務無法使用時沿用上一次的庫存摘要。
+    """
+
+    def __init__(self):
+        self.ttl = float(os.getenv("DASHBOARD_SUMMARY_TTL", "5"))
+        self.recent_limit = int(os.getenv("DASHBOARD_RECENT_ORDERS", "10"))
+        self._summary: Optional[Dict] = None
+        self._refreshed_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fresh(self) -> bool:
+        return self._summary is not None and time.monotonic() - self._refreshed_at < self.ttl
+
+    async def get(self) -> Dict:
+        """取得摘要，過期時重建"""
+        if self._fresh():
+            return self._summary
+        async with self._lock:
+            if not self._fresh():
+                self._summary = await self._build()
+                self._refreshed_at = time.monotonic()
+        return self._summary
+
+    async def _build(self) -> Dict:
+        async with AsyncSessionLocal() as db:
+            by_status = (await db.execute(
+                select(Order.status, func.count(Order.id), func.coalesce(func.sum(Order.total), 0))
+                .group_by(Order.status)
+            )).all()
+            recent = (await db.execute(
+                select(Order).order_by(desc(Order.created_at), desc(Order.id)).limit(self.recent_limit)
+            )).scalars().all()
+
+        previous = self._summary["inventory"] if self._summary else None
+        try:
+            inventory = await inventory_client.get_stock_summary()
+            # 缺貨與低庫存互斥，警告總數為兩者相加
+            inventory = {**inventory, "total_alerts": inventory["out_of_stock"] + inventory["low_stock"]}
+            inventory_status = "ok"
+        except HTTPException as e:
+            print(f"Dashboard inventory summary unavailable: {e.detail}")
+            inventory, inventory_status = previous, "unavailable"
+
+        orders_by_status = {status: {"count": count, "revenue": float(total)} for status, count, total in by_status}
+        return {
+            "generated_at": datetime.utcnow(),
+            "orders": {
+                "total": sum(row["count"] for row in orders_by_status.values()),
+                "revenue": sum(row["revenue"] for status, row in orders_by_status.items() if status in REVENUE_STATUSES),
+                "by_status": orders_by_status,
+                "recent": [
+                    {
+                        "id": order.id,
+                        "status": order.status,
+                        "total": float(order.total),
+                        "customer_name": order.customer_name,
+                        "created_at": order.created_at,
+                    }
+                    for order in recent
+                ],
+            },
+            "inventory": inventory,
+            "inventory_status": inventory_status,
+        }
+
+# 全域實例
+dashboard_summary = DashboardSummaryService()
@@ -1,72 +1,178 @@
+import asyncio
 import httpx
 import os
+import re
+import time
 from typing import Dict, List, Optional
 from fastapi import HTTPException
+from prometheus_client import Histogram
+from .product_cache import product_cache
+
+INVENTORY_CALL_DURATION = Histogram(
+    "inventory_client_request_duration_seconds", "呼叫庫存服務的延遲", ["method", "path", "status"]
+)
+
+_ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """包裝 httpx transport，記錄每次呼叫庫存服務的延遲（路徑中的 id 以 {id} 取代）"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport):
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        path = _ID_SEGMENT.sub("/{id}", request.url.path)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = await self._transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        finally:
+            INVENTORY_CALL_DURATION.labels(method=request.method, path=path, status=status).observe(
+                time.perf_counter() - start
+            )
+
+    async def aclose(self):
+        await self._transport.aclose()
 
 class InventoryClient:
-    """庫存服務客戶端"""
+    """庫存服務客戶端（共用一個 keep-alive 連線池）"""
     
     def __init__(self):
         self.base_url = os.getenv("INVENTORY_BASE_URL", "http://inventory-service:8001")
-        self.timeout = 30.0
+        # 連線池大小
+        self.max_connections = int(os.getenv("INVENTORY_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv("INVENTORY_MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = float(os.getenv("INVENTORY_KEEPALIVE_EXPIRY", "30"))
+        # 逾時設定：查詢類請求較短，庫存異動請求較長
+        self.connect_timeout = float(os.getenv("INVENTORY_CONNECT_TIMEOUT", "1.0"))
+        self.pool_timeout = float(os.getenv("INVENTORY_POOL_TIMEOUT", "1.0"))
+        self.read_timeout = float(os.getenv("INVENTORY_READ_TIMEOUT", "2.0"))
+        self.write_timeout = float(os.getenv("INVENTORY_WRITE_TIMEOUT", "5.0"))
+        # HTTP/2 需要 h2 套件且上游支援，預設關閉
+        self.http2 = os.getenv("INVENTORY_HTTP2", "false").lower() in ("1", "true", "yes")
+        # 單一請求內並行呼叫庫存服務的上限
+        self.max_concurrency = int(os.getenv("INVENTORY_MAX_CONCURRENCY", "10"))
+        # 批次查詢每次請求的產品數上限（需不超過庫存服務的限制）
+        self.batch_size = int(os.getenv("INVENTORY_BATCH_SIZE", "500"))
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def _timeout(self, seconds: float) -> httpx.Timeout:
+        return httpx.Timeout(seconds, connect=self.connect_timeout, pool=self.pool_timeout)
+    
+    async def start(self):
+        """建立共用連線池（應用啟動時呼叫）"""
+        if self._client is None:
+            # 連線池設定在 transport 上，外層包一層延遲量測
+            transport = httpx.AsyncHTTPTransport(
+                http2=self.http2,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+            )
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                transport=InstrumentedTransport(transport),
+                timeout=self._timeout(self.read_timeout),
+            )
     
-    async def check_stock(self, product_id: int, required_qty: int) -> Dict:
-        """檢查產品庫存是否足夠"""
+    async def close(self):
+        """關閉共用連線池（應用關閉時呼叫）"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("InventoryClient not started; call start() first")
+        return self._client
+    
+    async def release_items(self, items: List[Dict]) -> Dict[int, Dict]:
+        """一次釋放多筆庫存，回傳 product_id -> 釋放結果"""
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(f"{self.base_url}/api/inventory/stock/{product_id}")
-                response.raise_for_status()
-                
-                stock_info = response.json()
-                if stock_info["current_stock"] < required_qty:
-                    raise HTTPException(
-                        status_code=409,
-                        detail=f"Insufficient stock for product {product_id}. "
-                               f"Required: {required_qty}, Available: {stock_info['current_stock']}"
-                    )
-                
-                return stock_info
+            response = await self.client.post(
+                "/api/inventory/stock/release",
+                json={"items": items},
+                timeout=self._timeout(self.write_timeout)
+            )
+            response.raise_for_status()
+            return {line["product_id"]: line for line in response.json()["items"]}
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+                raise HTTPException(status_code=404, detail=e.response.json().get("detail"))
             raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
         except httpx.RequestError as e:
             raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
     
-    async def reserve_stock(self, product_id: int, qty: int) -> Dict:
-        """預留庫存（減少庫存）"""
+    async def hold_items(self, reservation_id: str, items: List[Dict]) -> Dict[int, Dict]:
+        """建立有期限的庫存預留（全部成功或全部失敗），回傳 product_id -> 預留結果"""
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                adjustment_data = {"adjustment": -qty}
-                response = await client.post(
-                    f"{self.base_url}/api/inventory/stock/{product_id}/adjust",
-                    json=adjustment_data
-                )
-                response.raise_for_status()
-                return response.json()
+            response = await self.client.post(
+                "/api/inventory/stock/reservations",
+                json={"reservation_id": reservation_id, "items": items},
+                timeout=self._timeout(self.write_timeout)
+            )
+            response.raise_for_status()
+            return {line["product_id"]: line for line in response.json()["items"]}
         except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
-            elif e.response.status_code == 400:
-                raise HTTPException(status_code=409, detail="Insufficient stock")
+            if e.response.status_code in (404, 409):
+                raise HTTPException(status_code=e.response.status_code, detail=e.response.json().get("detail"))
             raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
         except httpx.RequestError as e:
             raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
     
-    async def release_stock(self, product_id: int, qty: int) -> Dict:
-        """釋放庫存（增加庫存）"""
+    async def confirm_reservation(self, reservation_id: str, items: List[Dict]) -> Dict[int, Dict]:
+        """確認預留（實際扣除庫存）
+
+        預留已過期被清理時由庫存服務直接扣除 items，並以預留 ID 記錄已確認，
+        重試不會重複扣庫存；已確認過的預留回傳空結果。
+        """
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                adjustment_data = {"adjustment": qty}
-                response = await client.post(
-                    f"{self.base_url}/api/inventory/stock/{product_id}/adjust",
-                    json=adjustment_data
-                )
-                response.raise_for_status()
-                return response.json()
+            response = await self.client.post(
+                f"/api/inventory/stock/reservations/{reservation_id}/confirm",
+                json={"items": items},
+                timeout=self._timeout(self.write_timeout)
+            )
+            response.raise_for_status()
+            return {line["product_id"]: line for line in response.json()["items"]}
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
-                raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+                raise HTTPException(status_code=404, detail=e.response.json().get("detail"))
+            elif e.response.status_code == 409:
+                raise HTTPException(status_code=409, detail=e.response.json().get("detail"))
+            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
+    
+    async def release_reservation(self, reservation_id: str):
+        """釋放預留；預留不存在（已過期被清理）時視為已釋放"""
+        try:
+            response = await self.client.delete(
+                f"/api/inventory/stock/reservations/{reservation_id}",
+                timeout=self._timeout(self.write_timeout)
+            )
+            if response.status_code == 404:
+                return
+            response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
+    
+    async def get_stock_summary(self) -> Dict:
+        """取得庫存摘要（產品數、缺貨與低庫存數及最接近缺貨的產品）"""
+        try:
+            response = await self.client.get(
+                "/api/inventory/stock/summary",
+                timeout=self._timeout(self.read_timeout)
+            )
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
             raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
         except httpx.RequestError as e:
             raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
@@ -74,10 +180,12 @@ class InventoryClient:
     async def get_product_info(self, product_id: int) -> Dict:
         """取得產品資訊"""
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(f"{self.base_url}/api/inventory/products/{product_id}")
-                response.raise_for_status()
-                return response.json()
+            response = await self.client.get(
+                f"/api/inventory/products/{product_id}",
+                timeout=self._timeout(self.read_timeout)
+            )
+            response.raise_for_status()
+            return response.json()
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
                 raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
@@ -85,6 +193,61 @@ class InventoryClient:
         except httpx.RequestError as e:
             raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
 
+    async def get_products_info(self, product_ids: List[int]) -> Dict[int, Dict]:
+        """以批次端點一次取得多個產品資訊，回傳 product_id -> 產品資訊（不存在的產品不會出現）"""
+        result = {}
+        unique_ids = list(dict.fromkeys(product_ids))
+        try:
+            for start in range(0, len(unique_ids), self.batch_size):
+                chunk = unique_ids[start:start + self.batch_size]
+                response = await self.client.post(
+                    "/api/inventory/products:batch",
+                    json={"ids": chunk},
+                    timeout=self._timeout(self.read_timeout)
+                )
+                response.raise_for_status()
+                for product in response.json()["items"]:
+                    result[product["id"]] = product
+            return result
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+        except httpx.RequestError as e:
+            raise HTTPException(status_code=503, detail=f"Inventory service unavailable: {str(e)}")
+    
+    async def get_product_info_many(self, product_ids: List[int]) -> Dict[int, Dict]:
+        """取得多個產品的基本資料（名稱、SKU、價格），優先使用本地快取
+        
+        未命中的產品以一次批次請求向庫存服務查詢；批次請求失敗時改為逐一並行查詢
+        （並行數受 max_concurrency 限制）。查詢不到或失敗的產品不會出現在回傳結果中，
+        由呼叫端決定如何處理缺漏。
+        """
+        found = product_cache.get_many(dict.fromkeys(product_ids))
+        unique_ids = [pid for pid in dict.fromkeys(product_ids) if pid not in found]
+        if not unique_ids:
+            return found
+        
+        try:
+            fetched = await self.get_products_info(unique_ids)
+        except HTTPException:
+            fetched = await self._get_product_info_concurrently(unique_ids)
+        for pid, info in fetched.items():
+            found[pid] = product_cache.set(pid, info)
+        return found
+    
+    async def _get_product_info_concurrently(self, product_ids: List[int]) -> Dict[int, Dict]:
+        """逐一並行查詢產品資訊，個別失敗的產品略過"""
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def fetch(product_id: int) -> Dict:
+            async with semaphore:
+                return await self.get_product_info(product_id)
+        
+        results = await asyncio.gather(*(fetch(pid) for pid in product_ids), return_exceptions=True)
+        return {
+            pid: info for pid, info in zip(product_ids, results)
+            if not isinstance(info, BaseException)
+        }
+
 # 全域實例
 inventory_client = InventoryClient()
 
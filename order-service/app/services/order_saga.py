@@ -0,0 +1,273 @@
+import os
+import json
+import uuid
+import asyncio
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Dict, Optional
+from fastapi import HTTPException
+from sqlalchemy import select, func, update
+from ..db import AsyncSessionLocal
+from ..models import Order, OrderItem, OrderSaga
+from .inventory_client import inventory_client
+from .order_workflow import OrderWorkflowService, OrderStatus
+
+class SagaStep(str, Enum):
+    STARTED = "STARTED"                    # 已記錄，庫存預留可能已建立
+    RESERVED = "RESERVED"                  # 庫存已預留、價格已記錄，訂單尚未寫入
+    AWAITING_PAYMENT = "AWAITING_PAYMENT"  # 訂單已建立（CREATED），等待付款
+    CONFIRMING = "CONFIRMING"              # 付款中：確認預留後把訂單標記為 PAID
+    COMPLETED = "COMPLETED"
+    COMPENSATING = "COMPENSATING"          # 釋放預留並取消已建立的訂單
+    COMPENSATED = "COMPENSATED"
+
+# 由復原工作接手的步驟；AWAITING_PAYMENT 在等待使用者，未付款的預留由庫存服務逾期釋放
+UNFINISHED_STEPS = (SagaStep.STARTED, SagaStep.RESERVED, SagaStep.CONFIRMING, SagaStep.COMPENSATING)
+
+def _error_message(error: Exception) -> str:
+    return str(error.detail) if isinstance(error, HTTPException) else str(error)
+
+class OrderSagaService:
+    """訂單 saga：reserve → persist → confirm，每一步先寫入 order_sagas 再呼叫庫存服務
+
+    建立訂單的請求尚未回應成功前（STARTED、RESERVED）中斷時一律補償：釋放預留，
+    不會在用戶端收到錯誤後才冒出訂單。付款確認中（CONFIRMING）中斷時繼續完成，
+    確認預留在庫存服務端是冪等的，重試不會重複扣庫存。
+    復原工作只接手超過 stale_after 秒沒有推進的 saga，並以 SKIP LOCKED 在副本間分攤。
+    """
+
+    def __init__(self):
+        self.recovery_interval = float(os.getenv("SAGA_RECOVERY_INTERVAL", "30"))
+        # 超過此秒數未推進的 saga 視為所屬程序已中斷
+        self.stale_after = float(os.getenv("SAGA_STALE_AFTER_SECONDS", "60"))
+        self.batch_size = int(os.getenv("SAGA_RECOVERY_BATCH_SIZE", "100"))
+        self.resumed = 0
+        self.compensated = 0
+        self.failures = 0
+        self.last_error = None
+        self.running = False
+
+    async def _set_step(self, saga_id: str, step: SagaStep, error: Optional[str] = None,
+                        expected: Optional[str] = None, **fields) -> bool:
+        """推進 saga 步驟；指定 expected 時只有目前仍在該步驟才推進，回傳是否已推進"""
+        async with AsyncSessionLocal() as db:
+            saga = await db.get(OrderSaga, saga_id, with_for_update=expected is not None)
+            if saga is None:
+                # 導入 saga 前建立的訂單沒有紀錄
+                return False
+            if expected is not None and saga.step != expected:
+                await db.rollback()
+                return False
+            saga.step = step.value
+            saga.updated_at = datetime.utcnow()
+            if error is not None:
+                saga.last_error = error
+            for name, value in fields.items():
+                setattr(saga, name, value)
+            await db.commit()
+            return True
+
+    async def create_order(self, request: Dict) -> int:
+        """預留庫存並寫入訂單，回傳訂單 ID；失敗時補償後拋出原本的錯誤"""
+        saga_id = uuid.uuid4().hex
+        async with AsyncSessionLocal() as db:
+            db.add(OrderSaga(id=saga_id, step=SagaStep.STARTED.value, payload=json.dumps(request)))
+            await db.commit()
+
+        try:
+            product_info = await inventory_client.hold_items(
+                saga_id, [{"product_id": item["product_id"], "qty": item["qty"]} for item in request["items"]]
+            )
+            payload = {**request, "prices": {str(pid): info["price"] for pid, info in product_info.items()}}
+            if not await self._set_step(saga_id, SagaStep.RESERVED, expected=SagaStep.STARTED.value,
+                                        payload=json.dumps(payload)):
+                raise HTTPException(409, "Order reservation was released before the order was saved, please retry")
+            return await self._persist(saga_id, payload)
+        except Exception as e:
+            await self._compensate_quietly(saga_id, e)
+            raise
+
+    async def _persist(self, saga_id: str, payload: Dict) -> int:
+        """在同一個交易寫入訂單與 saga 步驟
+
+        先以條件式 UPDATE 把 saga 從 RESERVED 推進（同時鎖定該列）；請求太慢而 saga 已被
+        復原工作補償時不會寫入沒有預留的訂單。
+        """
+        prices = payload["prices"]
+        async with AsyncSessionLocal() as db:
+            async with db.begin():
+                result = await db.execute(
+                    update(OrderSaga)
+                    .where(OrderSaga.id == saga_id, OrderSaga.step == SagaStep.RESERVED.value)
+                    .values(step=SagaStep.AWAITING_PAYMENT.value, updated_at=datetime.utcnow())
+                )
+                if result.rowcount == 0:
+                    raise HTTPException(409, "Order reservation was released before the order was saved, please retry")
+                order = Order(
+                    status=OrderStatus.CREATED.value,
+                    total=sum(prices[str(item["product_id"])] * item["qty"] for item in payload["items"]),
+                    customer_name=payload.get("customer_name"),
+                    customer_email=payload.get("customer_email"),
+                    shipping_address=payload.get("shipping_address"),
+                    notes=payload.get("notes"),
+                    reservation_id=saga_id
+                )
+                db.add(order)
+                await db.flush()  # 取得 order.id
+                db.add_all([
+                    OrderItem(
+                        order_id=order.id,
+                        product_id=item["product_id"],
+                        qty=item["qty"],
+                        unit_price=prices[str(item["product_id"])]
+                    )
+                    for item in payload["items"]
+                ])
+                await db.execute(update(OrderSaga).where(OrderSaga.id == saga_id).values(order_id=order.id))
+            return order.id
+
+    async def pay(self, saga_id: str, order_id: int, notes: Optional[str] = None):
+        """付款：確認預留（實際扣庫存）並把訂單標記為 PAID
+
+        只從 AWAITING_PAYMENT 推進，與取消互斥；已在付款或已取消時回傳 409。
+        """
+        if not await self._set_step(saga_id, SagaStep.CONFIRMING, expected=SagaStep.AWAITING_PAYMENT.value):
+            raise HTTPException(409, "Order is not awaiting payment")
+        await self._confirm(saga_id, order_id, notes)
+
+    async def _confirm(self, saga_id: str, order_id: int, notes: Optional[str] = None):
+        async with AsyncSessionLocal() as db:
+            items = (await db.execute(select(OrderItem).where(OrderItem.order_id == order_id))).scalars().all()
+            try:
+                await inventory_client.confirm_reservation(
+                    saga_id, [{"product_id": item.product_id, "qty": item.qty} for item in items]
+                )
+            except HTTPException as e:
+                if e.status_code == 409:
+                    # 預留已失效且庫存不足：付款失敗，訂單維持等待付款
+                    await self._set_step(saga_id, SagaStep.AWAITING_PAYMENT, error=_error_message(e),
+                                         expected=SagaStep.CONFIRMING.value)
+                raise
+            # 只完成仍在 CONFIRMING 的 saga；已由其他副本完成時不重複更新訂單
+            saga = await db.get(OrderSaga, saga_id, with_for_update=True)
+            if saga is None or saga.step != SagaStep.CONFIRMING.value:
+                await db.rollback()
+                return
+            saga.step = SagaStep.COMPLETED.value
+            saga.updated_at = datetime.utcnow()
+            order = await db.get(Order, order_id)
+            if order is not None and order.status == OrderStatus.CREATED.value:
+                # 與 saga 步驟在同一次提交
+                await OrderWorkflowService.update_order_status(db, order_id, OrderStatus.PAID.value, notes)
+            else:
+                await db.commit()
+
+    async def compensate(self, saga_id: str, reason: str, expected: Optional[str] = None) -> bool:
+        """釋放預留，已建立的訂單改為 CANCELLED，回傳是否已補償
+
+        指定 expected 時只補償仍停在該步驟的 saga（已被推進或已由其他副本處理時略過）。
+        """
+        advanced = await self._set_step(saga_id, SagaStep.COMPENSATING, error=reason, expected=expected)
+        if expected is not None and not advanced:
+            return False
+        await inventory_client.release_reservation(saga_id)
+        async with AsyncSessionLocal() as db:
+            saga = await db.get(OrderSaga, saga_id)
+            if saga is not None:
+                saga.step = SagaStep.COMPENSATED.value
+                saga.updated_at = datetime.utcnow()
+            order_id = saga.order_id if saga is not None else None
+            if order_id is None:
+                order_id = await db.scalar(select(Order.id).where(Order.reservation_id == saga_id))
+            order = await db.get(Order, order_id) if order_id is not None else None
+            if order is not None and order.status == OrderStatus.CREATED.value:
+                await OrderWorkflowService.update_order_status(db, order.id, OrderStatus.CANCELLED.value, reason)
+            else:
+                await db.commit()
+        return True
+
+    async def cancel(self, saga_id: str, reason: str):
+        """取消尚未付款的訂單；只從 AWAITING_PAYMENT 補償，付款確認中或已完成時回傳 409"""
+        if not await self.compensate(saga_id, reason, expected=SagaStep.AWAITING_PAYMENT.value):
+            raise HTTPException(409, "Order is not awaiting payment")
+
+    async def _compensate_quietly(self, saga_id: str, error: Exception):
+        """建立失敗時的補償；補償本身失敗時留給復原工作"""
+        try:
+            await self.compensate(saga_id, f"Order creation failed: {_error_message(error)}")
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"❌ Saga {saga_id} compensation failed, left for recovery: {e}")
+
+    async def recover_once(self) -> int:
+        """接手一批中斷的 saga，回傳處理筆數"""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            sagas = (await db.execute(
+                select(OrderSaga)
+                .where(
+                    OrderSaga.step.in_([step.value for step in UNFINISHED_STEPS]),
+                    OrderSaga.updated_at <= now - timedelta(seconds=self.stale_after),
+                )
+                .order_by(OrderSaga.updated_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )).scalars().all()
+            # 更新 updated_at 作為租約，避免其他副本同時接手
+            for saga in sagas:
+                saga.updated_at = now
+                saga.attempts += 1
+            claimed = [(saga.id, saga.step, saga.order_id) for saga in sagas]
+            await db.commit()
+
+        for saga_id, step, order_id in claimed:
+            try:
+                if step == SagaStep.CONFIRMING.value:
+                    await self._confirm(saga_id, order_id, "Payment confirmed by saga recovery")
+                    self.resumed += 1
+                else:
+                    # 認領後原請求可能已寫入訂單而推進到 AWAITING_PAYMENT，此時不補償
+                    if await self.compensate(saga_id, f"Compensated by saga recovery from {step}", expected=step):
+                        self.compensated += 1
+            except Exception as e:
+                self.failures += 1
+                self.last_error = _error_message(e)
+                print(f"❌ Saga {saga_id} recovery from {step} failed: {self.last_error}")
+        return len(claimed)
+
+    async def run(self):
+        """復原迴圈：啟動時先處理一次，之後依間隔處理；有積壓時連續處理"""
+        self.running = True
+        while self.running:
+            try:
+                if await self.recover_once() >= self.batch_size:
+                    continue
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"❌ Saga recovery error: {e}")
+            await asyncio.sleep(self.recovery_interval)
+
+    async def stats(self) -> Dict:
+        """各步驟的 saga 數量與復原計數"""
+        async with AsyncSessionLocal() as db:
+            counts = dict((await db.execute(
+                select(OrderSaga.step, func.count(OrderSaga.id))
+                .where(OrderSaga.step.in_([step.value for step in UNFINISHED_STEPS + (SagaStep.AWAITING_PAYMENT,)]))
+                .group_by(OrderSaga.step)
+            )).all())
+        return {
+            "steps": counts,
+            "resumed": self.resumed,
+            "compensated": self.compensated,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+    def stop(self):
+        """停止復原迴圈"""
+        self.running = False
+
+# 全域實例
+order_saga = OrderSagaService()
@@ -1,7 +1,7 @@
 from datetime import datetime
 from enum import Enum
 from typing import Optional
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import pytz
 from ..models import Order
 
@@ -43,10 +43,10 @@ class OrderWorkflowService:
         return [status.value for status in cls.VALID_TRANSITIONS.get(current, [])]
     
     @classmethod
-    def update_order_status(cls, db: Session, order_id: int, new_status: str, 
-                          notes: Optional[str] = None) -> Order:
+    async def update_order_status(cls, db: AsyncSession, order_id: int, new_status: str, 
+                                  notes: Optional[str] = None) -> Order:
         """更新訂單狀態"""
-        order = db.query(Order).filter(Order.id == order_id).first()
+        order = await db.get(Order, order_id)
         if not order:
             raise ValueError(f"Order {order_id} not found")
         
@@ -73,8 +73,8 @@ class OrderWorkflowService:
             else:
                 order.notes = f"[{get_aest_time().isoformat()}] {notes}"
         
-        db.commit()
-        db.refresh(order)
+        await db.commit()
+        await db.refresh(order)
         
         return order
     
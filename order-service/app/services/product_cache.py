@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+class ProductCache:
+    """產品基本資料的行程內 LRU + TTL 快取
+
+    只存放幾乎不變的欄位（名稱、SKU、價格），不存放庫存數量。
+    由 inventory-service 發布的 product_updates 訊息失效，TTL 作為漏接訊息時的保底。
+    """
+
+    FIELDS = ("id", "sku", "name", "price")
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, product_id: int) -> Optional[Dict]:
+        """取得快取資料，過期或不存在時回傳 None"""
+        with self._lock:
+            entry = self._entries.get(product_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[product_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(product_id)
+            self.hits += 1
+            return entry[1]
+
+    def get_many(self, product_ids: Iterable[int]) -> Dict[int, Dict]:
+        """批次取得，只回傳命中的項目"""
+        found = {}
+        for product_id in product_ids:
+            data = self.get(product_id)
+            if data is not None:
+                found[product_id] = data
+        return found
+
+    def set(self, product_id: int, data: Dict) -> Dict:
+        """寫入快取，超過容量時淘汰最久未使用的項目，回傳實際快取的資料"""
+        metadata = {k: data[k] for k in self.FIELDS if k in data}
+        with self._lock:
+            self._entries[product_id] = (time.monotonic() + self.ttl, metadata)
+            self._entries.move_to_end(product_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return metadata
+
+    def invalidate(self, product_id: int):
+        """移除單一產品"""
+        with self._lock:
+            self._entries.pop(product_id, None)
+
+    def clear(self):
+        """清空快取"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """取得快取統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+# 全域實例
+product_cache = ProductCache(
+    max_size=int(os.getenv("PRODUCT_CACHE_MAX_SIZE", "10000")),
+    ttl=float(os.getenv("PRODUCT_CACHE_TTL", "300")),
+)
@@ -0,0 +1,78 @@
+import time
+import redis
+import redis.asyncio as aioredis
+from prometheus_client import Counter, Histogram
+
+# 指標名稱與庫存服務 app/cache.py 相同，兩個服務的 Redis 延遲可在同一張面板比較
+REDIS_OP_DURATION = Histogram(
+    "redis_command_duration_seconds", "Redis 指令延遲", ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+REDIS_ERRORS = Counter("redis_command_errors_total", "Redis 指令錯誤數", ["command"])
+
+def observe_redis_command(command: str, elapsed: float, failed: bool = False):
+    REDIS_OP_DURATION.labels(command=command).observe(elapsed)
+    if failed:
+        REDIS_ERRORS.labels(command=command).inc()
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """記錄整批 pipeline 執行時間的 Pipeline"""
+
+    def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command("PIPELINE", time.perf_counter() - start, failed)
+
+class InstrumentedRedis(redis.Redis):
+    """記錄每個指令延遲的同步 Redis 客戶端（阻塞讀取的 XREADGROUP 包含等待時間）"""
+
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command(str(args[0]).upper(), time.perf_counter() - start, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+class InstrumentedAsyncPipeline(aioredis.client.Pipeline):
+    """記錄整批 pipeline 執行時間的非同步 Pipeline"""
+
+    async def execute(self, raise_on_error=True):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command("PIPELINE", time.perf_counter() - start, failed)
+
+class InstrumentedAsyncRedis(aioredis.Redis):
+    """記錄每個指令延遲的非同步 Redis 客戶端；訂閱連線的 get_message 不經過此處，不計入"""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        failed = False
+        try:
+            return await super().execute_command(*args, **options)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            observe_redis_command(str(args[0]).upper(), time.perf_counter() - start, failed)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -1,19 +1,40 @@
-import redis
+import os
 import json
+import random
 import asyncio
-from typing import Dict, Any
+from typing import Dict, Any, List
+from .product_cache import product_cache
+from .redis_client import InstrumentedAsyncRedis
 
 class RedisSubscriber:
-    """Redis 訂閱者服務"""
+    """Redis 訂閱者服務
+
+    使用 redis.asyncio 非阻塞地接收訊息，不佔用事件迴圈；連線中斷時以指數退避重連。
+    收到的訊息放入有界佇列，由固定數量的 worker 執行處理函式，
+    處理速度跟不上時佇列滿會反壓讀取端，而不是無限堆積。
+    """
+    
+    CHANNELS = ('inventory_updates', 'product_updates')
     
     def __init__(self):
-        try:
-            self.redis_client = redis.Redis(host='redis', port=6379, decode_responses=True, socket_connect_timeout=5, socket_timeout=5)
-            self.running = False
-        except Exception as e:
-            print(f"Redis connection failed: {e}")
-            self.redis_client = None
-            self.running = False
+        self.redis_client = InstrumentedAsyncRedis(
+            host=os.getenv("REDIS_HOST", "redis"),
+            port=int(os.getenv("REDIS_PORT", "6379")),
+            decode_responses=True,
+            socket_connect_timeout=5,
+            # 冪等鍵也共用此客戶端，Redis 無回應時需快速失敗改用 MySQL 備援；訂閱讀取以 get_message 的 timeout 另行控制
+            socket_timeout=1,
+        )
+        self.workers = int(os.getenv("REDIS_SUBSCRIBER_WORKERS", "4"))
+        self.queue_size = int(os.getenv("REDIS_SUBSCRIBER_QUEUE_SIZE", "1000"))
+        self.backoff_base = float(os.getenv("REDIS_SUBSCRIBER_BACKOFF_BASE", "0.5"))
+        self.backoff_max = float(os.getenv("REDIS_SUBSCRIBER_BACKOFF_MAX", "30"))
+        self.handlers = {
+            'inventory_updates': self.handle_inventory_update,
+            'product_updates': self.handle_product_update,
+        }
+        self.attempt = 0
+        self.running = False
     
     async def handle_low_stock_alert(self, data: Dict[str, Any]):
         """處理低庫存警告"""
@@ -26,6 +47,11 @@ class RedisSubscriber:
         # - 記錄到日誌系統
         # - 觸發自動補貨流程
     
+    async def handle_low_stock_cleared(self, data: Dict[str, Any]):
+        """處理低庫存解除（庫存回升至安全庫存以上）"""
+        print(f"✅ Low Stock Cleared: {data['sku']} ({data['name']}) - "
+              f"Current: {data['current_stock']}, Safety: {data['safety_stock']}")
+    
     async def handle_stock_change(self, data: Dict[str, Any]):
         """處理庫存變更通知"""
         print(f"📦 Stock Change: {data['sku']} ({data['name']}) - "
@@ -42,45 +68,67 @@ class RedisSubscriber:
         
         # 這裡可以添加更多處理邏輯
     
-    async def subscribe_to_channels(self):
-        """訂閱所有相關頻道"""
-        if not self.redis_client:
-            print("❌ Redis client not available, skipping subscription")
-            return
-            
+    async def handle_product_update(self, data: Dict[str, Any]):
+        """處理產品資料變更：失效本地產品快取"""
+        product_cache.invalidate(int(data['product_id']))
+        print(f"🧹 Product cache invalidated: {data['product_id']} ({data.get('action')})")
+    
+    async def _worker(self, queue: asyncio.Queue):
+        """從佇列取出訊息並執行對應的處理函式"""
+        while True:
+            channel, data = await queue.get()
+            try:
+                await self.handlers[channel](data)
+            except Exception as e:
+                print(f"Error processing message on {channel}: {e}")
+            finally:
+                queue.task_done()
+    
+    async def _listen(self, queue: asyncio.Queue):
+        """訂閱頻道並把訊息交給 worker，直到停止或連線中斷"""
+        pubsub = self.redis_client.pubsub()
         try:
-            pubsub = self.redis_client.pubsub()
-            
-            # 訂閱頻道
-            pubsub.subscribe(
-                'low_stock_alerts',
-                'stock_changes', 
-                'inventory_updates'
-            )
-            
-            print("🔔 Subscribed to Redis channels: low_stock_alerts, stock_changes, inventory_updates")
-            
-            self.running = True
-            for message in pubsub.listen():
-                if not self.running:
-                    break
-                    
-                if message['type'] == 'message':
-                    channel = message['channel']
+            await pubsub.subscribe(*self.CHANNELS)
+            print(f"🔔 Subscribed to Redis channels: {', '.join(self.CHANNELS)}")
+            self.attempt = 0
+            while self.running:
+                # 帶逾時等待，讓 stop() 能在一秒內生效
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None or message['type'] != 'message':
+                    continue
+                try:
                     data = json.loads(message['data'])
-                    
-                    if channel == 'low_stock_alerts':
-                        await self.handle_low_stock_alert(data)
-                    elif channel == 'stock_changes':
-                        await self.handle_stock_change(data)
-                    elif channel == 'inventory_updates':
-                        await self.handle_inventory_update(data)
-                        
-        except Exception as e:
-            print(f"❌ Redis subscription error: {e}")
+                except ValueError as e:
+                    print(f"Invalid message on {message['channel']}: {e}")
+                    continue
+                await queue.put((message['channel'], data))
+        finally:
+            # 訂閱中斷期間可能漏接失效訊息，清空快取避免讀到舊資料
+            product_cache.clear()
+            await pubsub.reset()
+    
+    async def subscribe_to_channels(self):
+        """訂閱所有相關頻道（低庫存警告與庫存變更改由 stock_events 的 Stream 消費者處理）"""
+        self.running = True
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        workers: List[asyncio.Task] = [
+            asyncio.create_task(self._worker(queue)) for _ in range(self.workers)
+        ]
+        try:
+            while self.running:
+                try:
+                    await self._listen(queue)
+                except Exception as e:
+                    # 指數退避加隨機抖動，避免所有副本同時重連
+                    delay = min(self.backoff_max, self.backoff_base * 2 ** self.attempt)
+                    delay *= random.uniform(0.5, 1.0)
+                    self.attempt += 1
+                    print(f"❌ Redis subscription error: {e}; reconnecting in {delay:.1f}s")
+                    await asyncio.sleep(delay)
         finally:
-            if 'pubsub' in locals():
-                pubsub.close()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
             print("🔕 Redis subscription closed")
     
     def stop(self):
@@ -0,0 +1,165 @@
+import os
+import json
+import socket
+import asyncio
+import redis
+from typing import Dict, List, Tuple
+from .redis_subscriber import redis_subscriber
+from .redis_client import InstrumentedRedis
+
+STOCK_EVENTS_STREAM = "stream:stock_events"
+STOCK_EVENTS_DEAD_STREAM = "stream:stock_events:dead"
+
+class StockEventConsumer:
+    """庫存事件 Stream 消費者
+
+    所有副本加入同一個消費者群組，每筆事件只會交給其中一個副本處理；
+    處理成功才 XACK。重啟時先重新處理自己尚未確認的事件，並定期以
+    XAUTOCLAIM 接手其他（已離線）消費者閒置過久的事件。
+    超過投遞次數上限的事件移到 dead letter Stream，避免卡住整個群組。
+    """
+
+    def __init__(self):
+        self.redis_client = InstrumentedRedis(
+            host=os.getenv("REDIS_HOST", "redis"),
+            port=int(os.getenv("REDIS_PORT", "6379")),
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=10,
+        )
+        self.group = os.getenv("STOCK_EVENTS_GROUP", "order-service")
+        # 以 pod 名稱作為消費者名稱，重啟後能接續自己的待確認事件
+        self.consumer = os.getenv("STOCK_EVENTS_CONSUMER", socket.gethostname())
+        self.batch_size = int(os.getenv("STOCK_EVENTS_BATCH_SIZE", "100"))
+        self.block_ms = int(os.getenv("STOCK_EVENTS_BLOCK_MS", "2000"))
+        self.claim_idle_ms = int(os.getenv("STOCK_EVENTS_CLAIM_IDLE_MS", "60000"))
+        self.max_deliveries = int(os.getenv("STOCK_EVENTS_MAX_DELIVERIES", "5"))
+        self.handlers = {
+            "low_stock_alert": redis_subscriber.handle_low_stock_alert,
+            "low_stock_cleared": redis_subscriber.handle_low_stock_cleared,
+            "stock_change": redis_subscriber.handle_stock_change,
+        }
+        self.processed = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self.running = False
+
+    def ensure_group(self):
+        """建立消費者群組（已存在則略過）"""
+        try:
+            self.redis_client.xgroup_create(STOCK_EVENTS_STREAM, self.group, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def _read(self, start_id: str) -> List[Tuple[str, Dict]]:
+        """讀取事件；start_id 為 ">" 取新事件，"0" 取自己尚未確認的事件"""
+        block = self.block_ms if start_id == ">" else None
+        response = self.redis_client.xreadgroup(
+            self.group, self.consumer, {STOCK_EVENTS_STREAM: start_id},
+            count=self.batch_size, block=block,
+        )
+        if not response:
+            return []
+        return response[0][1]
+
+    def _claim_stale(self) -> List[Tuple[str, Dict]]:
+        """接手其他消費者閒置過久的待確認事件"""
+        _, messages, _ = self.redis_client.xautoclaim(
+            STOCK_EVENTS_STREAM, self.group, self.consumer,
+            min_idle_time=self.claim_idle_ms, start_id="0-0", count=self.batch_size,
+        )
+        return messages
+
+    def _delivery_counts(self, message_ids: List[str]) -> Dict[str, int]:
+        if not message_ids:
+            return {}
+        pending = self.redis_client.xpending_range(
+            STOCK_EVENTS_STREAM, self.group, min=message_ids[0], max=message_ids[-1],
+            count=len(message_ids), consumername=self.consumer,
+        )
+        return {entry["message_id"]: entry["times_delivered"] for entry in pending}
+
+    async def _handle(self, messages: List[Tuple[str, Dict]], check_deliveries: bool = False):
+        """處理一批事件，成功者一次 XACK；重複失敗者移到 dead letter"""
+        if not messages:
+            return
+        deliveries = {}
+        if check_deliveries:
+            deliveries = await asyncio.to_thread(self._delivery_counts, [m[0] for m in messages])
+        acked, dead = [], []
+        for message_id, fields in messages:
+            if not fields:
+                # 已被裁剪出 Stream 的事件只需確認
+                acked.append(message_id)
+                continue
+            handler = self.handlers.get(fields.get("type"))
+            try:
+                if handler is not None:
+                    await handler(json.loads(fields["data"]))
+                acked.append(message_id)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Stock event {message_id} failed: {e}")
+                if deliveries.get(message_id, 1) >= self.max_deliveries:
+                    dead.append((message_id, fields))
+        await asyncio.to_thread(self._ack, acked, dead)
+
+    def _ack(self, acked: List[str], dead: List[Tuple[str, Dict]]):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for message_id, fields in dead:
+            pipe.xadd(STOCK_EVENTS_DEAD_STREAM, {**fields, "source_id": message_id}, maxlen=10000, approximate=True)
+        ids = acked + [message_id for message_id, _ in dead]
+        if ids:
+            pipe.xack(STOCK_EVENTS_STREAM, self.group, *ids)
+        pipe.execute()
+        self.dead_lettered += len(dead)
+
+    async def _consume(self):
+        await asyncio.to_thread(self.ensure_group)
+        print(f"🔔 Consuming {STOCK_EVENTS_STREAM} as {self.group}/{self.consumer}")
+        while self.running:
+            backlog = await asyncio.to_thread(self._read, "0")
+            if not backlog:
+                break
+            await self._handle(backlog, check_deliveries=True)
+        loop = asyncio.get_running_loop()
+        next_claim = 0.0
+        while self.running:
+            if loop.time() >= next_claim:
+                await self._handle(await asyncio.to_thread(self._claim_stale), check_deliveries=True)
+                next_claim = loop.time() + self.claim_idle_ms / 1000
+            await self._handle(await asyncio.to_thread(self._read, ">"))
+
+    async def run(self):
+        """消費迴圈：先處理自己未確認的事件，之後讀取新事件並定期接手閒置事件"""
+        self.running = True
+        while self.running:
+            try:
+                await self._consume()
+            except Exception as e:
+                # 連線中斷時稍後重試，未確認的事件仍留在群組中
+                print(f"❌ Stock event consumer error: {e}")
+                await asyncio.sleep(1)
+        print("🔕 Stock event consumer stopped")
+
+    def stats(self) -> Dict:
+        """群組待確認數、Stream 長度與本副本的處理計數"""
+        summary = self.redis_client.xpending(STOCK_EVENTS_STREAM, self.group)
+        return {
+            "stream_length": self.redis_client.xlen(STOCK_EVENTS_STREAM),
+            "pending": summary["pending"],
+            "dead_letter_length": self.redis_client.xlen(STOCK_EVENTS_DEAD_STREAM),
+            "consumer": self.consumer,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    def stop(self):
+        """停止消費"""
+        self.running = False
+
+# 全域實例
+stock_event_consumer = StockEventConsumer()